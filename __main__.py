@@ -1,11 +1,205 @@
 import sys
 import os
 
+from constants import RESAMPLE_FILTER_NAMES, DEFAULT_RESAMPLE_FILTER, PNG_IMAGE_EXTENSION, GIF_IMAGE_EXTENSION, \
+    THREADS_PER_CPU, ANIMATION_FORMATS, DEFAULT_PNG_COMPRESS_LEVEL, COMPOSITOR_NAMES, DEFAULT_COMPOSITOR, \
+    DEFAULT_SERVER_HOST, DEFAULT_SERVER_PORT, DEFAULT_SERVER_CACHE_MB
+from atlas import Atlas
+from markdown_source import MarkdownSource
+from batch import expand_markdown_filenames, extract_documents, unique_sequences, write_documents
+from stats import STATS
+from watch import WatchSession, watch, watched_paths
 from mdpicgen import (format_markdown, process_psd, process_imageset, extract_button_sequences, write_markdown,
-                      ImageOpt)
+                      check_prescaled, export_psd_imageset, serve_imageset, ImageOpt, PngOpt)
 
 DEBUG_LOG_MAIN = True
 
+
+def height_list(text) -> [int]:
+    """ Comma-separated heights, e.g. '48,96' """
+    return [int(value) for value in text.split(",")]
+
+
+def format_list(text) -> [str]:
+    """ Comma-separated formats, e.g. 'png,gif' """
+    formats = [value.strip().lower() for value in text.split(",")]
+    if not set(formats) <= {PNG_IMAGE_EXTENSION, *ANIMATION_FORMATS}:
+        raise ValueError(text)
+    return formats
+
+
+def png_opt(args) -> PngOpt:
+    return PngOpt(args.png_compress_level, args.png_optimize, args.png_colors, args.png_strip,
+                  measure_saved=bool(args.stats or args.stats_json))
+
+
+def main(args, session: WatchSession = None, changed_paths: {str} = None) -> int:
+    """
+    Runs the whole pipeline once, then reports its stats.
+
+    :param session: State kept between runs with --watch
+    :param changed_paths: Paths changed since the previous run, with --watch
+    :return: Exit status
+    """
+    STATS.reset()
+    with STATS.stage("total"):
+        status = run_pipeline(args, session, changed_paths)
+
+    if args.stats:
+        print(STATS.report())
+    if args.stats_json:
+        STATS.write_json(args.stats_json)
+    return status
+
+
+def serve(args) -> int:
+    """
+    Serves images rendered on request, until interrupted, then reports its stats.
+
+    :return: Exit status
+    """
+    STATS.reset()
+    opt = ImageOpt(height=args.image_height[0], gif=False, prescale=args.prescale, resample=args.resample,
+                   heights=args.image_height, png=png_opt(args), compositor=args.compositor)
+    try:
+        serve_imageset(args.imageset_file, args.imageset_dir, opt, args.host, args.port, args.cache_mb << 20,
+                       args.watch_interval)
+    except Exception as e:
+        print(f"Aborting. Error serving imageset: {e}", file=sys.stderr)
+        return 1
+
+    if args.stats:
+        print(STATS.report())
+    if args.stats_json:
+        STATS.write_json(args.stats_json)
+    return 0
+
+
+def run_pipeline(args, session: WatchSession = None, changed_paths: {str} = None) -> int:
+    # With --watch, force regeneration on the first run only
+    force = args.force and not (session and session.run_count)
+
+    md_filenames = expand_markdown_filenames(args.md_file, [args.md_out_dir])
+    if not md_filenames:
+        print(f"Aborting. No Markdown files found: {args.md_file}", file=sys.stderr)
+        return 1
+    if args.md_out_file and len(md_filenames) > 1:
+        print("Aborting. Use --md-out-dir, instead of --md-out-file, with several Markdown files", file=sys.stderr)
+        return 1
+
+    if args.atlas and (args.gif or set(args.format or []) - {PNG_IMAGE_EXTENSION}):
+        print("Aborting. Use --atlas without --gif, or animated --format: atlases pack PNG images only",
+              file=sys.stderr)
+        return 1
+
+    # Extract from Markdown
+    sequences_by_document = {}
+    sources = {}
+    try:
+        in_workers = len(md_filenames) > 1 and not session and (args.jobs or 1) > 1
+        if not args.stream and not in_workers:
+            # Read, and parse, each file once: shared by extraction, link rewriting and formatting
+            sources = {md_filename: MarkdownSource(md_filename) for md_filename in md_filenames}
+
+        if len(md_filenames) == 1:
+            sequences_by_document = {md_filenames[0]: extract_button_sequences(
+                md_filenames[0], args.button_pattern_file, args.extract_index, force, args.stream,
+                session.extraction_index(md_filenames[0], args.extract_index, force) if session else None,
+                sources.get(md_filenames[0]))}
+        elif session:
+            # Serially, reusing each file's in-memory index
+            sequences_by_document = {md_filename: extract_button_sequences(
+                md_filename, args.button_pattern_file, force=force, stream=args.stream,
+                index=session.extraction_index(md_filename), source=sources.get(md_filename))
+                for md_filename in md_filenames}
+        else:
+            if args.extract_index:
+                print("Ignoring --extract-index option, only supported for a single Markdown file", file=sys.stderr)
+            sequences_by_document = extract_documents(md_filenames, args.button_pattern_file, args.jobs or 1,
+                                                      args.stream, sources)
+        button_sequences = unique_sequences(sequences_by_document)
+        sequence_count = sum(len(sequences) for sequences in sequences_by_document.values())
+        if len(md_filenames) == 1:
+            print(f"extracted {sequence_count} sequences")
+        else:
+            print(f"extracted {sequence_count} sequences, {len(button_sequences)} unique, "
+                  f"from {len(md_filenames)} files")
+    except Exception as e:
+        print(f"Aborting. Error extracting button sequences: {e}", file=sys.stderr)
+        return 1
+
+    basenames = [seq.basename for seq in button_sequences]
+
+    if args.print_extract:
+        for md_filename, sequences in sequences_by_document.items():
+            if len(md_filenames) > 1:
+                print(f"{md_filename}:")
+            for seq in sequences:
+                print(f"{seq.sequence_mapping} => {seq.basename}")
+
+    if args.image_source == "psd" and args.psd_file:
+        try:
+            if args.gif or args.format or args.atlas:
+                print("Ignoring --gif, --format and --atlas options, only PNG files are supported for PSD, see "
+                      "psd-imageset", file=sys.stderr)
+
+            with STATS.stage("images"):
+                process_psd(args.image_out_dir, args.psd_file, basenames,
+                            ImageOpt(height=args.image_height[0], gif=False, heights=args.image_height,
+                                     png=png_opt(args)), force, args.jobs)
+        except Exception as e:
+            print(f"Aborting. Error processing PSD file: {e}", file=sys.stderr)
+            return 1
+    elif args.image_source in ("imageset", "psd-imageset"):
+        try:
+            exported = False
+            if args.image_source == "psd-imageset":
+                with STATS.stage("export_psd"):
+                    exported = export_psd_imageset(args.psd_file, args.imageset_file, args.imageset_dir, force)
+
+            opt = ImageOpt(height=args.image_height[0], gif=args.gif, prescale=args.prescale, resample=args.resample,
+                           heights=args.image_height, formats=args.format, animation_format=args.animation_format,
+                           png=png_opt(args), compositor=args.compositor)
+            if args.prescale_check:
+                check_prescaled(args.imageset_file, args.imageset_dir, button_sequences,
+                                ImageOpt(height=args.image_height[0], gif=False, prescale=True,
+                                         resample=args.resample))
+            else:
+                with STATS.stage("images"):
+                    process_imageset(args.image_out_dir, args.imageset_file, args.imageset_dir, button_sequences,
+                                     opt, force, args.jobs or 1, session.imageset if session else None,
+                                     exported or not session or
+                                     session.is_imageset_changed(changed_paths, args.imageset_file, args.imageset_dir),
+                                     args.atlas)
+        except Exception as e:
+            print(f"Aborting. Error processing imageset: {e}", file=sys.stderr)
+            return 1
+
+    if args.md_out_file or args.md_out_dir:
+        try:
+            link_opt = ImageOpt(args.image_height[0], gif=args.gif, heights=args.image_height,
+                                animation_format=args.animation_format)
+            atlas = Atlas.load(args.image_out_dir) if args.atlas else None
+            if args.md_out_file:
+                markdown = write_markdown(args.md_out_file, args.image_out_dir, md_filenames[0],
+                                          sequences_by_document[md_filenames[0]], link_opt, args.srcset,
+                                          sources.get(md_filenames[0]), atlas)
+            if args.md_out_dir:
+                write_documents(args.md_out_dir, args.image_out_dir, sequences_by_document, link_opt, args.srcset,
+                                sources, atlas)
+        except Exception as e:
+            print(f"Aborting. Error writing markdown: {e}", file=sys.stderr)
+            return 1
+
+    if args.print_formatted:
+        for md_filename in md_filenames:
+            with STATS.stage("format_markdown", md_filename):
+                formatted_text = format_markdown(md_filename, sources.get(md_filename))
+            print(formatted_text)
+
+    return 0
+
+
 if __name__ == '__main__':
     import argparse
 
@@ -24,19 +218,89 @@ if __name__ == '__main__':
                     -- see sub-commands for image generation details. 
                     ''')
 
-    parser.add_argument("--md-file", type=str, help="Input filename for the Markdown file.", required=True)
+    parser.add_argument("--md-file", type=str, action='append',
+                        help="Input filename for the Markdown file. Repeat, or give a directory or a quoted glob "
+                             "pattern, to process several files in one batch: images shared by files are "
+                             "generated once. Required, except by the serve sub-command.")
     parser.add_argument("--md-out-file", type=str,
                         help="Output filename for Input Markdown with updated image links.")
+    parser.add_argument("--md-out-dir", type=str,
+                        help="Output directory for each input Markdown with updated image links, at its path "
+                             "relative to the common directory of all inputs. Links are relative to each output "
+                             "file.")
     parser.add_argument("--image-out-dir", default='out', type=str,
                         help="Output directory name for composited images, will be created (Default: 'out').")
 
     parser.add_argument("--button-pattern-file", default=f"{script_dir}/qunmk2.patset", type=str,
                         help="Pattern filename for matching buttons (Default: 'qunmk2.patset').")
 
-    parser.add_argument("--image-height", default=48, type=int,
-                        help="Pixel height of generated images, used with sub-commands (Default: 48).")
+    parser.add_argument("--image-height", default=[48], type=height_list,
+                        help="Pixel height of generated images, used with sub-commands. Comma-separate several "
+                             "heights to generate them all in one run, e.g. '48,96,144'. The first height is linked "
+                             "from Markdown. Images of further heights are named with their height, e.g. "
+                             "'s_1@96.png' (Default: 48).")
     parser.add_argument("--gif", action='store_true', help="Generate GIF from button sequences, "
                                                            "sets filename extension (Default: false, use PNG).")
+    parser.add_argument("--animation-format", choices=ANIMATION_FORMATS, default=GIF_IMAGE_EXTENSION,
+                        help="Format of animations with '--gif': 'gif', or 'apng' or 'webp', animated PNG and WebP, "
+                             "lossless in full color, though larger than GIF. GIF frames share one palette of the "
+                             "imageset's colors (Default: 'gif').")
+    parser.add_argument("--format", type=format_list,
+                        help="Additional comma-separated image formats to generate in the same run, 'png', 'gif', "
+                             "'apng' or 'webp', besides PNG, or the '--animation-format' with '--gif'. Compositing "
+                             "is shared by all heights and formats (Default: none).")
+    parser.add_argument("--png-compress-level", type=int, choices=range(10), default=DEFAULT_PNG_COMPRESS_LEVEL,
+                        metavar="{0-9}",
+                        help=f"zlib compression level of PNG images, 0 for fastest, to 9 for smallest "
+                             f"(Default: {DEFAULT_PNG_COMPRESS_LEVEL}).")
+    parser.add_argument("--png-optimize", action='store_true',
+                        help="Search for the smallest PNG encoding, slower (Default: false).")
+    parser.add_argument("--png-colors", type=int, choices=range(1, 257), metavar="{1-256}",
+                        help="Quantize PNG images to a palette of at most this many colors, with alpha. "
+                             "Much smaller for images of few colors, lossy for images of more "
+                             "(Default: none, full RGBA).")
+    parser.add_argument("--png-strip", action='store_true',
+                        help="Drop metadata copied from layer images into PNG images, e.g. their ICC color profile "
+                             "(Default: false, keep it).")
+    parser.add_argument("--srcset", action='store_true',
+                        help="Link images of all '--image-height' heights from Markdown, as an HTML <img> tag with "
+                             "a srcset attribute, relative to the first height (Default: false, Markdown link).")
+
+    parser.add_argument("--atlas", action='store_true',
+                        help="Pack the PNG images of all heights into a few sprite sheets in '--image-out-dir', "
+                             "'atlas-0.png' etc., indexed by 'atlas.json' and 'atlas.css', instead of a file each. "
+                             "Links each image from Markdown as an HTML <img> tag of its sheet, styled to show only "
+                             "the image. Not for GIF (Default: false, a file each).")
+    parser.add_argument("--extract-index", type=str,
+                        help="Index filename for caching extracted sequences, reused while '--md-file' and "
+                             "'--button-pattern-file' are unchanged, per table (Default: none, always extract).")
+    parser.add_argument("--stream", action='store_true',
+                        help="Extract sequences reading '--md-file' line by line, in memory bounded by its largest "
+                             "block rather than the whole document. Ignores '--extract-index' "
+                             "(Default: false, parse the whole document).")
+    parser.add_argument("--force", action='store_true',
+                        help="Regenerate all images, even those unchanged since they were last generated into "
+                             "'--image-out-dir', and re-extract all sequences, ignoring '--extract-index' "
+                             "(Default: false, skip unchanged images and tables).")
+
+    parser.add_argument("--jobs", type=int,
+                        help="Number of worker processes generating images, and extracting several '--md-file' "
+                             f"files (Default: 1, except the psd sub-command, which uses {THREADS_PER_CPU} "
+                             f"threads per CPU instead of processes).")
+
+    parser.add_argument("--watch", action='store_true',
+                        help="Keep running, and run again whenever '--md-file', '--button-pattern-file', or the "
+                             "sub-command's inputs change. Only edited tables are extracted again, and only images "
+                             "with changed inputs are generated again.")
+    parser.add_argument("--watch-interval", type=float, default=0.5,
+                        help="Seconds between checks for changes with '--watch', or of the imageset served by "
+                             "the serve sub-command (Default: 0.5).")
+
+    parser.add_argument("--stats", action='store_true',
+                        help="Print time spent in each stage, counters such as images composited and bytes "
+                             "written, and image render latencies, after the run.")
+    parser.add_argument("--stats-json", type=str,
+                        help="Output filename for the '--stats' report as JSON, including time per Markdown file.")
 
     parser.add_argument("--print-formatted", action='store_true',
                         help="Print formatted Markdown (from '--md-file') to the console.")
@@ -49,7 +313,27 @@ if __name__ == '__main__':
                                        help="Optional sub-commands for how to generate images: "
                                             "the source of image data.")
 
-    parser_imageset = subparsers.add_parser("imageset",
+    # Options for rendering images from an imageset, shared by sub-commands
+    render_options = argparse.ArgumentParser(add_help=False)
+    render_options.add_argument("--prescale", action='store_true',
+                                help="Composite at output size, from layers scaled once to '--image-height'. "
+                                     "Much faster for small images, with slight differences at layer edges "
+                                     "(Default: false, composite at full size then resize).")
+    render_options.add_argument("--resample", choices=RESAMPLE_FILTER_NAMES, default=DEFAULT_RESAMPLE_FILTER,
+                                help=f"Resampling filter for resizing images to '--image-height' "
+                                     f"(Default: '{DEFAULT_RESAMPLE_FILTER}').")
+    render_options.add_argument("--compositor", choices=COMPOSITOR_NAMES, default=DEFAULT_COMPOSITOR,
+                                help="Compositing backend: 'pillow' composites one layer at a time, 'numpy' "
+                                     "composites batches of images, e.g. animation frames, as premultiplied "
+                                     "arrays, within 1 level of 'pillow'. Faster only where vectorizing beats "
+                                     "Pillow's per-layer calls, compare with '--stats' "
+                                     f"(Default: '{DEFAULT_COMPOSITOR}').")
+    imageset_options = argparse.ArgumentParser(add_help=False, parents=[render_options])
+    imageset_options.add_argument("--prescale-check", action='store_true',
+                                  help="Report differences between '--prescale' and full size compositing, for "
+                                       "each image, instead of generating images.")
+
+    parser_imageset = subparsers.add_parser("imageset", parents=[imageset_options],
                                             help="Read image data from a directory of images, supports GIF animation "
                                                  "of button sequences.")
     parser_imageset.add_argument("--imageset-file", type=str,
@@ -61,6 +345,18 @@ if __name__ == '__main__':
                                  help="Directory containing images used as layers defined in '--imageset-file'"
                                       " (Default: 'imageset').")
 
+    parser_psd_imageset = subparsers.add_parser("psd-imageset", parents=[imageset_options],
+                                                help="Export a PSD file to an imageset, once per PSD content, then "
+                                                     "read image data from the imageset. Much faster than 'psd', "
+                                                     "and supports GIF animation.")
+    parser_psd_imageset.add_argument("--psd-file", type=str, help="Input filename for the PSD file.", required=True)
+    parser_psd_imageset.add_argument("--imageset-file", type=str, default='psd_imageset.csv',
+                                     help="Output filename for the exported imageset CSV "
+                                          "(Default: 'psd_imageset.csv').")
+    parser_psd_imageset.add_argument("--imageset-dir", type=str, default="psd_imageset",
+                                     help="Output directory for the exported layer images, will be created "
+                                          "(Default: 'psd_imageset').")
+
     parser_psd = subparsers.add_parser("psd",
                                        help="NOT RECOMMENDED: Read image data from PSD file. "
                                             "depends on Adobe(tm) Photoshop tech, slow, "
@@ -68,48 +364,63 @@ if __name__ == '__main__':
                                             "animation not supported.")
     parser_psd.add_argument("--psd-file", type=str, help="Input filename for the PSD file.", required=True)
 
-    args = parser.parse_args()
+    parser_serve = subparsers.add_parser("serve", parents=[render_options],
+                                         help="Serve images rendered on request, from a directory of images as "
+                                              "'imageset', over HTTP at '/<basename>.<png|gif|apng|webp>?h=48', e.g. "
+                                              "for previewing documents, instead of generating every image. Heights "
+                                              "are those of '--image-height'. Reloads the imageset when changed. Ignores "
+                                              "other Markdown options, except '--png-*', '--stats' and "
+                                              "'--watch-interval'.")
+    parser_serve.add_argument("--imageset-file", type=str, default='qunmk2_imageset.csv',
+                              help="Specifies what image filename will be used for what layer, and their xy "
+                                   "coordinates (Default: 'qunmk2_imageset.csv').")
+    parser_serve.add_argument("--imageset-dir", type=str, default="imageset",
+                              help="Directory containing images used as layers defined in '--imageset-file' "
+                                   "(Default: 'imageset').")
+    parser_serve.add_argument("--host", type=str, default=DEFAULT_SERVER_HOST,
+                              help=f"Address to listen on (Default: '{DEFAULT_SERVER_HOST}', this computer only).")
+    parser_serve.add_argument("--port", type=int, default=DEFAULT_SERVER_PORT,
+                              help=f"Port to listen on (Default: {DEFAULT_SERVER_PORT}).")
+    parser_serve.add_argument("--cache-mb", type=int, default=DEFAULT_SERVER_CACHE_MB,
+                              help="Megabytes of encoded images kept in memory, the least recently requested "
+                                   f"evicted first (Default: {DEFAULT_SERVER_CACHE_MB}).")
 
-    # Extract from Markdown
-    button_sequences = []
-    try:
-        button_sequences = extract_button_sequences(args.md_file, args.button_pattern_file)
-        print(f"extracted {len(button_sequences)} sequences")
-    except Exception as e:
-        print(f"Aborting. Error extracting button sequences: {e}", file=sys.stderr)
-        exit(1)
-
-    basenames = [seq.basename for seq in button_sequences]
+    args = parser.parse_args()
 
-    if args.print_extract:
-        for seq in button_sequences:
-            print(f"{seq.sequence_mapping} => {seq.basename}")
+    if args.image_source == "serve":
+        exit(serve(args))
+    if not args.md_file:
+        parser.error("the following arguments are required: --md-file")
 
-    if args.image_source == "psd" and args.psd_file:
-        try:
-            if args.gif:
-                print("Ignoring --gif option, unsupported for PSD", file=sys.stderr)
+    if args.watch:
+        session = WatchSession()
 
-            process_psd(args.image_out_dir, args.psd_file, basenames, args.image_height)
-        except Exception as e:
-            print(f"Aborting. Error processing PSD file: {e}", file=sys.stderr)
-            exit(1)
-    elif args.image_source == "imageset":
-        try:
-            process_imageset(args.image_out_dir, args.imageset_file, args.imageset_dir, button_sequences,
-                             ImageOpt(height=args.image_height, gif=args.gif))
-        except Exception as e:
-            print(f"Aborting. Error processing imageset: {e}", file=sys.stderr)
-            exit(1)
+        def list_paths():
+            md_filenames = expand_markdown_filenames(args.md_file, [args.md_out_dir])
+            filenames = md_filenames + [args.button_pattern_file]
+            dirnames = []
+            if args.image_source == "imageset":
+                filenames.append(args.imageset_file)
+                dirnames.append(args.imageset_dir)
+            elif args.image_source in ("psd", "psd-imageset"):
+                filenames.append(args.psd_file)
+            # Never watch outputs
+            outputs = [os.path.join(os.path.abspath(dirname), "") for dirname in
+                       [args.image_out_dir, args.md_out_dir] if dirname]
+            if args.image_source == "psd-imageset":
+                outputs.append(os.path.join(os.path.abspath(args.imageset_dir), ""))
+            return [path for path in watched_paths(filenames, dirnames)
+                    if not any(path.startswith(output) for output in outputs) and
+                    not (args.md_out_file and path == os.path.abspath(args.md_out_file))]
 
-    if args.md_out_file:
-        try:
-            markdown = write_markdown(args.md_out_file, args.image_out_dir, args.md_file, button_sequences,
-                                      ImageOpt(args.image_height, gif=args.gif))
-        except Exception as e:
-            print(f"Aborting. Error writing markdown: {e}", file=sys.stderr)
-            exit(1)
+        def run(changed_paths):
+            try:
+                main(args, session, changed_paths)
+            except Exception as e:
+                # Keep watching, the next edit may fix it
+                print(f"Error: {e}", file=sys.stderr)
+            session.run_count += 1
 
-    if args.print_formatted:
-        formatted_text = format_markdown(args.md_file)
-        print(formatted_text)
+        watch(list_paths, run, args.watch_interval)
+    else:
+        exit(main(args))
@@ -0,0 +1,227 @@
+import sys
+
+from PIL import Image
+
+from constants import GIF_IMAGE_EXTENSION, APNG_IMAGE_EXTENSION, WEBP_IMAGE_EXTENSION, GIF_PALETTE_SIZE, \
+    GIF_TRANSPARENT_INDEX, GIF_ALPHA_THRESHOLD
+from stats import STATS
+
+DEBUG_LOG_ANIMATION = False
+ENABLE_GLOBAL_PALETTE = True
+PALETTE_INDEXES = 256  # Of any palette image
+
+# Pillow's format for each animated filename extension
+PILLOW_FORMATS = {
+    GIF_IMAGE_EXTENSION: "GIF",
+    APNG_IMAGE_EXTENSION: "PNG",
+    WEBP_IMAGE_EXTENSION: "WEBP",
+}
+
+
+def build_palette(images: [Image]) -> Image:
+    """
+    A palette shared by every frame of every animation, from the images they are composited from.
+    Its last entry is left for transparency, see GIF_TRANSPARENT_INDEX.
+
+    :param images: E.g. the background, and each layer composited over the background beneath it
+    :return: Palette image, for Image.quantize
+    """
+    width = max(image.width for image in images)
+    montage = Image.new("RGB", (width, sum(image.height for image in images)))
+    y = 0
+    for image in images:
+        montage.paste(image.convert("RGB"), (0, y))
+        y += image.height
+
+    colors = montage.quantize(GIF_PALETTE_SIZE - 1, method=Image.Quantize.MEDIANCUT).getpalette()
+    colors = colors[:(GIF_PALETTE_SIZE - 1) * 3]
+
+    palette = Image.new("P", (1, 1))
+    palette.putpalette(colors)
+    if DEBUG_LOG_ANIMATION:
+        print(f"palette of {len(colors) // 3} colors, from {len(images)} images", file=sys.stderr)
+    return palette
+
+
+class AnimationFrames:
+    """
+    Frames of an animation, generated anew each time they're iterated: e.g. composited one at a time, as the encoder
+    takes them, rather than all held in memory.
+
+    Repeated frames are the same image, not copies: a repeat is of the first frame, e.g. the poster, or of one of the
+    two frames before it, e.g. a flash. See map_frames.
+    """
+    generate = None
+    """ Returns an iterator of the frames """
+    count: int = 0
+    last: Image = None
+    """ The last frame, generated once, e.g. for a still image too """
+
+    def __init__(self, generate, count: int, last: Image):
+        self.generate = generate
+        self.count = count
+        self.last = last
+
+    def __iter__(self):
+        return self.generate()
+
+    def __len__(self):
+        return self.count
+
+    def map(self, function) -> "AnimationFrames":
+        """ Frames of the function of each frame, e.g. resized. Repeats, and the last frame, still map once. """
+        last = function(self.last)
+        return AnimationFrames(lambda: map_frames(function, self.generate(), [(self.last, last)]), self.count, last)
+
+
+def map_frames(function, frames, results=()):
+    """
+    Applies a function to each frame, but once to a repeated frame, see AnimationFrames: its results are the same
+    image too.
+
+    :param results: Optional frames already mapped, and their results, e.g. the last frame
+    """
+    known = list(results)
+    first, recent = None, []
+    for frame in frames:
+        result = next((result for source, result in [*known, *(first or []), *recent] if source is frame), None)
+        if result is None:
+            result = function(frame)
+        first = first or [(frame, result)]
+        recent = [*recent[-1:], (frame, result)]
+        yield result
+
+
+def mark_duplicate_frames(frames):
+    """
+    Pairs each frame with whether it's identical to the one before, e.g. a repeated button, flashed by
+    ImageSet.gen_animated_images, composites identically again.
+    """
+    previous, previous_data = None, None
+    for frame in frames:
+        if frame is previous:
+            yield frame, True
+            continue
+
+        data = frame.tobytes()
+        yield frame, data == previous_data
+        previous, previous_data = frame, data
+
+
+def merge_duplicate_frames(frames: [Image], durations: [int]) -> ([Image], [int]):
+    """
+    Drops each frame identical to the one before, showing the one before for both durations.
+    """
+    merged_frames, merged_durations = [], []
+    for (frame, duplicate), duration in zip(mark_duplicate_frames(frames), durations):
+        if duplicate:
+            merged_durations[-1] += duration
+            continue
+
+        merged_frames.append(frame)
+        merged_durations.append(duration)
+
+    STATS.count("frames_merged", len(durations) - len(merged_durations))
+    return merged_frames, merged_durations
+
+
+def count_duplicate_frames(frames):
+    """ Passes on every frame, counting those identical to the one before, which Pillow's GIF encoder merges """
+    duplicates = 0
+    for frame, duplicate in mark_duplicate_frames(frames):
+        duplicates += duplicate
+        yield frame
+    STATS.count("frames_merged", duplicates)
+
+
+def quantize_frames(frames, palette: Image) -> ([Image], [int], int):
+    """
+    Maps every frame to the shared palette, without dithering, so unchanged regions keep identical pixels.
+    Mostly transparent pixels become transparent. The palette is then reduced to the colors used, for a small
+    color table.
+
+    Takes the frames one at a time, e.g. from AnimationFrames, holding only their palette images. A repeated frame
+    is quantized once.
+
+    :return: Palette frames, their palette, and its transparent index. Or None when frames differ in transparency:
+    a frame cannot make visible pixels transparent again without clearing the whole canvas, so Pillow quantizes such
+    frames separately instead.
+    """
+    first_mask = None
+    used_indexes = set()
+
+    def quantize(frame: Image) -> Image:
+        nonlocal first_mask
+        mask = frame.getchannel("A").point(lambda alpha: 255 if alpha < GIF_ALPHA_THRESHOLD else 0)
+        first_mask = first_mask or mask.tobytes()
+        if mask.tobytes() != first_mask:
+            return None
+
+        result = frame.convert("RGB").quantize(palette=palette, dither=Image.Dither.NONE)
+        result.paste(GIF_TRANSPARENT_INDEX, mask=mask)
+        used_indexes.update(index for _, index in result.getcolors(PALETTE_INDEXES))
+        return result
+
+    quantized = []
+    for result in map_frames(quantize, frames):
+        if result is None:
+            return None
+        quantized.append(result)
+
+    # Renumber the colors used, each once, then transparency
+    all_colors = palette.getpalette()
+    lut = list(range(PALETTE_INDEXES))
+    colors = {}
+    for index in sorted(used_indexes - {GIF_TRANSPARENT_INDEX}):
+        lut[index] = colors.setdefault(tuple(all_colors[index * 3:index * 3 + 3]), len(colors))
+    transparent_index = len(colors)
+    lut[GIF_TRANSPARENT_INDEX] = transparent_index
+    # Any color unused by the animation, so that the palette maps each color to exactly one index
+    transparent_color = next((value, 0, 0) for value in range(PALETTE_INDEXES) if (value, 0, 0) not in colors)
+    colors = [value for color in [*colors, transparent_color] for value in color]
+
+    def renumber(result: Image) -> Image:
+        result = result.point(lut)
+        result.putpalette(colors)
+        return result
+
+    # In place, releasing each frame as it's renumbered
+    for index, result in enumerate(map_frames(renumber, quantized)):
+        quantized[index] = result
+    return quantized, colors, transparent_index
+
+
+def save_animation(filename, frames, durations: [int], image_format, palette: Image = None):
+    """
+    Writes an endlessly looping animation of the RGBA frames, in the format of a filename extension.
+
+    Frames identical to the one before are merged. GIF frames share the palette, when given: Pillow then writes
+    a single color table, and each frame as just the rectangle changed from the one before, left in place for the
+    next. APNG and WebP are lossless, and Pillow encodes their changed rectangles likewise.
+
+    GIF frames are taken one at a time, see quantize_frames, and Pillow merges duplicates as it takes them. Pillow
+    takes APNG and WebP frames all at once.
+
+    :param frames: Iterable of the frames, e.g. AnimationFrames. Iterated again when GIF frames differ in
+    transparency.
+    """
+    options = {}
+
+    if image_format == GIF_IMAGE_EXTENSION:
+        quantized = quantize_frames(frames, palette) if palette and ENABLE_GLOBAL_PALETTE else None
+        if quantized:
+            frames, colors, transparent_index = quantized
+            # Frames left in place, so each changed rectangle draws over the one before
+            options = {"palette": bytes(colors), "transparency": transparent_index, "disposal": 1, "optimize": False}
+        STATS.count("gif_global_palette" if quantized else "gif_frame_palettes")
+        frames = count_duplicate_frames(frames)
+        first = next(frames)
+    else:
+        frames, durations = merge_duplicate_frames(list(frames), durations)
+        first, frames = frames[0], frames[1:]
+        if image_format == WEBP_IMAGE_EXTENSION:
+            options = {"lossless": True}
+
+    # Saving sets attributes of the image saved: save a copy, as frames may be shared, e.g. the last with a PNG
+    first.copy().save(filename, save_all=True, append_images=frames, loop=0, duration=durations,
+                      format=PILLOW_FORMATS[image_format], **options)
@@ -0,0 +1,162 @@
+import json
+import math
+import os
+import re
+import sys
+
+from PIL import Image
+
+from constants import ATLAS_BASENAME, ATLAS_INDEX_FILENAME, ATLAS_CSS_FILENAME, ATLAS_VERSION, ATLAS_MAX_SIZE, \
+    PNG_IMAGE_EXTENSION
+from png_encoding import save_png
+from stats import STATS
+from util import PngOpt
+
+DEBUG_LOG_ATLAS = False
+
+# CSS classes: of every image in the atlas, and the prefix of each image's own class
+ATLAS_CSS_CLASS = "mdpicgen-atlas"
+ATLAS_CSS_PREFIX = f"{ATLAS_CSS_CLASS}-"
+
+
+class AtlasImage:
+    sheet: str
+    """ Filename of the sprite sheet, relative to the atlas """
+    x: int
+    y: int
+    width: int
+    height: int
+
+    def __init__(self, sheet, x, y, width, height):
+        self.sheet = sheet
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+    def style(self) -> str:
+        """ Inline CSS showing just this image of an <img> of its sheet """
+        return (f"width:{self.width}px;height:{self.height}px;object-fit:none;"
+                f"object-position:{-self.x}px {-self.y}px")
+
+
+class Atlas:
+    """
+    Images packed into a few sprite sheets, instead of a file each. Indexed by a JSON file of the rectangle of each
+    image, for Markdown links, and by a CSS file of a class for each image, for other pages.
+    """
+    sheets: [str] = []
+    """ Filenames of the sprite sheets, relative to the atlas """
+    images: {str: AtlasImage} = {}
+    """ Keyed by image name, e.g. 's_1', or 's_1@96' """
+
+    def __init__(self, sheets=None, images=None):
+        self.sheets = sheets or []
+        self.images = images or {}
+
+    @staticmethod
+    def pack(sizes: {str: (int, int)}, max_size=ATLAS_MAX_SIZE) -> "Atlas":
+        """
+        Places images in rows, tallest first, in roughly square sheets of at most max_size pixels a side. Starts
+        another sheet when one is full.
+        """
+        if not sizes:
+            return Atlas()
+        widest = max(width for width, _ in sizes.values())
+        row_width = min(max_size, max(widest, math.ceil(math.sqrt(sum(w * h for w, h in sizes.values())))))
+
+        atlas = Atlas()
+        sheet = None
+        x = y = row_height = 0
+        for name, (width, height) in sorted(sizes.items(), key=lambda item: (-item[1][1], -item[1][0], item[0])):
+            if width > max_size or height > max_size:
+                raise ValueError(f"Image {name} of {width}x{height} pixels is larger than an atlas sheet, "
+                                 f"{max_size} pixels a side")
+            if x + width > row_width:
+                x, y, row_height = 0, y + row_height, 0
+            if sheet is None or y + height > max_size:
+                sheet = f"{ATLAS_BASENAME}-{len(atlas.sheets)}.{PNG_IMAGE_EXTENSION}"
+                atlas.sheets.append(sheet)
+                x = y = row_height = 0
+
+            atlas.images[name] = AtlasImage(sheet, x, y, width, height)
+            x += width
+            row_height = max(row_height, height)
+
+        if DEBUG_LOG_ATLAS:
+            print(f"packed {len(sizes)} images into {len(atlas.sheets)} sheets, rows of {row_width} pixels",
+                  file=sys.stderr)
+        return atlas
+
+    def write(self, out_dirname, images: {str: Image}, png: PngOpt):
+        """
+        Writes the sprite sheets of the packed images, then their JSON and CSS indexes. Removes sheets of a
+        previous atlas no longer used.
+        """
+        try:
+            previous_sheets = Atlas.load(out_dirname).sheets
+        except (OSError, ValueError, KeyError):
+            previous_sheets = []
+
+        for sheet in self.sheets:
+            placed = [(image, self.images[name]) for name, image in images.items()
+                      if self.images[name].sheet == sheet]
+            size = (max(rect.x + rect.width for _, rect in placed), max(rect.y + rect.height for _, rect in placed))
+            sheet_image = Image.new("RGBA", size)
+            for image, rect in placed:
+                sheet_image.paste(image, (rect.x, rect.y))
+
+            sheet_filename = os.path.join(out_dirname, sheet)
+            save_png(sheet_image, sheet_filename, png)
+            STATS.record_written(PNG_IMAGE_EXTENSION, sheet_filename)
+
+        index = {
+            "version": ATLAS_VERSION,
+            "sheets": self.sheets,
+            "images": {name: vars(rect) for name, rect in sorted(self.images.items())},
+        }
+        with open(os.path.join(out_dirname, ATLAS_INDEX_FILENAME), "w") as fout:
+            json.dump(index, fout, indent=1)
+        with open(os.path.join(out_dirname, ATLAS_CSS_FILENAME), "w") as fout:
+            fout.write(self.css())
+
+        for sheet in set(previous_sheets) - set(self.sheets):
+            if os.path.exists(os.path.join(out_dirname, sheet)):
+                os.remove(os.path.join(out_dirname, sheet))
+
+    @staticmethod
+    def load(out_dirname) -> "Atlas":
+        with open(os.path.join(out_dirname, ATLAS_INDEX_FILENAME), "r") as fin:
+            index = json.load(fin)
+        if index.get("version") != ATLAS_VERSION:
+            raise ValueError(f"Outdated atlas in {out_dirname}, generate images again")
+
+        return Atlas(index["sheets"], {name: AtlasImage(**rect) for name, rect in index["images"].items()})
+
+    @staticmethod
+    def is_complete(out_dirname) -> bool:
+        """
+        :return: Whether the atlas index of the directory is current, and every sheet it lists exists
+        """
+        try:
+            atlas = Atlas.load(out_dirname)
+        except (OSError, ValueError, KeyError):
+            return False
+        return all(os.path.exists(os.path.join(out_dirname, sheet)) for sheet in atlas.sheets)
+
+    def css(self) -> str:
+        """
+        Example, for <span class="mdpicgen-atlas mdpicgen-atlas-s_1"></span>:
+            .mdpicgen-atlas-s_1 { background-image: url(atlas-0.png); background-position: -72px 0px; width: 72px; ... }
+        """
+        lines = [f".{ATLAS_CSS_CLASS} {{ display: inline-block; background-repeat: no-repeat; }}"]
+        for name, rect in sorted(self.images.items()):
+            lines.append(f".{Atlas.css_class(name)} {{ background-image: url({rect.sheet}); "
+                         f"background-position: {-rect.x}px {-rect.y}px; "
+                         f"width: {rect.width}px; height: {rect.height}px; }}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def css_class(name) -> str:
+        """ E.g. 'mdpicgen-atlas-s_1-96' for 's_1@96' """
+        return ATLAS_CSS_PREFIX + re.sub(r"[^\w-]", "-", name)
@@ -0,0 +1,124 @@
+import concurrent.futures
+import glob
+import os
+import sys
+
+from atlas import Atlas
+from button_sequence import ButtonSequence
+from extract_md import extract_button_sequences
+from markdown_source import MarkdownSource
+from modify_md import write_markdown
+from patset import PatternSet
+from stats import STATS
+from util import ImageOpt
+
+DEBUG_LOG_BATCH = False
+
+MARKDOWN_EXTENSION = ".md"
+GLOB_CHARACTERS = "*?["
+
+
+def expand_markdown_filenames(paths: [str], exclude_dirnames: [str] = ()) -> [str]:
+    """
+    Expands directories, to the Markdown files within them, and glob patterns, to their matches. Drops duplicates.
+
+    :param exclude_dirnames: Directories whose files aren't expanded to, e.g. the output directory of Markdown files
+        generated from files of an input directory
+    :return: Markdown filenames, in the given order, sorted within each directory or pattern
+    """
+    excluded = [os.path.realpath(dirname) for dirname in exclude_dirnames if dirname]
+
+    def included(filename):
+        filename = os.path.realpath(filename)
+        return not any(os.path.commonpath([filename, dirname]) == dirname for dirname in excluded)
+
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            result.extend(filter(included, sorted(glob.glob(os.path.join(path, "**", f"*{MARKDOWN_EXTENSION}"),
+                                                            recursive=True))))
+        elif any(c in path for c in GLOB_CHARACTERS):
+            result.extend(filter(included, sorted(glob.glob(path, recursive=True))))
+        else:
+            result.append(path)
+
+    return list(dict.fromkeys(os.path.normpath(filename) for filename in result))
+
+
+def extract_documents(md_filenames: [str], but_pat_file, jobs=1, stream=False,
+                      sources: {str: MarkdownSource} = None) -> {str: [ButtonSequence]}:
+    """
+    Extracts sequences from each Markdown file, in worker processes when jobs > 1.
+
+    :param sources: Optional contents of the files already read, used when extracting in this process
+    :return: Sequences of each document, in the given order
+    """
+    # Parsed once, and passed to workers as its rules
+    but_pat_file = PatternSet.of(but_pat_file)
+    if jobs and jobs > 1 and len(md_filenames) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(extract_in_worker, md_filename, but_pat_file, stream)
+                       for md_filename in md_filenames]
+
+            result = {}
+            for md_filename, future in zip(md_filenames, futures):
+                result[md_filename], stats = future.result()
+                STATS.merge(stats)
+            return result
+
+    sources = sources or {}
+    return {md_filename: extract_button_sequences(md_filename, but_pat_file, stream=stream,
+                                                  source=sources.get(md_filename))
+            for md_filename in md_filenames}
+
+
+def extract_in_worker(md_filename, but_pat_file, stream) -> ([ButtonSequence], {}):
+    """
+    :return: Sequences, and the worker's stats of extracting them, to merge into the caller's
+    """
+    STATS.reset()
+    return extract_button_sequences(md_filename, but_pat_file, stream=stream), STATS.snapshot()
+
+
+def unique_sequences(sequences_by_document: {str: [ButtonSequence]}) -> [ButtonSequence]:
+    """
+    :return: The first sequence of each basename, across all documents, so that each image is generated once
+    """
+    result = {}
+    for sequences in sequences_by_document.values():
+        for sequence in sequences:
+            result.setdefault(sequence.basename, sequence)
+
+    if DEBUG_LOG_BATCH:
+        total = sum(len(sequences) for sequences in sequences_by_document.values())
+        print(f"batch: {len(result)} unique of {total} sequences, "
+              f"in {len(sequences_by_document)} documents", file=sys.stderr)
+    return list(result.values())
+
+
+def output_filenames(md_filenames: [str], md_out_dir) -> {str: str}:
+    """
+    Places each output document in md_out_dir, at its path relative to the deepest directory containing all inputs.
+    """
+    common_dir = os.path.commonpath([os.path.dirname(os.path.abspath(md_filename)) for md_filename in md_filenames])
+    return {md_filename: os.path.join(md_out_dir, os.path.relpath(os.path.abspath(md_filename), common_dir))
+            for md_filename in md_filenames}
+
+
+def write_documents(md_out_dir, image_out_dir, sequences_by_document: {str: [ButtonSequence]}, opt: ImageOpt,
+                    srcset=False, sources: {str: MarkdownSource} = None, atlas: Atlas = None):
+    """
+    Writes each document with updated image links into md_out_dir. Links are relative to the written document, as
+    all documents share the images in image_out_dir.
+
+    :param sources: Optional contents of the files already read, e.g. by extraction
+    :param atlas: Optional atlas of the images, see write_markdown
+    """
+    sources = sources or {}
+    for md_filename, md_out_filename in output_filenames(list(sequences_by_document), md_out_dir).items():
+        md_out_dirname = os.path.dirname(md_out_filename)
+        os.makedirs(md_out_dirname, exist_ok=True)
+
+        image_out_path = os.path.relpath(image_out_dir, md_out_dirname)
+        write_markdown(md_out_filename, image_out_path, md_filename, sequences_by_document[md_filename], opt, srcset,
+                       sources.get(md_filename), atlas)
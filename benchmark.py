@@ -0,0 +1,328 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from PIL import Image, ImageDraw
+
+from constants import BG_LAYER_NAME, IMAGE_FILE_CSV_HEADER, LAYER_NAME_CSV_HEADER, X_POS_CSV_HEADER, \
+    Y_POS_CSV_HEADER
+from mdpicgen import extract_button_sequences, process_imageset, write_markdown, format_markdown, ImageOpt
+
+BENCHMARK_VERSION = 1
+# Stages faster than this, in the baseline, vary more by noise than by regressions: their times aren't compared
+MIN_COMPARE_SECONDS = 0.1
+STAGE_NAMES = ["extract", "imageset_png", "imageset_gif", "write_markdown", "format_markdown"]
+
+BUTTON_NAME_PREFIX = "KEY"
+LAYER_NAME_PREFIX = "k"
+UNUSED_NAME_PREFIX = "UNUSED"
+
+
+class BenchmarkConfig:
+    """
+    Size of the synthetic corpus: Markdown, pattern file and imageset. The same seed always generates the same files.
+    """
+
+    def __init__(self, tables=10, rows=10, sequence_length=3, buttons=16, patterns=64, canvas_width=512,
+                 canvas_height=320, image_height=48, repeat=5, seed=1):
+        self.tables = tables
+        self.rows = rows
+        self.sequence_length = sequence_length
+        self.buttons = buttons
+        """ Distinct buttons, each with a pattern and an imageset layer """
+        self.patterns = max(patterns, buttons)
+        """ Total patterns in the pattern file, including ones never matched """
+        self.canvas_width = canvas_width
+        self.canvas_height = canvas_height
+        self.image_height = image_height
+        self.repeat = repeat
+        """ Timed runs of each stage, the fastest is reported """
+        self.seed = seed
+
+    def to_dict(self) -> {}:
+        return dict(vars(self))
+
+
+class SyntheticCorpus:
+    """
+    Generates the Markdown, pattern file and imageset of a benchmark into a directory.
+    """
+
+    def __init__(self, config: BenchmarkConfig, dirname):
+        self.config = config
+        self.markdown_filename = os.path.join(dirname, "bench.md")
+        self.pattern_filename = os.path.join(dirname, "bench.patset")
+        self.imageset_filename = os.path.join(dirname, "bench_imageset.csv")
+        self.imageset_dir = os.path.join(dirname, "imageset")
+        self.line_count = 0
+
+        rng = random.Random(config.seed)
+        self.write_patterns()
+        self.write_imageset(rng)
+        self.write_markdown(rng)
+
+    def write_patterns(self):
+        with open(self.pattern_filename, "w") as fout:
+            fout.write("__header__ = Button\n")
+            fout.write('__separator__ = "+"\n')
+            for index in range(self.config.patterns):
+                if index < self.config.buttons:
+                    fout.write(f"^{BUTTON_NAME_PREFIX} {index}$ = {LAYER_NAME_PREFIX}{index}\n")
+                else:
+                    fout.write(f"^{UNUSED_NAME_PREFIX} {index}( \\(Long press\\))?$ = u{index}\n")
+
+    def write_imageset(self, rng: random.Random):
+        config = self.config
+        os.makedirs(self.imageset_dir, exist_ok=True)
+
+        layers = [(BG_LAYER_NAME, "bg.png", 0, 0)]
+        background = Image.new("RGBA", (config.canvas_width, config.canvas_height), (40, 40, 48, 255))
+        ImageDraw.Draw(background).rounded_rectangle(
+            (8, 8, config.canvas_width - 8, config.canvas_height - 8), radius=24, fill=(90, 90, 100, 255))
+        background.save(os.path.join(self.imageset_dir, "bg.png"))
+
+        for index in range(config.buttons):
+            size = rng.randint(config.canvas_height // 10, config.canvas_height // 4)
+            image = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+            ImageDraw.Draw(image).ellipse((0, 0, size - 1, size - 1),
+                                          fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256), 220))
+            image_filename = f"{LAYER_NAME_PREFIX}{index}.png"
+            image.save(os.path.join(self.imageset_dir, image_filename))
+
+            layers.append((f"{LAYER_NAME_PREFIX}{index}", image_filename,
+                           rng.randrange(config.canvas_width - size), rng.randrange(config.canvas_height - size)))
+
+        with open(self.imageset_filename, "w") as fout:
+            fout.write(f"{IMAGE_FILE_CSV_HEADER},{LAYER_NAME_CSV_HEADER},{X_POS_CSV_HEADER},{Y_POS_CSV_HEADER}\n")
+            for layer_name, image_filename, x, y in layers:
+                fout.write(f"{image_filename},{layer_name},{x},{y}\n")
+
+    def write_markdown(self, rng: random.Random):
+        config = self.config
+        lines = ["# Synthetic benchmark\n", "\n"]
+        for table in range(config.tables):
+            lines.extend([f"## Table {table}\n", "\n", "| Button | Description |\n", "|---|---|\n"])
+            for _ in range(config.rows):
+                buttons = [f"{BUTTON_NAME_PREFIX} {rng.randrange(config.buttons)}"
+                           for _ in range(config.sequence_length)]
+                lines.append(f"| {' + '.join(buttons)} <br> | Press them in order |\n")
+            lines.append("\n")
+
+        with open(self.markdown_filename, "w") as fout:
+            fout.writelines(lines)
+        self.line_count = len(lines)
+
+
+def measure(function, repeat) -> (float, float, int, object):
+    """
+    :return: Fastest wall time of repeated calls, their noise: the fraction the median exceeds the fastest by, peak
+    memory allocated by Python during one more call, and the last result. Pillow's image buffers are allocated
+    outside Python, see max_rss_bytes() for those.
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start_time)
+    seconds = min(times)
+    noise = statistics.median(times) / seconds - 1 if seconds else 0.0
+
+    # Separately, as tracing slows everything down
+    tracemalloc.start()
+    try:
+        function()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return seconds, noise, peak_bytes, result
+
+
+def max_rss_bytes() -> int:
+    """
+    :return: Peak resident memory of this process so far, or None where unsupported
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes, except on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def run_benchmark(config: BenchmarkConfig, stages=None) -> {}:
+    """
+    Generates a corpus, then times each stage on it.
+
+    :param stages: Names of stages to run (Default: all, see STAGE_NAMES)
+    :return: JSON-serializable results
+    """
+    stages = stages or STAGE_NAMES
+    results = {}
+
+    with tempfile.TemporaryDirectory() as dirname:
+        corpus = SyntheticCorpus(config, dirname)
+        out_dirname = os.path.join(dirname, "out")
+
+        def record(name, function, items):
+            if name not in stages:
+                return None
+            # Progress and diagnostics of stages are not part of the benchmark output
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                seconds, noise, peak_bytes, result = measure(function, config.repeat)
+            results[name] = {
+                "seconds": seconds,
+                "noise": noise,
+                "peak_bytes": peak_bytes,
+                "items": items,
+                "items_per_second": items / seconds if seconds else None,
+            }
+            return result
+
+        with contextlib.redirect_stderr(io.StringIO()):
+            sequences = extract_button_sequences(corpus.markdown_filename, corpus.pattern_filename)
+        record("extract", lambda: extract_button_sequences(corpus.markdown_filename, corpus.pattern_filename),
+               len(sequences))
+
+        image_count = len({sequence.basename for sequence in sequences})
+        for name, gif in [("imageset_png", False), ("imageset_gif", True)]:
+            # Forced, as the image cache would otherwise skip every run after the first
+            record(name, lambda: process_imageset(out_dirname, corpus.imageset_filename, corpus.imageset_dir,
+                                                  sequences, ImageOpt(config.image_height, gif), force=True),
+                   image_count)
+
+        md_out_filename = os.path.join(dirname, "bench_out.md")
+        record("write_markdown", lambda: write_markdown(md_out_filename, out_dirname, corpus.markdown_filename,
+                                                        sequences, ImageOpt(config.image_height, False)),
+               corpus.line_count)
+        record("format_markdown", lambda: format_markdown(corpus.markdown_filename), corpus.line_count)
+
+    return {
+        "version": BENCHMARK_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config.to_dict(),
+        "stages": results,
+        "max_rss_bytes": max_rss_bytes(),
+    }
+
+
+def compare(results: {}, baseline: {}, max_time_regression, max_memory_regression,
+            min_seconds=MIN_COMPARE_SECONDS) -> [str]:
+    """
+    Compares stages present in both results.
+
+    :param max_time_regression: Allowed fractional increase in time, e.g. 0.25 for 25%, plus the noise of both
+    results' times, see measure
+    :param max_memory_regression: Allowed fractional increase in peak memory
+    :param min_seconds: Compares times only of stages taking at least this long in the baseline
+    :return: Descriptions of each regression beyond the allowed limits
+    """
+    regressions = []
+    if baseline.get("config") != results.get("config"):
+        print("warning: baseline was measured with a different config", file=sys.stderr)
+    if (baseline.get("python"), baseline.get("platform")) != (results.get("python"), results.get("platform")):
+        print("warning: baseline was measured on a different Python or platform, times may differ",
+              file=sys.stderr)
+
+    for name, stage in results["stages"].items():
+        base_stage = baseline.get("stages", {}).get(name)
+        if not base_stage:
+            continue
+
+        time_limit = max_time_regression + base_stage.get("noise", 0.0) + stage.get("noise", 0.0)
+        for key, limit in [("seconds", time_limit), ("peak_bytes", max_memory_regression)]:
+            if key == "seconds" and base_stage[key] < min_seconds:
+                continue
+            if base_stage[key] and stage[key] > base_stage[key] * (1 + limit):
+                regressions.append(f"{name}: {key} {stage[key]:g} exceeds baseline {base_stage[key]:g} "
+                                   f"by more than {limit:.0%}")
+    return regressions
+
+
+def format_results(results: {}, baseline: {} = None) -> str:
+    lines = [f"{'stage':<16} {'seconds':>10} {'items/s':>12} {'peak MiB':>10}" +
+             (f" {'vs baseline':>12}" if baseline else "")]
+    for name, stage in results["stages"].items():
+        line = (f"{name:<16} {stage['seconds']:>10.4f} {stage['items_per_second'] or 0:>12.1f} "
+                f"{stage['peak_bytes'] / (1 << 20):>10.2f}")
+        base_stage = (baseline or {}).get("stages", {}).get(name)
+        if base_stage and base_stage["seconds"]:
+            line += f" {stage['seconds'] / base_stage['seconds']:>11.2f}x"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='''Time each stage of the pipeline on a synthetic Markdown file, pattern file and imageset,
+                    record throughput and peak memory as JSON, and fail on regressions from a baseline.''')
+    parser.add_argument("--out", type=str, help="Output filename for JSON results, usable as a later baseline.")
+    parser.add_argument("--baseline", type=str,
+                        help="JSON results of an earlier run to compare against, measured on the same machine, e.g. "
+                             "'benchmark_baseline.json' of the default corpus (Default: none, no comparison).")
+    parser.add_argument("--max-time-regression", type=float, default=0.25,
+                        help="Fail when a stage is slower than the baseline by more than this fraction, plus "
+                             "the noise of both runs' times, their median's excess over their fastest "
+                             "(Default: 0.25).")
+    parser.add_argument("--max-memory-regression", type=float, default=0.25,
+                        help="Fail when a stage's peak memory exceeds the baseline by more than this fraction "
+                             "(Default: 0.25).")
+    parser.add_argument("--min-seconds", type=float, default=MIN_COMPARE_SECONDS,
+                        help="Compare times only of stages taking at least this many seconds in the baseline, as "
+                             f"shorter ones vary mostly by noise (Default: {MIN_COMPARE_SECONDS}).")
+    parser.add_argument("--stages", type=lambda text: text.split(","), default=STAGE_NAMES,
+                        help=f"Comma-separated stages to run (Default: {','.join(STAGE_NAMES)}).")
+
+    defaults = BenchmarkConfig()
+    parser.add_argument("--tables", type=int, default=defaults.tables, help="Button tables in the Markdown.")
+    parser.add_argument("--rows", type=int, default=defaults.rows, help="Rows in each table.")
+    parser.add_argument("--sequence-length", type=int, default=defaults.sequence_length,
+                        help="Buttons in each row's sequence.")
+    parser.add_argument("--buttons", type=int, default=defaults.buttons,
+                        help="Distinct buttons, each with a pattern and a layer.")
+    parser.add_argument("--patterns", type=int, default=defaults.patterns,
+                        help="Patterns in the pattern file, at least '--buttons'.")
+    parser.add_argument("--canvas", type=lambda text: [int(value) for value in text.split("x")],
+                        default=[defaults.canvas_width, defaults.canvas_height],
+                        help="Imageset canvas size, WIDTHxHEIGHT.")
+    parser.add_argument("--image-height", type=int, default=defaults.image_height, help="Generated image height.")
+    parser.add_argument("--repeat", type=int, default=defaults.repeat, help="Timed runs of each stage.")
+    parser.add_argument("--seed", type=int, default=defaults.seed, help="Random seed of the synthetic corpus.")
+
+    args = parser.parse_args()
+
+    benchmark_config = BenchmarkConfig(args.tables, args.rows, args.sequence_length, args.buttons, args.patterns,
+                                       args.canvas[0], args.canvas[1], args.image_height, args.repeat, args.seed)
+    benchmark_results = run_benchmark(benchmark_config, args.stages)
+
+    baseline_results = None
+    if args.baseline:
+        with open(args.baseline, "r") as fin:
+            baseline_results = json.load(fin)
+
+    print(format_results(benchmark_results, baseline_results))
+
+    if args.out:
+        with open(args.out, "w") as fout:
+            json.dump(benchmark_results, fout, indent=2)
+
+    if baseline_results:
+        found_regressions = compare(benchmark_results, baseline_results, args.max_time_regression,
+                                    args.max_memory_regression, args.min_seconds)
+        for regression in found_regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        if found_regressions:
+            exit(1)
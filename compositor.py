@@ -0,0 +1,222 @@
+import sys
+
+import numpy as np
+from PIL import Image
+
+DEBUG_LOG_COMPOSITOR = False
+NUMPY_BATCH_PIXELS = 1 << 22  # Canvas pixels composited at once, 64 MiB of float RGBA
+
+
+class Compositor:
+    """
+    Composites layers, in order, over the first: the background, which defines the canvas. Composites with Pillow,
+    one layer at a time.
+
+    Layers are ImageLayer objects: an RGBA image, at an x, y offset in the canvas.
+    """
+
+    def composite(self, layers, box=None) -> Image:
+        """
+        :param layers: The background first, then the layers over it
+        :param box: Optional rectangle of the canvas to composite, e.g. a dirty rectangle (Default: all of it)
+        :return: New image, of the box's size
+        """
+        background = layers[0].image
+        if box is None:
+            image = background.copy()
+            box = (0, 0, background.width, background.height)
+        else:
+            image = background.crop(box)
+
+        for layer in layers[1:]:
+            composite_layer_region(image, box, layer)
+        return image
+
+    def prepare(self, layers):
+        """ Converts layers ahead of compositing them, e.g. before compositing from several threads. Pillow
+        composites layers as they are.
+        """
+
+    def composite_batch(self, layer_lists, box=None) -> [Image]:
+        """ Composites several lists of layers, e.g. of animation frames, see composite. """
+        return list(self.iter_composites(layer_lists, box))
+
+    def iter_composites(self, layer_lists, box=None):
+        """ Composites several lists of layers lazily, one at a time, see composite_batch.
+
+        Continues from the previous list's composite while a list only adds layers to it, as animation frames do.
+        """
+        working, previous = None, []
+        for layers in layer_lists:
+            if working is not None and layers[:len(previous)] == previous:
+                for layer in layers[len(previous):]:
+                    composite_layer_region(working, box or (0, 0, *layers[0].image.size), layer)
+            else:
+                working = self.composite(layers, box)
+            yield working.copy()
+            previous = layers
+
+
+class NumpyCompositor(Compositor):
+    """
+    Composites with NumPy, holding each layer image once as a premultiplied float array. Composites a batch of
+    layer lists at once, applying each layer to every list it's in with a single vectorized "over" operation.
+
+    Within 1 level of Compositor, which rounds Pillow's fixed point arithmetic differently. Fully transparent
+    pixels come out black, as premultiplied colors of no alpha are lost.
+    """
+    arrays: {int: (Image, np.ndarray)} = {}
+    """ Premultiplied RGBA of each layer image, keyed by image id, keeping the image alive to keep its id unique """
+
+    def __init__(self):
+        self.arrays = {}
+
+    def prepare(self, layers):
+        for layer in layers:
+            self.premultiplied(layer.image)
+
+    def composite(self, layers, box=None) -> Image:
+        return self.composite_batch([layers], box)[0]
+
+    def composite_batch(self, layer_lists, box=None) -> [Image]:
+        """ Lists of layers sharing a background are composited in batches: arrays of up to NUMPY_BATCH_PIXELS of
+        their canvases.
+        """
+        images = [None] * len(layer_lists)
+        batches = {}
+        for index, layers in enumerate(layer_lists):
+            background = layers[0].image
+            width, height = (box[2] - box[0], box[3] - box[1]) if box else background.size
+            batch = batches.setdefault(id(background), [[]])
+            if len(batch[-1]) * width * height >= NUMPY_BATCH_PIXELS:
+                batch.append([])
+            batch[-1].append(index)
+
+        batches = [indexes for batch in batches.values() for indexes in batch]
+        for indexes in batches:
+            batch_images = self.composite_shared_background([layer_lists[index] for index in indexes], box)
+            for index, image in zip(indexes, batch_images):
+                images[index] = image
+
+        if DEBUG_LOG_COMPOSITOR:
+            print(f"composited {len(layer_lists)} images in {len(batches)} batches", file=sys.stderr)
+        return images
+
+    def iter_composites(self, layer_lists, box=None):
+        """ Composites lazily, a batch of up to NUMPY_BATCH_PIXELS at a time, of lists in order """
+        layer_lists = list(layer_lists)
+        start = 0
+        while start < len(layer_lists):
+            width, height = (box[2] - box[0], box[3] - box[1]) if box else layer_lists[start][0].image.size
+            end = start + max(1, NUMPY_BATCH_PIXELS // (width * height))
+            yield from self.composite_batch(layer_lists[start:end], box)
+            start = end
+
+    def composite_shared_background(self, layer_lists, box=None) -> [Image]:
+        """ Composites as arrays only the rectangle the layers cover, and converts, then pastes over a crop of the
+        background, only the rectangle each list's layers cover.
+        """
+        background = layer_lists[0][0].image
+        box = box or (0, 0, background.width, background.height)
+        list_clips = [union_box([clip_layer(layer, box) for layer in layers[1:]]) for layers in layer_lists]
+        clip = union_box(list_clips)
+        if not clip:
+            return [background.crop(box) for _ in layer_lists]
+
+        left, top, right, bottom = clip
+        canvases = np.repeat(self.premultiplied(background)[top:bottom, left:right][np.newaxis], len(layer_lists),
+                             axis=0)
+
+        # Step through the lists' layers together, applying each distinct layer of a step to all its canvases
+        for step in range(1, max(len(layers) for layers in layer_lists)):
+            canvases_by_layer = {}
+            for index, layers in enumerate(layer_lists):
+                if step < len(layers):
+                    canvases_by_layer.setdefault(id(layers[step]), (layers[step], []))[1].append(index)
+
+            for layer, indexes in canvases_by_layer.values():
+                layer_clip = clip_layer(layer, box)
+                if not layer_clip:
+                    continue
+
+                source = self.premultiplied(layer.image)[layer_clip[1] - layer.y:layer_clip[3] - layer.y,
+                                                         layer_clip[0] - layer.x:layer_clip[2] - layer.x]
+                rows = slice(layer_clip[1] - top, layer_clip[3] - top)
+                columns = slice(layer_clip[0] - left, layer_clip[2] - left)
+                transparency = 1 - source[..., 3:] / 255
+
+                if indexes == list(range(indexes[0], indexes[-1] + 1)):
+                    # Contiguous canvases, e.g. animation frames sharing earlier layers: update them in place
+                    target = canvases[indexes[0]:indexes[-1] + 1, rows, columns]
+                    target *= transparency
+                    target += source
+                else:
+                    canvases[indexes, rows, columns] = source + canvases[indexes, rows, columns] * transparency
+
+        images = []
+        for canvas, list_clip in zip(canvases, list_clips):
+            image = background.crop(box)
+            if list_clip:
+                pixels = NumpyCompositor.unpremultiplied(canvas[list_clip[1] - top:list_clip[3] - top,
+                                                                list_clip[0] - left:list_clip[2] - left])
+                image.paste(Image.fromarray(pixels), (list_clip[0] - box[0], list_clip[1] - box[1]))
+            images.append(image)
+        return images
+
+    def premultiplied(self, image: Image) -> np.ndarray:
+        if id(image) not in self.arrays:
+            array = np.asarray(image.convert("RGBA"), dtype=np.float32)
+            array[..., :3] *= array[..., 3:] / 255
+            self.arrays[id(image)] = (image, array)
+        return self.arrays[id(image)][1]
+
+    @staticmethod
+    def unpremultiplied(array: np.ndarray) -> np.ndarray:
+        """
+        :return: RGBA pixels, of premultiplied RGBA
+        """
+        alpha = array[..., 3:]
+        colors = np.divide(array[..., :3] * 255, alpha, out=np.zeros_like(array[..., :3]), where=alpha > 0)
+        return np.rint(np.concatenate([colors, alpha], axis=-1)).clip(0, 255).astype(np.uint8)
+
+
+def clip_layer(layer, box) -> (int, int, int, int):
+    """
+    :return: The part of a layer's rectangle within a rectangle of the canvas, or None if they don't overlap
+    """
+    left, top = max(layer.x, box[0]), max(layer.y, box[1])
+    right = min(layer.x + layer.image.width, box[2])
+    bottom = min(layer.y + layer.image.height, box[3])
+    if left < right and top < bottom:
+        return left, top, right, bottom
+    return None
+
+
+def union_box(boxes) -> (int, int, int, int):
+    """
+    :return: The rectangle bounding all the rectangles, ignoring None, or None if there are none
+    """
+    boxes = [box for box in boxes if box]
+    if not boxes:
+        return None
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+
+def composite_layer_region(image: Image, box, layer):
+    """ Composites the part of a layer within a rectangle of the canvas, in place.
+
+    :param image: The rectangle's composite so far
+    :param box: The rectangle, in the canvas
+    """
+    clip = clip_layer(layer, box)
+    if clip:
+        left, top, right, bottom = clip
+        image.alpha_composite(layer.image, (left - box[0], top - box[1]),
+                              (left - layer.x, top - layer.y, right - layer.x, bottom - layer.y))
+
+
+COMPOSITORS = {
+    "pillow": Compositor,
+    "numpy": NumpyCompositor,
+}
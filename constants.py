@@ -9,9 +9,15 @@ BG_LAYER_NAME: str = "BG"
 
 PNG_IMAGE_EXTENSION = "png"
 GIF_IMAGE_EXTENSION = "gif"
+APNG_IMAGE_EXTENSION = "apng"
+WEBP_IMAGE_EXTENSION = "webp"
+# Formats of animated images, as filename extensions, see animation.py
+ANIMATION_FORMATS = [GIF_IMAGE_EXTENSION, APNG_IMAGE_EXTENSION, WEBP_IMAGE_EXTENSION]
 
 # For generating image filenames, the separator between alphanumeric chars, e.g. "s_mplay_123"
 SHORT_NAME_INFIX_SEPARATOR = "_"
+# For generating image filenames of additional heights, e.g. "s_mplay_123@96"
+VARIANT_HEIGHT_SEPARATOR = "@"
 
 THREADS_PER_CPU = 0.8
 
@@ -32,3 +38,47 @@ IMAGE_FILE_CSV_HEADER = 'image_file'
 GIF_BEGIN_FRAME_DURATION_MS = 1000
 GIF_MID_FRAME_DURATION_MS = 400
 GIF_END_FRAME_DURATION_MS = 2000
+
+# For encoding animations, see animation.py
+ANIMATION_VERSION = 1  # Bump when encoding changes, to invalidate previously generated animations
+# Colors shared by all GIF frames, including transparency. Smaller, and closer, than Pillow's palette per frame, for
+# the Qun imageset: of 256, 128 and 64 colors, 64 encoded smallest with less error
+GIF_PALETTE_SIZE = 64
+GIF_TRANSPARENT_INDEX = GIF_PALETTE_SIZE - 1
+GIF_ALPHA_THRESHOLD = 128  # Pixels less opaque are transparent in GIF
+
+# For encoding PNG images, see png_encoding.py
+DEFAULT_PNG_COMPRESS_LEVEL = 6  # Pillow's
+
+# For packing images into sprite sheets, see atlas.py
+ATLAS_BASENAME = "atlas"
+ATLAS_INDEX_FILENAME = f"{ATLAS_BASENAME}.json"
+ATLAS_CSS_FILENAME = f"{ATLAS_BASENAME}.css"
+ATLAS_MAX_SIZE = 4096  # Pixels a side of a sprite sheet, within every browser's limits
+ATLAS_VERSION = 1  # Bump when packing changes, to invalidate previously packed atlases
+
+# For skipping unchanged images, see image_cache.py
+IMAGE_CACHE_MANIFEST_FILENAME = ".mdpicgen_manifest.json"
+IMAGE_CACHE_VERSION = 1  # Bump when rendering changes, to invalidate previously generated images
+DIGEST_CHUNK_SIZE = 1 << 20
+
+# For skipping re-extraction of unchanged Markdown, see extract_index.py
+EXTRACT_INDEX_VERSION = 1  # Bump when extraction changes, to invalidate previously indexed results
+
+# For exporting a PSD to an imageset, see psd_gen.py
+PSD_EXPORT_VERSION = 1  # Bump when exporting changes, to invalidate previously exported imagesets
+PSD_EXPORT_CSV_HEADERS = [IMAGE_FILE_CSV_HEADER, LAYER_NAME_CSV_HEADER, X_POS_CSV_HEADER, Y_POS_CSV_HEADER, 'width',
+                          'height']
+
+# Resampling filters for resizing images, named as in PIL.Image.Resampling
+RESAMPLE_FILTER_NAMES = ["nearest", "box", "bilinear", "hamming", "bicubic", "lanczos"]
+DEFAULT_RESAMPLE_FILTER = "bicubic"
+
+# Compositing backends, see compositor.COMPOSITORS
+COMPOSITOR_NAMES = ["pillow", "numpy"]
+DEFAULT_COMPOSITOR = "pillow"
+
+# Serving images rendered on request
+DEFAULT_SERVER_HOST = "127.0.0.1"
+DEFAULT_SERVER_PORT = 8000
+DEFAULT_SERVER_CACHE_MB = 64
@@ -0,0 +1,137 @@
+import json
+import os
+import sys
+
+from button_sequence import ButtonSequence
+from constants import EXTRACT_INDEX_VERSION
+
+DEBUG_LOG_INDEX = False
+
+INDEX_VERSION_KEY = "version"
+INDEX_DOCUMENT_KEY = "document"
+INDEX_PATTERNS_KEY = "patterns"
+INDEX_SEQUENCES_KEY = "sequences"
+INDEX_REJECTS_KEY = "rejects"
+INDEX_TABLES_KEY = "tables"
+
+
+class ExtractionIndex:
+    """
+    On-disk index of extraction results, reused while the Markdown and pattern file are unchanged.
+
+    Keyed by content digests. The whole document is reused when both the Markdown and the pattern file are unchanged.
+    Otherwise, each button table is reused when its own text, and the pattern file, are unchanged. Line numbers are
+    stored relative to their table, so that edits elsewhere in the document only shift them.
+    """
+    index_filename: str
+    document_digest: str = None
+    patterns_digest: str = None
+    sequences: [[]] = []
+    """ [ [sequence_mapping, line_number], ...] -- for the whole document """
+    rejects: [str] = []
+    tables: {str: {}} = {}
+    """ Table digest to sequences, with table-relative line numbers, and rejects """
+    used_tables: {str: {}} = {}
+
+    table_hits: int = 0
+    table_misses: int = 0
+
+    def __init__(self, index_filename=None, force=False):
+        """
+        :param index_filename: Index file to read and write. Without one, the index is kept in memory only.
+        """
+        self.index_filename = index_filename
+        self.sequences = []
+        self.rejects = []
+        self.tables = {}
+        self.used_tables = {}
+        self.table_hits = 0
+        self.table_misses = 0
+
+        if index_filename and not force:
+            self.load()
+
+    def load(self):
+        """ Reads the index. Missing, unreadable or outdated indexes are treated as empty.
+        """
+        try:
+            with open(self.index_filename, "r") as fin:
+                index = json.load(fin)
+        except (OSError, ValueError):
+            return
+
+        if not isinstance(index, dict) or index.get(INDEX_VERSION_KEY) != EXTRACT_INDEX_VERSION:
+            return
+
+        self.document_digest = index.get(INDEX_DOCUMENT_KEY)
+        self.patterns_digest = index.get(INDEX_PATTERNS_KEY)
+        self.sequences = index.get(INDEX_SEQUENCES_KEY, [])
+        self.rejects = index.get(INDEX_REJECTS_KEY, [])
+        self.tables = index.get(INDEX_TABLES_KEY, {})
+
+    def lookup_document(self, document_digest, patterns_digest) -> ([ButtonSequence], [str]):
+        """
+        :return: Sequences and rejects of the whole document, or None when either input changed
+        """
+        if (self.document_digest, self.patterns_digest) != (document_digest, patterns_digest):
+            return None
+
+        sequences = [ButtonSequence(mapping, line_number) for mapping, line_number in self.sequences]
+        return sequences, list(self.rejects)
+
+    def record_document(self, document_digest, patterns_digest, sequences: [ButtonSequence], rejects: [str]):
+        """ Replaces the index contents with the results of a full extraction. Drops tables no longer present.
+        """
+        self.document_digest = document_digest
+        self.patterns_digest = patterns_digest
+        self.sequences = [[seq.sequence_mapping, seq.line_number] for seq in sequences]
+        self.rejects = list(rejects)
+        self.tables = self.used_tables
+        self.used_tables = {}
+
+    def lookup_table(self, table_digest, line_number) -> ([ButtonSequence], [str]):
+        """
+        :param table_digest: Identifies the table text and the pattern file
+        :param line_number: Where the table now starts in the document
+        :return: Sequences, re-based to the table's current location, and rejects. Or None when unknown.
+        """
+        entry = self.tables.get(table_digest)
+        if entry is None:
+            self.table_misses += 1
+            return None
+
+        self.table_hits += 1
+        self.used_tables[table_digest] = entry
+
+        sequences = [ButtonSequence(mapping, line_number + offset) for mapping, offset in entry[INDEX_SEQUENCES_KEY]]
+        return sequences, list(entry[INDEX_REJECTS_KEY])
+
+    def record_table(self, table_digest, line_number, sequences: [ButtonSequence], rejects: [str]):
+        self.used_tables[table_digest] = {
+            INDEX_SEQUENCES_KEY: [[seq.sequence_mapping, seq.line_number - line_number] for seq in sequences],
+            INDEX_REJECTS_KEY: list(rejects),
+        }
+
+    def save(self):
+        """ Writes the index, atomically, so an interrupted run never leaves a corrupt index behind.
+        """
+        index = {
+            INDEX_VERSION_KEY: EXTRACT_INDEX_VERSION,
+            INDEX_DOCUMENT_KEY: self.document_digest,
+            INDEX_PATTERNS_KEY: self.patterns_digest,
+            INDEX_SEQUENCES_KEY: self.sequences,
+            INDEX_REJECTS_KEY: self.rejects,
+            INDEX_TABLES_KEY: self.tables,
+        }
+
+        if self.index_filename:
+            temp_filename = f"{self.index_filename}.tmp"
+            with open(temp_filename, "w") as fout:
+                json.dump(index, fout)
+            os.replace(temp_filename, self.index_filename)
+
+        if DEBUG_LOG_INDEX:
+            print(f"extraction index: {self.table_hits} tables reused, {self.table_misses} extracted",
+                  file=sys.stderr)
+        self.table_hits = 0
+        self.table_misses = 0
@@ -1,35 +1,85 @@
+import functools
 import re
 import sys
 from collections import Counter
 
 from mistletoe.block_token import Table, TableRow, Document, TableCell
-from mistletoe.markdown_renderer import MarkdownRenderer
 from mistletoe.span_token import RawText, HtmlSpan
 
 from button_sequence import ButtonSequence
 from constants import HTML_BREAK_PATTERN, DIGITS_MACRO_NAME
-from util import extract_digit_ranges, strip_whitespace, find_first_non_null_index
-from patset import patterns_to_header, patterns_to_separators, patterns_map_to_button_name
+from extract_index import ExtractionIndex
+from markdown_source import MarkdownSource
+from stats import STATS
+from util import extract_digit_ranges, find_first_non_null_index, digest_file, digest_values
+from patset import PatternSet
 
 # For debugging parsing
 DEBUG_LOG_EXTRACT = True
 
 EXTRACT_CAPTURE_GROUP_INDEX = 1
 
+# Distinct element texts remembered by ButtonMatcher, bounding its memory
+MATCH_CACHE_SIZE = 4096
+MATCHER_GROUP_PREFIX = "_mdpicgen_pattern_"
+# Numbered backreferences, e.g. '\1', would refer to the wrong groups once patterns are combined
+NUMBERED_BACKREFERENCE_PATTERN = re.compile(r"\\[1-9]")
 
-def extract_button_sequences(md_file, but_pat_file) -> ["ButtonSequence"]:
+
+def extract_button_sequences(md_file, but_pat_file, index_filename=None, force=False, stream=False,
+                             index: ExtractionIndex = None, source: MarkdownSource = None) -> ["ButtonSequence"]:
     """
     Extract button command sequences from Markdown following a set of patterns.
 
     :param md_file: Markdown file formatted with well-known button sequences in special tables
-    :param but_pat_file: Text file mapping regular expressions to buttons, and defining separator patterns
+    :param but_pat_file: Text file mapping regular expressions to buttons, and defining separator patterns. Or a
+    PatternSet already loaded
+    :param index_filename: Optional extraction index file, reusing results while inputs are unchanged
+    :param force: Ignore the extraction index contents, re-extracting everything
+    :param stream: Read the Markdown line by line, in bounded memory, rather than parsing it whole. Ignores the index
+    :param index: Optional extraction index already loaded, e.g. kept in memory between runs, instead of index_filename
+    :param source: Optional contents of md_file already read, shared with later stages, instead of reading md_file
     :return: List of dictionaries mapping recognized button names, as written in the input Markdown, to short names
     which are used as compound layer names in basenames of generated image files illustrating the button sequence
     """
-    extractor = ExtractButtonsFromMarkdown(md_file, but_pat_file)
+    extractor = None
+    with STATS.stage("extract", md_file):
+        if stream:
+            # Deferred import, as the streaming extractor extends ExtractButtonsFromMarkdown
+            from stream_extract_md import StreamButtonsFromMarkdown
+            extractor = StreamButtonsFromMarkdown(but_pat_file)
+            button_sequences = list(extractor.stream(md_file))
+            could_not_find = extractor.could_not_find
+        elif not index_filename and index is None:
+            extractor = ExtractButtonsFromMarkdown(md_file, but_pat_file, source=source)
+            button_sequences, could_not_find = extractor.button_sequences, extractor.could_not_find
+        else:
+            if index is None:
+                index = ExtractionIndex(index_filename, force)
+            document_digest = source.digest if source else digest_file(md_file)
+            patterns = PatternSet.of(but_pat_file)
+            patterns_digest = patterns.digest
+
+            reused = index.lookup_document(document_digest, patterns_digest)
+            if reused:
+                button_sequences, could_not_find = reused
+            else:
+                extractor = ExtractButtonsFromMarkdown(md_file, patterns, index, source=source)
+                button_sequences, could_not_find = extractor.button_sequences, extractor.could_not_find
+
+                index.record_document(document_digest, patterns_digest, button_sequences, could_not_find)
+                index.save()
+
+    STATS.count("sequences_extracted", len(button_sequences))
+    STATS.count("sequences_rejected", len(could_not_find))
+    if extractor:
+        cache_info = extractor.matcher.lookup.cache_info()
+        STATS.count("match_cache_hits", cache_info.hits)
+        STATS.count("match_cache_misses", cache_info.misses)
+
     if DEBUG_LOG_EXTRACT:
-        print(f"rejected: {len(extractor.could_not_find)}", file=sys.stderr)
-    return extractor.button_sequences
+        print(f"rejected: {len(could_not_find)}", file=sys.stderr)
+    return button_sequences
 
 
 class ExtractButtonsFromMarkdown:
@@ -43,23 +93,39 @@ class ExtractButtonsFromMarkdown:
     """ Extracted sequences, also contains line numbers """
     could_not_find = []
     """ Sequences not matched by the patterns """
+    patterns: PatternSet = None
 
     # Options
     require_br_tag = True  # "SHIFT + SEQ PLAY + turn dial <br> ..." -- default constraint
 
-    def __init__(self, markdown_filename, button_pattern_file):
-        self.button_patterns = patterns_map_to_button_name(button_pattern_file)
-        self.separators = patterns_to_separators(button_pattern_file)
-        self.header = patterns_to_header(button_pattern_file)
-
-        with open(markdown_filename, "r") as fin:
-            with MarkdownRenderer(normalize_whitespace=True) as _:
-                document = Document(fin)
-
-                # Extract buttons, following constraints and patterns, and store results
-                result = self.extract_document(document)
-                self.button_sequences = result
-                self.buttons = ButtonSequence.to_sequence_mapping_list(self.button_sequences)
+    def __init__(self, markdown_filename, button_pattern_file, index: ExtractionIndex = None, patterns_digest=None,
+                 source: MarkdownSource = None):
+        """
+        :param button_pattern_file: Pattern file, or a PatternSet already loaded
+        :param index: Optional extraction index, reusing the results of unchanged tables
+        :param patterns_digest: Content digest of the button_pattern_file (Default: the PatternSet's)
+        :param source: Optional contents of markdown_filename already read, and perhaps parsed
+        """
+        self.load_patterns(button_pattern_file)
+        self.index = index
+        self.patterns_digest = patterns_digest or self.patterns.digest
+
+        source = source or MarkdownSource(markdown_filename)
+        self.lines = source.lines
+
+        # Extract buttons, following constraints and patterns, and store results
+        result = self.extract_document(source.document())
+        self.button_sequences = result
+        self.buttons = ButtonSequence.to_sequence_mapping_list(self.button_sequences)
+
+    def load_patterns(self, button_pattern_file):
+        self.patterns = PatternSet.of(button_pattern_file)
+        self.button_patterns = self.patterns.button_patterns
+        self.separators = self.patterns.separators
+        self.header = self.patterns.header
+        self.matcher = ButtonMatcher(self.button_patterns)
+        self.could_not_find = []
+        self.index = None
 
     def extract_document(self, doc: Document) -> [ButtonSequence]:
         """
@@ -79,11 +145,34 @@ class ExtractButtonsFromMarkdown:
         result = []
 
         if ExtractButtonsFromMarkdown.is_button_table(table, self.header.lower()):
+            if self.index:
+                return self.extract_indexed_table(table)
+
             extracted = [self.extract_tablerow(child) for child in table.children]
             result = [e for e in extracted if e]
 
         return result
 
+    def extract_indexed_table(self, table: Table) -> [ButtonSequence]:
+        """ Reuses the indexed results for an unchanged table, otherwise extracts and indexes the table.
+        """
+        # Header, delimiter row, then a line per row
+        table_lines = self.lines[table.line_number - 1:table.line_number + 1 + len(table.children)]
+        table_digest = digest_values(self.patterns_digest, table_lines)
+
+        reused = self.index.lookup_table(table_digest, table.line_number)
+        if reused:
+            result, rejects = reused
+            self.could_not_find.extend(rejects)
+            return result
+
+        rejects_start = len(self.could_not_find)
+        extracted = [self.extract_tablerow(child) for child in table.children]
+        result = [e for e in extracted if e]
+
+        self.index.record_table(table_digest, table.line_number, result, self.could_not_find[rejects_start:])
+        return result
+
     @staticmethod
     def is_button_table(table, header) -> bool:
         label = table.header.children[0].children[0]
@@ -160,11 +249,9 @@ class ExtractButtonsFromMarkdown:
             return = [{'SHIFT': 's'}, {'SEQ PLAY': 'splay'}, {'turn dial': 'd'}]
         """
 
-        candidate_sequence = self.separate_rawtext(text, self.separators)
-        validating_patterns = self.button_patterns.keys()
-        valid_names = list(self.button_patterns.values())
+        candidate_sequence = self.patterns.split(text)
 
-        poison, valid_sequence = self.filter_sequence(candidate_sequence, valid_names, validating_patterns)
+        poison, valid_sequence = self.filter_sequence(candidate_sequence, self.matcher)
 
         if not poison:
             result = valid_sequence
@@ -177,11 +264,11 @@ class ExtractButtonsFromMarkdown:
         return result
 
     @staticmethod
-    def filter_sequence(candidate_sequence, valid_names, validating_patterns) -> (str, [str]):
+    def filter_sequence(candidate_sequence, matcher: "ButtonMatcher") -> (str, [str]):
         valid_sequence = []
         poison = None
         for element in candidate_sequence:
-            valid_element = ExtractButtonsFromMarkdown.match_element(element, valid_names, validating_patterns)
+            valid_element = matcher.match(element)
 
             if valid_element:
                 valid_sequence.append(valid_element)
@@ -191,7 +278,11 @@ class ExtractButtonsFromMarkdown:
         return poison, valid_sequence
 
     @staticmethod
-    def match_element(element, valid_names, validating_patterns) -> {str: str}:
+    def search_element(element, valid_names, validating_patterns) -> (int, str):
+        """ Searches the element with each pattern in turn.
+
+        Returns: Count of matching patterns, and the macro-expanded short name when exactly one pattern matches
+        """
         # constrain overall result to element's presence in recognized patterns
         match_results = list(map(lambda p: p.search(element), validating_patterns))
 
@@ -199,19 +290,25 @@ class ExtractButtonsFromMarkdown:
         # Count matches (non-None) to ensure this is a valid button.
         match_count = len(match_results) - Counter(match_results)[None]
 
+        short_name = None
+        if match_count == 1:
+            match_index = find_first_non_null_index(match_results)
+
+            pattern_match = match_results[match_index]
+            element_group = ExtractButtonsFromMarkdown.get_capture_group(element, pattern_match)
+
+            short_name = ExtractButtonsFromMarkdown.macro_expand_short_name(element_group, valid_names[match_index])
+
+        return match_count, short_name
+
+    @staticmethod
+    def format_match(element, match_count, short_name) -> {str: str}:
         result = {}
         match match_count:
             case 0:
                 pass
             case 1:
-                match_index = find_first_non_null_index(match_results)
-
-                pattern_match = match_results[match_index]
-                element_group = ExtractButtonsFromMarkdown.get_capture_group(element, pattern_match)
-
-                short_name = valid_names[match_index]
-                macro_expanded = ExtractButtonsFromMarkdown.macro_expand_short_name(element_group, short_name)
-                result = {element: macro_expanded}
+                result = {element: short_name}
             case _:
                 print(f"error: unexpected multiple matches ({match_count}) for element \"{element}\", "
                       f"check the pattern file",
@@ -228,21 +325,6 @@ class ExtractButtonsFromMarkdown:
         """
         return pattern_match.group(EXTRACT_CAPTURE_GROUP_INDEX) if pattern_match.lastindex else element
 
-    @staticmethod
-    def separate_rawtext(text, separators):
-        """Split the text to a sequence, stripping padding."""
-        sequence = [text]
-
-        for separator in separators:
-            separates = []
-            for element in sequence:
-                element = element.split(separator)
-                separates = separates + element
-            sequence = separates
-
-        sequence = strip_whitespace(sequence)
-        return sequence
-
     @staticmethod
     def macro_expand_short_name(element, short_name) -> str:
         """Replace recognized macros found in short_name with the results from their execution.
@@ -255,4 +337,74 @@ class ExtractButtonsFromMarkdown:
 
         result = temp
         return result
-    
\ No newline at end of file
+    
+
+class ButtonMatcher:
+    """
+    Matches an element of a button sequence against all button patterns in one regular expression evaluation, and
+    remembers the results per element text: manuals repeat the same few buttons, e.g. "SHIFT", thousands of times.
+
+    Each pattern is a named group inside an optional lookahead, so a single match finds every pattern which would
+    match anywhere in the element, exactly as searching with each pattern. Unlike a plain alternation, which stops at
+    the first matching alternative, this keeps the check that exactly one pattern matches.
+
+    Falls back to searching with each pattern when patterns can't be combined, e.g. with numbered backreferences.
+    """
+
+    def __init__(self, button_patterns: {re.Pattern: str}, cache_size=MATCH_CACHE_SIZE):
+        self.patterns = list(button_patterns.keys())
+        self.short_names = list(button_patterns.values())
+        self.combined, self.group_indexes = ButtonMatcher.combine_patterns(self.patterns)
+        self.lookup = functools.lru_cache(maxsize=cache_size)(self.search)
+
+    @staticmethod
+    def combine_patterns(patterns: [re.Pattern]) -> (re.Pattern, [int]):
+        """
+        Returns: Combined pattern and the index of the group wrapping each pattern, or (None, []) if not combinable
+        """
+        if any(NUMBERED_BACKREFERENCE_PATTERN.search(pattern.pattern) for pattern in patterns):
+            return None, []
+
+        alternatives = [fr"(?:(?=[\s\S]*?(?P<{MATCHER_GROUP_PREFIX}{index}>{pattern.pattern}))|)"
+                        for index, pattern in enumerate(patterns)]
+        try:
+            combined = re.compile("".join(alternatives), re.IGNORECASE)
+        except re.error as e:
+            if DEBUG_LOG_EXTRACT:
+                print(f"can't combine patterns, matching each in turn: {e}", file=sys.stderr)
+            return None, []
+
+        group_indexes = [combined.groupindex[f"{MATCHER_GROUP_PREFIX}{index}"] for index in range(len(patterns))]
+        return combined, group_indexes
+
+    def search(self, element) -> (int, str):
+        """
+        Returns: Count of matching patterns, and the macro-expanded short name when exactly one pattern matches
+        """
+        if not self.combined:
+            STATS.count("regex_evaluations", len(self.patterns))
+            return ExtractButtonsFromMarkdown.search_element(element, self.short_names, self.patterns)
+
+        STATS.count("regex_evaluations")
+        pattern_match = self.combined.match(element)
+        matched = [(index, group_index) for index, group_index in enumerate(self.group_indexes)
+                   if pattern_match.start(group_index) != -1]
+
+        if len(matched) != 1:
+            return len(matched), None
+
+        match_index, group_index = matched[0]
+
+        # As ExtractButtonsFromMarkdown.get_capture_group, with the pattern's own groups following its wrapping group
+        own_groups = range(group_index + 1, group_index + 1 + self.patterns[match_index].groups)
+        if any(pattern_match.start(own_group) != -1 for own_group in own_groups):
+            element_group = pattern_match.group(group_index + EXTRACT_CAPTURE_GROUP_INDEX)
+        else:
+            element_group = element
+
+        short_name = ExtractButtonsFromMarkdown.macro_expand_short_name(element_group, self.short_names[match_index])
+        return 1, short_name
+
+    def match(self, element) -> {str: str}:
+        match_count, short_name = self.lookup(element)
+        return ExtractButtonsFromMarkdown.format_match(element, match_count, short_name)
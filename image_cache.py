@@ -0,0 +1,81 @@
+import json
+import os
+import sys
+
+from constants import IMAGE_CACHE_MANIFEST_FILENAME, IMAGE_CACHE_VERSION
+
+DEBUG_LOG_CACHE = False
+
+MANIFEST_VERSION_KEY = "version"
+MANIFEST_ENTRIES_KEY = "images"
+
+
+class ImageCache:
+    """
+    Persistent manifest of generated images, stored in the output directory.
+
+    Maps each image filename to a key, a digest of every input which rendered it. An image is "fresh", and may be
+    skipped, when its recorded key is unchanged and the file still exists.
+    """
+    manifest_filename: str
+    force: bool
+    entries: {str: str}
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(self, out_dirname, force=False):
+        self.manifest_filename = os.path.join(out_dirname, IMAGE_CACHE_MANIFEST_FILENAME)
+        self.force = force
+        self.entries = self.load()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self) -> {str: str}:
+        """ Reads the manifest. Missing, unreadable or outdated manifests are treated as empty.
+        """
+        try:
+            with open(self.manifest_filename, "r") as fin:
+                manifest = json.load(fin)
+        except (OSError, ValueError):
+            return {}
+
+        if not isinstance(manifest, dict) or manifest.get(MANIFEST_VERSION_KEY) != IMAGE_CACHE_VERSION:
+            if DEBUG_LOG_CACHE:
+                print(f"ignoring outdated manifest: {self.manifest_filename}", file=sys.stderr)
+            return {}
+
+        return manifest.get(MANIFEST_ENTRIES_KEY, {})
+
+    def is_fresh(self, image_filename, key) -> bool:
+        """ Checks, and counts, whether the image was already generated from identical inputs.
+        """
+        name = os.path.basename(image_filename)
+        fresh = (not self.force and
+                 self.entries.get(name) == key and
+                 os.path.exists(image_filename))
+
+        if fresh:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        if DEBUG_LOG_CACHE:
+            print(f"cache {'hit' if fresh else 'miss'}: {name} {key}", file=sys.stderr)
+
+        return fresh
+
+    def record(self, image_filename, key):
+        self.entries[os.path.basename(image_filename)] = key
+
+    def save(self):
+        """ Writes the manifest, atomically, so an interrupted run never leaves a corrupt manifest behind.
+        """
+        manifest = {MANIFEST_VERSION_KEY: IMAGE_CACHE_VERSION, MANIFEST_ENTRIES_KEY: self.entries}
+
+        temp_filename = f"{self.manifest_filename}.tmp"
+        with open(temp_filename, "w") as fout:
+            json.dump(manifest, fout, indent=1, sort_keys=True)
+        os.replace(temp_filename, self.manifest_filename)
+
+    def report(self) -> str:
+        return f"cache: {self.hits} unchanged, {self.misses} rendered"
@@ -1,17 +1,35 @@
+import concurrent.futures
+import contextlib
 import csv
+import functools
+import math
+import os
 import sys
+import time
 
-from PIL import Image
+from PIL import Image, ImageChops, ImageStat
 
 from constants import BG_LAYER_NAME, SHORT_NAME_INFIX_SEPARATOR, Y_POS_CSV_HEADER, X_POS_CSV_HEADER, \
     LAYER_NAME_CSV_HEADER, IMAGE_FILE_CSV_HEADER, GIF_END_FRAME_DURATION_MS, GIF_MID_FRAME_DURATION_MS, \
-    GIF_BEGIN_FRAME_DURATION_MS
-from util import make_out_dir, size_from_height, ImageOpt
+    GIF_BEGIN_FRAME_DURATION_MS, ANIMATION_VERSION, ATLAS_INDEX_FILENAME, ATLAS_MAX_SIZE, ATLAS_VERSION, \
+    DEFAULT_COMPOSITOR
+from atlas import Atlas
+from animation import AnimationFrames, build_palette, save_animation
+from compositor import Compositor, COMPOSITORS
+from png_encoding import save_png
+from util import make_out_dir, size_from_height, ImageOpt, digest_values
 from button_sequence import ButtonSequence
+from image_cache import ImageCache
+from layer_store import LayerStore
+from pipeline import WritePipeline, ENABLE_WRITE_PIPELINE
+from stats import STATS
 
 DEBUG_LOG_IMAGESET = False
 ENABLE_RESIZE = True
-USE_THREADING_EXPERIMENTAL = False  # Causes truncated image rendering, buggy
+ENABLE_TRIM_LAYERS = True
+ENABLE_DIRTY_RECTS = True
+RESAMPLE_MAX_SUPPORT = 3  # Output pixels, of the widest filter: lanczos
+RENDER_BATCH_SEQUENCES = 32  # Sequences whose still images are composited together, see render_variants_batch
 
 
 class ImageLayer:
@@ -19,12 +37,15 @@ class ImageLayer:
     layer_name: str
     x: int
     y: int
+    source: [[str, str]]
+    """ Identifies the layer's inputs, for caching: its CSV row, and the content digest of its image file """
 
-    def __init__(self, image: Image, layer_name: str, x: int, y: int):
+    def __init__(self, image: Image, layer_name: str, x: int, y: int, source=None):
         self.image = image
         self.layer_name = layer_name
         self.x = x
         self.y = y
+        self.source = source or []
 
     def __repr__(self) -> str:
         return "<%s.%s layer_name=%s x=%d y=%d image=%s at 0x%X>" % (
@@ -40,73 +61,550 @@ class ImageLayer:
 
 class ImageSet:
     all_layers: {str: ImageLayer} = {}
-
-    def process_imageset(self, out_dirname, imageset_filename, imageset_dir, button_sequences, opt: ImageOpt):
-        self.all_layers = self.load_imageset(imageset_filename, imageset_dir)
+    scaled_layers: {(int, str): {str: ImageLayer}} = {}
+    """ Layers pre-scaled to output size, keyed by height and resampling filter """
+    scaled_backgrounds: {(int, str): Image} = {}
+    """ Background resized to output size, keyed by height and resampling filter, see scaled_background """
+    palette: Image = None
+    """ Shared by all GIF frames, see gif_palette """
+    compositors: {str: Compositor} = {}
+    """ Compositing backends used, by name, keeping any state of theirs, e.g. layers converted for NumPy """
+
+    def __init__(self):
+        self.all_layers = {}
+        self.scaled_layers = {}
+        self.scaled_backgrounds = {}
+        self.palette = None
+        self.compositors = {}
+
+    def process_imageset(self, out_dirname, imageset_filename, imageset_dir, button_sequences, opt: ImageOpt,
+                         force=False, jobs=1, reload=True, atlas=False):
+        """
+        :param jobs: Number of worker processes rendering images. Each worker loads the imageset once.
+        :param reload: Load the imageset, otherwise reuse the layers already loaded by an earlier call
+        :param atlas: Pack the images into sprite sheets, see process_atlas, instead of writing a file each
+        """
+        if reload or not self.all_layers:
+            with STATS.stage("load_layers"):
+                self.all_layers = self.load_imageset(imageset_filename, imageset_dir)
+            self.scaled_layers = {}
+            self.scaled_backgrounds = {}
+            self.palette = None
+            self.compositors = {}
 
         make_out_dir(out_dirname)
+        cache = ImageCache(out_dirname, force)
+
+        if atlas:
+            try:
+                self.process_atlas(out_dirname, imageset_filename, imageset_dir, button_sequences, opt, cache, jobs)
+            finally:
+                cache.save()
+            return
 
         # Avoid redundant image generation
+        pending = []
         processed_basenames = set()
+        variants = opt.variants()
         for sequence in button_sequences:
             basename = sequence.basename
 
             if basename not in processed_basenames:
-                self.process_image(out_dirname, sequence, opt)
                 processed_basenames.add(basename)
 
-        print(f"composited {len(processed_basenames)} images")
+                # Avoid regenerating images from unchanged inputs, across runs
+                pending_variants = []
+                for variant in variants:
+                    image_filename = ImageSet.image_filename(out_dirname, basename, opt, variant)
+                    key = self.image_key(basename, variant)
+                    if not cache.is_fresh(image_filename, key):
+                        pending_variants.append((variant, image_filename, key))
+
+                if pending_variants:
+                    pending.append((sequence, pending_variants))
+
+        try:
+            if jobs and jobs > 1 and len(pending) > 1:
+                self.process_images_in_pool(out_dirname, imageset_filename, imageset_dir, pending, opt, cache, jobs)
+            else:
+                # Encode and write each image while compositing the next
+                keys = {image_filename: key for _, pending_variants in pending
+                        for _, image_filename, key in pending_variants}
+                with WritePipeline() if ENABLE_WRITE_PIPELINE else contextlib.nullcontext() as pipeline:
+                    self.process_images(out_dirname, pending, opt, pipeline,
+                                        lambda image_filename: cache.record(image_filename, keys[image_filename]))
+        finally:
+            cache.save()
+
+        STATS.count("images_composited", cache.misses)
+        STATS.count("images_skipped", cache.hits)
+        print(f"composited {cache.misses} images, skipped {cache.hits} unchanged")
+
+    @staticmethod
+    def process_images_in_pool(out_dirname, imageset_filename, imageset_dir, pending, opt: ImageOpt,
+                               cache: ImageCache, jobs):
+        """ Renders in worker processes, avoiding the GIL: compositing and encoding are CPU bound.
+        Each image is written by exactly one worker, so output is identical to rendering serially.
+        Records images in submission order, and raises the first error after the remaining images finish.
+        """
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                                    initargs=(imageset_filename, imageset_dir)) as pool:
+            futures = [(pool.submit(process_image_in_worker, out_dirname, sequence, opt,
+                                    [variant for variant, _, _ in pending_variants]), pending_variants)
+                       for sequence, pending_variants in pending]
+
+            error = None
+            for future, pending_variants in futures:
+                try:
+                    STATS.merge(future.result())
+                    ImageSet.record_variants(cache, pending_variants)
+                except Exception as e:
+                    error = error or e
+
+            if error:
+                raise error
+
+    def process_atlas(self, out_dirname, imageset_filename, imageset_dir, button_sequences, opt: ImageOpt,
+                      cache: ImageCache, jobs=1):
+        """
+        Renders the PNG image of every variant, then packs them all into sprite sheets, indexed by JSON and CSS, see
+        Atlas. Skipped while the inputs of every image are unchanged, and every sheet exists. Otherwise, every image is
+        rendered again, as any may move within the sheets.
+        """
+        if any(variant.gif for variant in opt.variants()):
+            raise ValueError("Atlas packs PNG images only, not animations")
+
+        # Avoid redundant image generation: images are named, and composited, by basename
+        sequences = list({sequence.basename: sequence for sequence in button_sequences}.values())
+        image_keys = [[opt.variant_basename(sequence.basename, variant.height),
+                       self.image_key(sequence.basename, variant)]
+                      for sequence in sequences for variant in opt.variants()]
+        atlas_key = digest_values(image_keys, ATLAS_MAX_SIZE, ATLAS_VERSION)
+
+        index_filename = os.path.join(out_dirname, ATLAS_INDEX_FILENAME)
+        if cache.is_fresh(index_filename, atlas_key) and Atlas.is_complete(out_dirname):
+            STATS.count("images_skipped", len(image_keys))
+            print(f"atlas of {len(image_keys)} images unchanged, skipped")
+            return
+
+        images = {}
+        if jobs and jobs > 1 and len(sequences) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                                        initargs=(imageset_filename, imageset_dir)) as pool:
+                for rendered, stats in pool.map(render_pngs_in_worker, sequences, [opt] * len(sequences)):
+                    images.update(rendered)
+                    STATS.merge(stats)
+        else:
+            for start in range(0, len(sequences), RENDER_BATCH_SEQUENCES):
+                images.update(self.render_pngs(sequences[start:start + RENDER_BATCH_SEQUENCES], opt))
+
+        atlas = Atlas.pack({name: image.size for name, image in images.items()})
+        with STATS.stage("write_atlas"):
+            atlas.write(out_dirname, images, opt.png)
+        cache.record(index_filename, atlas_key)
+
+        STATS.count("images_composited", len(images))
+        print(f"composited {len(images)} images, packed into {len(atlas.sheets)} atlas sheets")
+
+    def render_pngs(self, sequences, opt: ImageOpt) -> {str: Image}:
+        """
+        :return: The PNG image of each variant of the sequences, rendered together, by variant basename
+        """
+        start_time = time.perf_counter()
+        results = {opt.variant_basename(sequence.basename, variant.height): images[0]
+                   for sequence, rendered in zip(sequences, self.render_variants_batch(sequences, opt, opt.variants()))
+                   for variant, images, _ in rendered}
+        # Each sequence's share of the batch
+        latency = (time.perf_counter() - start_time) / len(sequences)
+        for _ in sequences:
+            STATS.record_latency("render_image", latency)
+        return results
+
+    @staticmethod
+    def record_variants(cache: ImageCache, pending_variants):
+        for _, image_filename, key in pending_variants:
+            cache.record(image_filename, key)
+
+    def image_key(self, basename, opt: ImageOpt) -> str:
+        """ Digest of all inputs rendering an image: its name, its layers' CSV rows and image file contents,
+        and the rendering options.
+        """
+        layer_names = dict.fromkeys(ImageSet.layer_names_from_basename(basename=basename))
+        layer_sources = [self.all_layers[layer_name].source for layer_name in layer_names]
+
+        rendering = [opt.height, opt.gif, opt.prescale, opt.resample, ENABLE_RESIZE, ENABLE_DIRTY_RECTS]
+        if opt.gif:
+            rendering += [GIF_BEGIN_FRAME_DURATION_MS, GIF_MID_FRAME_DURATION_MS, GIF_END_FRAME_DURATION_MS,
+                          opt.extension(), ANIMATION_VERSION]
+        else:
+            rendering += opt.png.key()
+        if opt.compositor != DEFAULT_COMPOSITOR:
+            rendering.append(opt.compositor)
+
+        return digest_values(basename, layer_sources, rendering)
+
+    @staticmethod
+    def image_filename(out_dirname, basename, opt: ImageOpt, variant: ImageOpt = None) -> str:
+        variant = variant or opt
+        return f"{out_dirname}/{opt.variant_basename(basename, variant.height)}.{variant.extension()}"
 
     def load_imageset(self, csv_file, imageset_dir) -> {str: ImageLayer}:
         """ Loads CSV of imageset data
         :return: Dictionary of layer names to ImageLayer objects
         """
         results = {}
+        # Many layers reuse the same few image files, decode each once
+        layer_store = LayerStore()
+        # Trimmed images, and their offsets, by decoded image
+        trimmed = {}
         with open(csv_file, 'r') as csvfile:
             reader = csv.DictReader(csvfile)
 
             for row in reader:
                 row: dict  # Workaround for https://youtrack.jetbrains.com/issue/PY-60440
+                image, digest = layer_store.load(f"{imageset_dir}/{row[IMAGE_FILE_CSV_HEADER]}")
+
+                # The background defines the canvas, keep it whole
+                trim_x = trim_y = 0
+                if ENABLE_TRIM_LAYERS and row[LAYER_NAME_CSV_HEADER] != BG_LAYER_NAME:
+                    if id(image) not in trimmed:
+                        trimmed[id(image)] = ImageSet.trim_transparent(image)
+                        trimmed_image = trimmed[id(image)][0]
+                        STATS.count("layer_pixels_trimmed",
+                                    image.width * image.height - trimmed_image.width * trimmed_image.height)
+                    image, trim_x, trim_y = trimmed[id(image)]
+
                 layer = ImageLayer(
-                    image=self.load_image(f"{imageset_dir}/{row[IMAGE_FILE_CSV_HEADER]}"),
+                    image=image,
                     layer_name=row[LAYER_NAME_CSV_HEADER],
-                    x=int(row[X_POS_CSV_HEADER]),
-                    y=int(row[Y_POS_CSV_HEADER]),
+                    x=int(row[X_POS_CSV_HEADER]) + trim_x,
+                    y=int(row[Y_POS_CSV_HEADER]) + trim_y,
+                    source=[list(item) for item in row.items()] + [["digest", digest]],
                 )
 
                 results[layer.layer_name] = layer
 
+        layer_store.log_report()
+        STATS.count("layers_loaded", len(results))
+        STATS.count("layer_files_read", layer_store.files_read)
+        STATS.count("layer_bytes_read", layer_store.bytes_read)
+        STATS.count("layer_images_decoded", layer_store.images_decoded)
         if DEBUG_LOG_IMAGESET:
             print(results, file=sys.stderr)
 
         return results
 
     @staticmethod
-    def load_image(image_filename):
-        return Image.open(image_filename)
+    def trim_transparent(image: Image) -> (Image, int, int):
+        """ Crops an image to the bounding box of its non-transparent pixels, which alone change a composite.
 
-    def process_image(self, out_dirname, sequence, opt: ImageOpt):
-        basename = sequence.basename
-        image_filename = f"{out_dirname}/{basename}.{opt.extension()}"
+        :return: The cropped image, or the image itself when there's nothing to trim, and the crop's offset
+        """
+        bbox = image.getchannel("A").getbbox() if image.mode == "RGBA" else None
+        if not bbox or bbox == (0, 0, image.width, image.height):
+            return image, 0, 0
+        return image.crop(bbox), bbox[0], bbox[1]
 
-        if opt.gif:
-            images, durations, names = ImageSet.gen_animated_images(sequence, opt, self.all_layers)
-       
-            if DEBUG_LOG_IMAGESET:
-                print(f"grouped layer names: {names}", file=sys.stderr)
-                print(f"composed animation of {len(images)} images", file=sys.stderr)
+    def process_images(self, out_dirname, pending, opt: ImageOpt, pipeline: WritePipeline = None, on_written=None):
+        """ Writes the images of several sequences, see process_image. Sequences of the same pending variants are
+        rendered together, up to RENDER_BATCH_SEQUENCES at a time, see render_variants_batch.
+
+        :param pending: Each sequence, and its variants to write, each with its filename and key
+        """
+        batches = {}
+        for sequence, pending_variants in pending:
+            variants = tuple(variant for variant, _, _ in pending_variants)
+            batches.setdefault(variants, []).append(sequence)
+
+        for variants, sequences in batches.items():
+            for start in range(0, len(sequences), RENDER_BATCH_SEQUENCES):
+                batch = sequences[start:start + RENDER_BATCH_SEQUENCES]
+                start_time = time.perf_counter()
+                rendered = self.render_variants_batch(batch, opt, list(variants))
+                # Each sequence's share of the batch
+                latency = (time.perf_counter() - start_time) / len(batch)
+
+                for sequence, results in zip(batch, rendered):
+                    self.write_variants(out_dirname, sequence.basename, opt, results, pipeline, on_written)
+                    STATS.record_latency("render_image", latency)
+
+    def process_image(self, out_dirname, sequence, opt: ImageOpt, variants: [ImageOpt] = None,
+                      pipeline: WritePipeline = None, on_written=None):
+        """ Writes the image of a sequence, in each variant height and format.
+
+        :param variants: Subset of opt.variants() to write (Default: all)
+        :param pipeline: Optional pipeline encoding and writing the images, returning once they're submitted.
+        Otherwise, returns once they're written. Animation frames are composited as they're encoded, see
+        AnimationFrames: in the pipeline's encoding threads.
+        :param on_written: Optional callback, with the filename of each image once written
+        """
+        start_time = time.perf_counter()
+        self.write_variants(out_dirname, sequence.basename, opt,
+                            self.render_variants(sequence, opt, variants or opt.variants()), pipeline, on_written)
+        STATS.record_latency("render_image", time.perf_counter() - start_time)
 
-            images[0].save(image_filename, save_all=True, append_images=images[1:], loop=0,
-                           duration=durations, format=opt.extension().upper())
+    def write_variants(self, out_dirname, basename, opt: ImageOpt, results: [(ImageOpt, [Image], [int])],
+                       pipeline: WritePipeline = None, on_written=None):
+        """
+        :param results: Rendered variants, see render_variants
+        """
+        for variant, images, durations in results:
+            image_filename = ImageSet.image_filename(out_dirname, basename, opt, variant)
+            encode = self.encoder(variant, images, durations)
+            written = functools.partial(ImageSet.record_written, variant.extension(), image_filename, on_written)
+
+            if pipeline:
+                pipeline.submit(encode, image_filename, written)
+            else:
+                encode(image_filename)
+                written()
+
+    def encoder(self, variant: ImageOpt, images, durations: [int]):
+        """
+        :param images: A variant's images, and durations, see render_variants
+        :return: Function encoding the image in the variant's format, into a file or file object
+        """
+        if variant.gif:
+            return functools.partial(save_animation, frames=images, durations=durations,
+                                     image_format=variant.extension(), palette=self.gif_palette())
+        return functools.partial(save_png, images[0], png=variant.png)
+
+    @staticmethod
+    def record_written(image_format, image_filename, on_written=None):
+        STATS.record_written(image_format, image_filename)
+        if on_written:
+            on_written(image_filename)
+
+    def gif_palette(self) -> Image:
+        """ Palette shared by all GIF frames, built once from the layers: the background, and each other layer
+        composited over the background beneath it, as in frames.
+        """
+        if self.palette is None:
+            bg = self.all_layers[BG_LAYER_NAME].image
+            images = [bg]
+            for layer_name, layer in self.all_layers.items():
+                if layer_name != BG_LAYER_NAME:
+                    image = bg.crop((layer.x, layer.y, layer.x + layer.image.width, layer.y + layer.image.height))
+                    image.alpha_composite(layer.image)
+                    images.append(image)
+
+            with STATS.stage("build_palette"):
+                self.palette = build_palette(images)
+        return self.palette
+
+    def render_variants(self, sequence, opt: ImageOpt, variants: [ImageOpt]) -> [(ImageOpt, [Image], [int])]:
+        """ Composites the images of each variant.
+
+        With several heights, composites once at full size, then resizes for every height, unless resampling only
+        dirty rectangles, which is cheaper for each height, see dirty_rects_apply. Otherwise, composites for the
+        single height. PNG variants reuse the last, complete, animation frame when also rendering GIF.
+
+        :return: Variant, its images (a single image for PNG, AnimationFrames for GIF), and frame durations
+        """
+        return self.render_variants_batch([sequence], opt, variants)[0]
+
+    def render_variants_batch(self, sequences, opt: ImageOpt,
+                              variants: [ImageOpt]) -> [[(ImageOpt, [Image], [int])]]:
+        """ Composites the images of each variant of several sequences, see render_variants. Still images of all
+        the sequences are composited together, see gen_composite_images.
+
+        :return: The variants' images of each sequence, in order
+        """
+        heights = list(dict.fromkeys(variant.height for variant in variants))
+
+        # Composite once, at the most useful size for all variants
+        if len(heights) > 1 and not opt.prescale and not ImageSet.dirty_rects_apply(opt):
+            render_opts = [ImageOpt(None, opt.gif, opt.prescale, opt.resample, compositor=opt.compositor)]
         else:
-            # PNG
-            layer_names: [] = ImageSet.layer_names_from_basename(basename=basename)
+            render_opts = [ImageOpt(height, opt.gif, opt.prescale, opt.resample, compositor=opt.compositor)
+                           for height in heights]
+
+        rendered = [{} for _ in sequences]
+        for render_opt in render_opts:
+            layers = self.all_layers if render_opt.height is None else self.layers_for(render_opt)
+            for index, frames in enumerate(self.render_frames_batch(sequences, render_opt, layers, variants)):
+                rendered[index][render_opt.height] = frames
+
+        return [ImageSet.variant_images(sequence.basename, sequence_rendered, variants)
+                for sequence, sequence_rendered in zip(sequences, rendered)]
+
+    @staticmethod
+    def variant_images(basename, rendered: {int: (AnimationFrames, [int], Image)},
+                       variants: [ImageOpt]) -> [(ImageOpt, [Image], [int])]:
+        """
+        :param rendered: Frames, durations and complete image, by height composited at, or None for full size
+        :return: Each variant, its images resized from those rendered when not composited at its height, and durations
+        """
+        results = []
+        for variant in variants:
+            frames, durations, full_image = rendered.get(variant.height) or rendered[None]
+
+            if variant.gif:
+                images = frames
+                if variant.height not in rendered:
+                    images = frames.map(functools.partial(ImageSet.resize_image, variant))
+            else:
+                images = [full_image]
+                if variant.height not in rendered:
+                    images = [ImageSet.resize_image(variant, full_image)]
 
             if DEBUG_LOG_IMAGESET:
-                print(f"computed layer names: {layer_names}", file=sys.stderr)
+                print(f"rendered {basename}: {len(images)} images, {variant.height} high, {variant.extension()}",
+                      file=sys.stderr)
+            results.append((variant, images, durations))
+
+        return results
+
+    def render_frames_batch(self, sequences, opt: ImageOpt, layers: {str: ImageLayer},
+                            variants: [ImageOpt]) -> [(AnimationFrames, [int], Image)]:
+        """
+        :return: Animation frames and durations, if any variant is GIF, and the complete image, of each sequence
+        """
+        background = self.scaled_background(opt)
+        compositor = self.compositor_for(opt)
+        if any(variant.gif for variant in variants):
+            results = []
+            for sequence in sequences:
+                images, durations, names = ImageSet.gen_animated_images(sequence, opt, layers, background,
+                                                                        compositor)
+
+                if DEBUG_LOG_IMAGESET:
+                    print(f"grouped layer names: {names}", file=sys.stderr)
+                    print(f"composed animation of {len(images)} images", file=sys.stderr)
 
-            composite_image = self.gen_composite_image(opt, layer_names, self.all_layers)
-            composite_image.save(image_filename, format=opt.extension().upper())
+                results.append((images, durations, images.last))
+            return results
+
+        layer_name_lists = [ImageSet.layer_names_from_basename(basename=sequence.basename) for sequence in sequences]
+
+        if DEBUG_LOG_IMAGESET:
+            print(f"computed layer names: {layer_name_lists}", file=sys.stderr)
+
+        return [([], [], image)
+                for image in self.gen_composite_images(opt, layer_name_lists, layers, background, compositor)]
+
+    def compositor_for(self, opt: ImageOpt) -> Compositor:
+        if opt.compositor not in self.compositors:
+            self.compositors[opt.compositor] = COMPOSITORS[opt.compositor]()
+        return self.compositors[opt.compositor]
+
+    def scaled_background(self, opt: ImageOpt) -> Image:
+        """ The background resized to the output height, once, for compositing only dirty rectangles over it.
+
+        :return: None when compositing at output size already, or keeping full size. Also None for the nearest
+        filter: a rectangle's sample positions may round to the neighbouring source pixel, where the full size
+        resize's don't.
+        """
+        if opt.height is None or not ImageSet.dirty_rects_apply(opt):
+            return None
+
+        key = (opt.height, opt.resample)
+        if key not in self.scaled_backgrounds:
+            self.scaled_backgrounds[key] = ImageSet.resize_image(opt, self.all_layers[BG_LAYER_NAME].image)
+        return self.scaled_backgrounds[key]
+
+    @staticmethod
+    def dirty_rects_apply(opt: ImageOpt) -> bool:
+        """
+        :return: Whether images are composited over a scaled background, resampling only dirty rectangles, see
+        scaled_background
+        """
+        return ENABLE_DIRTY_RECTS and ENABLE_RESIZE and not opt.prescale and opt.resample != "nearest"
+
+    def layers_for(self, opt: ImageOpt) -> {str: ImageLayer}:
+        """ Layers to composite with: full size, or pre-scaled to the output height.
+        """
+        if not (opt.prescale and ENABLE_RESIZE):
+            return self.all_layers
+
+        key = (opt.height, opt.resample)
+        if key not in self.scaled_layers:
+            self.scaled_layers[key] = ImageSet.scale_layers(self.all_layers, opt)
+        return self.scaled_layers[key]
+
+    @staticmethod
+    def scale_layers(all_layers: {str: ImageLayer}, opt: ImageOpt) -> {str: ImageLayer}:
+        """ Scales every layer, and its offsets, by the background's reduction to the output height. Compositing
+        scaled layers is much cheaper than resizing full size composites, for small output images.
+
+        The background is scaled to exactly the size the full size path outputs. Other layers are resampled onto the
+        output pixel grid, keeping their sub-pixel offsets, rather than rounding offsets to whole output pixels.
+        """
+        bg_width, bg_height = all_layers[BG_LAYER_NAME].image.size
+        out_width, out_height = size_from_height(opt.height, (bg_width, bg_height))
+        scale_x = out_width / bg_width
+        scale_y = out_height / bg_height
+        resample = ImageSet.resample_filter(opt)
+
+        # Transparent source pixels around each layer, covering the resampling filter's support
+        margin = math.ceil(RESAMPLE_MAX_SUPPORT / min(scale_x, scale_y))
+
+        results = {}
+        for layer_name, layer in all_layers.items():
+            if layer_name == BG_LAYER_NAME:
+                results[layer_name] = ImageLayer(layer.image.resize((out_width, out_height), resample),
+                                                 layer_name, 0, 0, layer.source)
+                continue
+
+            width, height = layer.image.size
+            # Output pixels touched by the layer, and the source region they cover
+            out_box = (math.floor(layer.x * scale_x), math.floor(layer.y * scale_y),
+                       math.ceil((layer.x + width) * scale_x), math.ceil((layer.y + height) * scale_y))
+            source_box = (out_box[0] / scale_x, out_box[1] / scale_y, out_box[2] / scale_x, out_box[3] / scale_y)
+
+            padded_x = math.floor(source_box[0]) - margin
+            padded_y = math.floor(source_box[1]) - margin
+            padded = Image.new("RGBA", (math.ceil(source_box[2]) + margin - padded_x,
+                                        math.ceil(source_box[3]) + margin - padded_y))
+            padded.paste(layer.image, (layer.x - padded_x, layer.y - padded_y))
+
+            scaled = padded.resize((out_box[2] - out_box[0], out_box[3] - out_box[1]), resample,
+                                   box=(source_box[0] - padded_x, source_box[1] - padded_y,
+                                        source_box[2] - padded_x, source_box[3] - padded_y))
+
+            results[layer_name] = ImageLayer(scaled, layer_name, out_box[0], out_box[1], layer.source)
+
+        return results
+
+    def check_prescaled(self, imageset_filename, imageset_dir, button_sequences, opt: ImageOpt) -> (float, int):
+        """ Reports the quality of pre-scaled compositing for every unique image, see compare_prescaled.
+
+        :return: Worst mean, and maximum, absolute differences
+        """
+        self.all_layers = self.load_imageset(imageset_filename, imageset_dir)
+        self.scaled_layers = {}
+        self.scaled_backgrounds = {}
+
+        sequences = {sequence.basename: sequence for sequence in button_sequences}
+        worst_mean, worst_max, worst_basename = 0.0, 0, None
+        for basename, sequence in sequences.items():
+            mean, maximum = self.compare_prescaled(sequence, opt)
+            if DEBUG_LOG_IMAGESET:
+                print(f"prescale difference {basename}: mean {mean:.2f}, max {maximum}", file=sys.stderr)
+
+            if mean > worst_mean:
+                worst_mean, worst_basename = mean, basename
+            worst_max = max(worst_max, maximum)
+
+        print(f"prescale check of {len(sequences)} images, '{opt.resample}' filter: "
+              f"worst mean difference {worst_mean:.2f} ({worst_basename}), max difference {worst_max}")
+        return worst_mean, worst_max
+
+    def compare_prescaled(self, sequence, opt: ImageOpt) -> (float, int):
+        """ Quality check of pre-scaled compositing, against compositing at full size and then resizing.
+
+        :return: Mean, and maximum, absolute difference of any RGBA channel, in 0-255 levels
+        """
+        layer_names = ImageSet.layer_names_from_basename(basename=sequence.basename)
+        full_size_opt = ImageOpt(opt.height, opt.gif, prescale=False, resample=opt.resample)
+
+        expected = ImageSet.gen_composite_image(full_size_opt, layer_names, self.all_layers)
+        actual = ImageSet.gen_composite_image(opt, layer_names, self.layers_for(opt))
+
+        difference = ImageChops.difference(expected, actual)
+        mean = sum(ImageStat.Stat(difference).mean) / len(difference.getbands())
+        maximum = max(high for _, high in difference.getextrema())
+        return mean, maximum
 
     @staticmethod
     def layer_names_from_basename(*, basename, unpack_digits=True, add_bg=True) -> [str]:
@@ -136,8 +634,9 @@ class ImageSet:
         return results
 
     @staticmethod
-    def gen_animated_images(sequence: ButtonSequence, opt: ImageOpt,
-                            all_layers: {str: ImageLayer}) -> ([Image], [int], [[str]]):
+    def gen_animated_images(sequence: ButtonSequence, opt: ImageOpt, all_layers: {str: ImageLayer},
+                            background: Image = None,
+                            compositor: Compositor = None) -> (AnimationFrames, [int], [[str]]):
         """
         Composites images as a series of images. 
         * Respects grouped digit-layer sequences, showing as a single image.
@@ -145,81 +644,250 @@ class ImageSet:
         * Defines a duration list for each frame with a hold at its end.
         * Initially shows the last "full" frame as a poster. Used for GIF loading, to better represent the animation 
           in still documents. 
+
+        Composites the last frame at once, then the others lazily, as they're iterated. Flashed frames, and the poster,
+        are the frames they repeat, not copies.
         
         :param sequence: Ordered list of layer names.
         :param opt: Configuration for image rendering.
         :param all_layers: Image data source.
-        :return: List of images, and durations for those images.
+        :param background: Optional background resized for opt, see scaled_background. Each frame then resamples
+        only the rectangles of the layers it adds, see composite_dirty_rects.
+        :param compositor: Compositing backend (Default: Pillow). Without a background, composites frames in
+        batches.
+        :return: Images, and durations for those images.
         """
+        compositor = compositor or Compositor()
 
         packed_layer_names: [] = ImageSet.layer_names_from_basename(basename=sequence.basename, unpack_digits=False)
         grouped_layer_names = [ImageSet.layer_names_from_basename(basename=name, unpack_digits=True, add_bg=False)
                                for name in packed_layer_names]
 
-        grouped_images = []
-        composited_image = None
+        # Layers of each frame: those of the frame before, then its group's
+        frame_layers = []
+        for ungrouped_layer_names in grouped_layer_names:
+            frame_layers.append([*(frame_layers[-1] if frame_layers else []),
+                                 *(all_layers[layer_name] for layer_name in ungrouped_layer_names)])
+
+        # Whether each group's frame follows a flash, counting frames as they're added
+        flashes = []
         last_layer_names = []
         for ungrouped_layer_names in grouped_layer_names:
-            ImageSet.flash_identical_layer(grouped_images, last_layer_names, ungrouped_layer_names)
+            flashes.append(ImageSet.flashes_identical_layer(len(flashes) + sum(flashes), last_layer_names,
+                                                            ungrouped_layer_names))
+            last_layer_names = ungrouped_layer_names
 
-            ungrouped_image_layers = [all_layers[layer_name] for layer_name in ungrouped_layer_names]
+        if background is None:
+            last = ImageSet.resize_image(opt, compositor.composite(frame_layers[-1]))
+        else:
+            last = ImageSet.composite_dirty_rects(opt, background, frame_layers[-1], frame_layers[-1][1:], compositor)
+        add_poster = len(grouped_layer_names) > 1
+
+        def generate():
+            if add_poster:
+                yield last
+
+            if background is None:
+                composites = compositor.iter_composites(frame_layers[:-1])
+            resized = None
+            recent = []
+            for index, flash in enumerate(flashes):
+                if flash:
+                    recent = [*recent[-1:], recent[-2]]
+                    yield recent[-1]
+
+                if index == len(frame_layers) - 1:
+                    resized = last
+                elif background is None:
+                    resized = ImageSet.resize_image(opt, next(composites))
+                else:
+                    # The first group is the background alone, which the resized background already shows
+                    changed_layers = frame_layers[index][len(frame_layers[index - 1]) if index else 1:]
+                    resized = ImageSet.composite_dirty_rects(opt, resized or background, frame_layers[index],
+                                                             changed_layers, compositor)
+                recent = [*recent[-1:], resized]
+                yield resized
+
+        frame_count = len(flashes) + sum(flashes) + add_poster
+        durations = [GIF_MID_FRAME_DURATION_MS] * (frame_count - 1) + [GIF_END_FRAME_DURATION_MS]
+        if add_poster:
+            durations = [GIF_BEGIN_FRAME_DURATION_MS] + durations
 
-            for layer in ungrouped_image_layers:
-                composited_image = ImageSet.composite_layer(composited_image, layer)
+        return AnimationFrames(generate, frame_count, last), durations, grouped_layer_names
 
-            resized = ImageSet.resize_image(opt, composited_image)
-            grouped_images.append(resized)
+    @staticmethod
+    def flashes_identical_layer(frame_count, last_layer_names, ungrouped_layer_names) -> bool:
+        """ Checks for identical layers between last image and next, to repeat a prior image first, animating a flash
+        to illustrate the repetition.
 
-            last_layer_names = ungrouped_layer_names
+        :param frame_count: Frames before the next
+        """
+        return bool(last_layer_names and
+                    any(element in set(last_layer_names) for element in set(ungrouped_layer_names)) and
+                    frame_count > 2)
 
-        added_poster = ImageSet.add_poster_image(grouped_images)
+    @staticmethod
+    def gen_composite_image(opt: ImageOpt, layer_names, layers: {str: ImageLayer}, background: Image = None,
+                            compositor: Compositor = None) -> Image:
+        """
+        :param layer_names: Layers to composite in order, the background first
+        :param background: Optional background resized for opt, see scaled_background. Composites, and resamples,
+        only the rectangles of the other layers over it, see composite_dirty_rects.
+        :param compositor: Compositing backend (Default: Pillow)
+        """
+        return ImageSet.gen_composite_images(opt, [layer_names], layers, background, compositor)[0]
 
-        durations = [GIF_MID_FRAME_DURATION_MS] * (len(grouped_images) - 1) + [GIF_END_FRAME_DURATION_MS]
-        if added_poster:
-            durations = [GIF_BEGIN_FRAME_DURATION_MS] + durations
+    @staticmethod
+    def gen_composite_images(opt: ImageOpt, layer_name_lists: [[str]], layers: {str: ImageLayer},
+                             background: Image = None, compositor: Compositor = None) -> [Image]:
+        """ Composites several images together, e.g. of different sequences, in batches of the compositor, see
+        gen_composite_image.
+        """
+        compositor = compositor or Compositor()
+        image_layer_lists = [[layers[layer_name] for layer_name in layer_names] for layer_names in layer_name_lists]
 
-        return grouped_images, durations, grouped_layer_names
+        if DEBUG_LOG_IMAGESET:
+            for layer_names, image_layers in zip(layer_name_lists, image_layer_lists):
+                for layer_name, layer in zip(layer_names, image_layers):
+                    print(f"compositing layer name '{layer_name}', layer {layer}", file=sys.stderr)
 
-    @staticmethod
-    def add_poster_image(grouped_images) -> bool:
-        if len(grouped_images) > 1:
-            grouped_images.insert(0, grouped_images[-1].copy())
-            return True
-        return False
+        if background is not None:
+            return ImageSet.composite_dirty_rects_batch(opt, [background] * len(image_layer_lists), image_layer_lists,
+                                                        [image_layers[1:] for image_layers in image_layer_lists],
+                                                        compositor)
+
+        # Resized as composited, keeping one batch at full size at a time
+        return [ImageSet.resize_image(opt, image) for image in compositor.iter_composites(image_layer_lists)]
 
     @staticmethod
-    def flash_identical_layer(grouped_images, last_layer_names, ungrouped_layer_names):
-        """ Checks for identical layers between last image and next, and then appends a prior image, animating a flash 
-        to illustrate the repetition.
+    def composite_dirty_rects(opt: ImageOpt, base: Image, layers: [ImageLayer], changed_layers: [ImageLayer],
+                              compositor: Compositor = None) -> Image:
+        """ Updates a resized composite for changed layers, resampling only the output rectangles they reach.
+
+        Each rectangle is composited at full size from a crop of the background, plus its margin for the resampling
+        filter, rather than from a copy of the whole background. Matches compositing every layer at full size then
+        resizing, as no other output pixel's filter reaches a changed source pixel. Within 1 level: the rectangle's
+        sample positions are computed relative to the crop, rounding slightly differently.
+
+        :param base: The resized composite of the layers before the changed ones, e.g. the resized background
+        :param layers: All layers composited so far, in order, the full size background first
+        :param changed_layers: Layers the base doesn't show yet, at the end of layers
+        :param compositor: Compositing backend (Default: Pillow)
+        :return: Copy of base, updated
         """
-        if (last_layer_names and
-                any(element in set(last_layer_names) for element in set(ungrouped_layer_names)) and
-                len(grouped_images) > 2):
-            grouped_images.append(grouped_images[-2].copy())
+        return ImageSet.composite_dirty_rects_batch(opt, [base], [layers], [changed_layers], compositor)[0]
 
     @staticmethod
-    def gen_composite_image(opt: ImageOpt, layer_names, layers: {str: ImageLayer}) -> Image:
-        working_image = None
-        layers = [(layer_name, layers[layer_name]) for layer_name in layer_names]
+    def composite_dirty_rects_batch(opt: ImageOpt, bases: [Image], layer_lists: [[ImageLayer]],
+                                    changed_layer_lists: [[ImageLayer]], compositor: Compositor = None) -> [Image]:
+        """ Updates several resized composites, see composite_dirty_rects. Rectangles of the same canvas region,
+        e.g. of a button shared by sequences, are composited in one batch of the compositor.
 
-        for layer_name, layer in layers:
-            if DEBUG_LOG_IMAGESET:
-                print(f"compositing layer name '{layer_name}', layer {layer}", file=sys.stderr)
-
-            working_image = ImageSet.composite_layer(working_image, layer)
+        :return: Copy of each base, updated
+        """
+        compositor = compositor or Compositor()
+        results = [base.copy() for base in bases]
+        resample = ImageSet.resample_filter(opt)
+
+        # Output rectangles of each canvas region, and the index of the image they're in
+        regions = {}
+        for index, (base, layers, changed_layers) in enumerate(zip(bases, layer_lists, changed_layer_lists)):
+            background = layers[0].image
+            ratio_x = background.width / base.width
+            ratio_y = background.height / base.height
+            # Source pixels around each rectangle, covering the resampling filter's support, plus rounding
+            margin_x = math.ceil(RESAMPLE_MAX_SUPPORT * max(ratio_x, 1)) + 1
+            margin_y = math.ceil(RESAMPLE_MAX_SUPPORT * max(ratio_y, 1)) + 1
+
+            for out_box in ImageSet.dirty_boxes(changed_layers, ratio_x, ratio_y, base.size):
+                source_box = (out_box[0] * ratio_x, out_box[1] * ratio_y, out_box[2] * ratio_x, out_box[3] * ratio_y)
+                region_box = (max(0, math.floor(source_box[0]) - margin_x),
+                              max(0, math.floor(source_box[1]) - margin_y),
+                              min(background.width, math.ceil(source_box[2]) + margin_x),
+                              min(background.height, math.ceil(source_box[3]) + margin_y))
+                regions.setdefault(region_box, []).append((index, out_box, source_box))
+
+        for region_box, rects in regions.items():
+            composites = compositor.iter_composites([layer_lists[index] for index, _, _ in rects], region_box)
+            for (index, out_box, source_box), region in zip(rects, composites):
+                scaled = region.resize((out_box[2] - out_box[0], out_box[3] - out_box[1]), resample,
+                                       box=(source_box[0] - region_box[0], source_box[1] - region_box[1],
+                                            source_box[2] - region_box[0], source_box[3] - region_box[1]))
+                results[index].paste(scaled, out_box[:2])
 
-        result = ImageSet.resize_image(opt, working_image)
-        return result
+        return results
 
     @staticmethod
-    def composite_layer(composite_image, layer: ImageLayer) -> Image:
-        if not composite_image:
-            composite_image = layer.image.copy()
-        else:
-            composite_image.alpha_composite(layer.image, (layer.x, layer.y))
+    def dirty_boxes(changed_layers: [ImageLayer], ratio_x, ratio_y, out_size) -> [(int, int, int, int)]:
+        """ Output rectangles whose resampling filter reaches any changed layer. Overlapping rectangles are merged,
+        resampling each output pixel once.
 
-        return composite_image
+        :param ratio_x: Source pixels per output pixel, horizontally
+        """
+        def span(start, end, ratio, limit) -> (int, int):
+            # Output pixel i samples source pixels within support of its center, (i + 0.5) * ratio
+            support = RESAMPLE_MAX_SUPPORT * max(ratio, 1)
+            return (max(0, math.floor((start - support) / ratio - 0.5) - 1),
+                    min(limit, math.ceil((end + support) / ratio - 0.5) + 1))
+
+        boxes = []
+        for layer in changed_layers:
+            left, right = span(layer.x, layer.x + layer.image.width, ratio_x, out_size[0])
+            top, bottom = span(layer.y, layer.y + layer.image.height, ratio_y, out_size[1])
+            if left >= right or top >= bottom:
+                continue
+
+            box = (left, top, right, bottom)
+            overlapping = [other for other in boxes
+                           if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]]
+            while overlapping:
+                for other in overlapping:
+                    boxes.remove(other)
+                    box = (min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3]))
+                overlapping = [other for other in boxes
+                               if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]]
+            boxes.append(box)
+
+        return boxes
 
     @staticmethod
     def resize_image(opt, output_image):
-        return output_image.resize(size_from_height(opt.height, output_image.size)) if ENABLE_RESIZE else output_image
+        if not ENABLE_RESIZE:
+            return output_image
+        if opt.prescale or opt.height is None:
+            # Already composited at output size, or keeping full size
+            return output_image
+        return output_image.resize(size_from_height(opt.height, output_image.size), ImageSet.resample_filter(opt))
+
+    @staticmethod
+    def resample_filter(opt: ImageOpt) -> Image.Resampling:
+        return Image.Resampling[opt.resample.upper()]
+
+
+# Worker process state, for ImageSet.process_images_in_pool. Loaded once per worker by its initializer.
+worker_imageset: ImageSet = None
+
+
+def init_worker(imageset_filename, imageset_dir):
+    global worker_imageset
+    worker_imageset = ImageSet()
+    worker_imageset.all_layers = worker_imageset.load_imageset(imageset_filename, imageset_dir)
+
+
+def render_pngs_in_worker(sequence, opt: ImageOpt) -> ({str: Image}, {}):
+    """
+    :return: Images, and the worker's stats of rendering them, to merge into the caller's
+    """
+    STATS.reset()
+    return worker_imageset.render_pngs([sequence], opt), STATS.snapshot()
+
+
+def process_image_in_worker(out_dirname, sequence, opt: ImageOpt, variants: [ImageOpt]) -> {}:
+    """
+    :return: Stats of this image, to merge into the caller's
+    """
+    STATS.reset()
+    # Workers encode in parallel already, one encoding thread overlaps compositing and writing
+    with WritePipeline(encode_threads=1) if ENABLE_WRITE_PIPELINE else contextlib.nullcontext() as pipeline:
+        worker_imageset.process_image(out_dirname, sequence, opt, variants, pipeline)
+    return STATS.snapshot()
@@ -0,0 +1,68 @@
+import io
+import os
+import sys
+
+from PIL import Image
+
+from util import digest_bytes
+
+DEBUG_LOG_LAYER_STORE = False
+
+
+class LayerStore:
+    """
+    Decodes each layer image exactly once, shared by every layer which uses it.
+
+    Layers are deduplicated by file path, and then by file contents. Images are normalized to RGBA, as required by
+    alpha compositing, and fully decoded up front, so no file handles remain open.
+
+    Shared images are read-only by convention: callers must copy an image before modifying it.
+    """
+    images_by_digest: {str: Image} = {}
+    digests_by_path: {str: str} = {}
+    files_read: int = 0
+    bytes_read: int = 0
+    images_decoded: int = 0
+
+    def __init__(self):
+        self.images_by_digest = {}
+        self.digests_by_path = {}
+        self.files_read = 0
+        self.bytes_read = 0
+        self.images_decoded = 0
+
+    def load(self, image_filename) -> (Image, str):
+        """
+        :return: Shared RGBA image, and the content digest of its file
+        """
+        path = os.path.realpath(image_filename)
+
+        digest = self.digests_by_path.get(path)
+        if digest is None:
+            with open(path, "rb") as fin:
+                data = fin.read()
+            self.files_read += 1
+            self.bytes_read += len(data)
+
+            digest = digest_bytes(data)
+            self.digests_by_path[path] = digest
+
+            if digest not in self.images_by_digest:
+                self.images_by_digest[digest] = LayerStore.decode(data)
+                self.images_decoded += 1
+
+        return self.images_by_digest[digest], digest
+
+    @staticmethod
+    def decode(data: bytes) -> Image:
+        with Image.open(io.BytesIO(data)) as image:
+            # Always a new, fully loaded image, even when already RGBA
+            return image.convert("RGBA")
+
+    def report(self) -> str:
+        return (f"layer store: read {self.files_read} files, {self.bytes_read} bytes, "
+                f"decoded {self.images_decoded} images")
+
+    def log_report(self):
+        if DEBUG_LOG_LAYER_STORE:
+            print(self.report(), file=sys.stderr)
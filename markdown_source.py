@@ -0,0 +1,41 @@
+import io
+
+from mistletoe.block_token import Document
+from mistletoe.markdown_renderer import MarkdownRenderer
+
+from util import digest_bytes
+
+
+class MarkdownSource:
+    """
+    Markdown file contents, read once, and parsed at most once, shared by extraction, link rewriting and formatting.
+
+    Lines are decoded as open() would in text mode. The document is parsed on first use, for the Markdown renderer,
+    as extraction needs its tokens, and formatting renders them.
+    """
+    filename: str
+    lines: [str] = []
+    digest: str = None
+    """ Content hash of the file, as util.digest_file """
+
+    def __init__(self, markdown_filename):
+        self.filename = markdown_filename
+        with open(markdown_filename, "rb") as fin:
+            data = fin.read()
+
+        self.digest = digest_bytes(data)
+        self.lines = io.TextIOWrapper(io.BytesIO(data)).readlines()
+        self._document = None
+
+    def document(self) -> Document:
+        if self._document is None:
+            with MarkdownRenderer(normalize_whitespace=True) as _:
+                self._document = Document(self.lines)
+        return self._document
+
+    def format(self) -> str:
+        """
+        :return: Markdown rendered from the parsed document, see FormatMarkdown
+        """
+        with MarkdownRenderer(normalize_whitespace=True) as renderer:
+            return renderer.render(self.document())
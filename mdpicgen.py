@@ -1,17 +1,44 @@
 from extract_md import extract_button_sequences
-from util import format_image_basename
+from util import format_image_basename, PngOpt
 from button_sequence import ButtonSequence
 from modify_md import format_markdown, write_markdown
 from imageset_gen import ImageSet, ImageOpt
 from psd_gen import PSDInMd
+from server import serve
 
 # noinspection PyUnresolvedReferences
-mdpicgen_ignore = extract_button_sequences, format_image_basename, ButtonSequence, format_markdown, write_markdown
+mdpicgen_ignore = extract_button_sequences, format_image_basename, ButtonSequence, format_markdown, write_markdown, \
+    PngOpt
 
 
-def process_psd(out_dirname, psd_filename, basenames, height):
-    PSDInMd().process_psd(out_dirname, psd_filename, basenames, height)
+def process_psd(out_dirname, psd_filename, basenames, opt: ImageOpt, force=False, jobs=None):
+    PSDInMd().process_psd(out_dirname, psd_filename, basenames, opt, force, jobs)
 
 
-def process_imageset(out_dirname, imageset_filename, imageset_dir, button_sequences, opt: ImageOpt):
-    ImageSet().process_imageset(out_dirname, imageset_filename, imageset_dir, button_sequences, opt)
+def export_psd_imageset(psd_filename, imageset_filename, imageset_dir, force=False) -> bool:
+    return PSDInMd().export_imageset(psd_filename, imageset_filename, imageset_dir, force)
+
+
+def process_imageset(out_dirname, imageset_filename, imageset_dir, button_sequences, opt: ImageOpt, force=False,
+                     jobs=1, imageset: ImageSet = None, reload=True, atlas=False):
+    """
+    :param imageset: Optional ImageSet to reuse, keeping its layers loaded between calls when not reload
+    :param atlas: Pack images into sprite sheets, instead of writing a file each
+    """
+    (imageset or ImageSet()).process_imageset(out_dirname, imageset_filename, imageset_dir, button_sequences, opt,
+                                              force, jobs, reload, atlas)
+
+
+def check_prescaled(imageset_filename, imageset_dir, button_sequences, opt: ImageOpt):
+    ImageSet().check_prescaled(imageset_filename, imageset_dir, button_sequences, opt)
+
+
+def serve_imageset(imageset_filename, imageset_dir, opt: ImageOpt, host, port, cache_bytes, interval=0.5):
+    """
+    Serves images rendered on request, e.g. '/s_1.png?h=48', until interrupted. Reloads the imageset when changed.
+
+    :param opt: Rendering options, and the heights served
+    :param cache_bytes: Size of the encoded images kept in memory
+    :param interval: Seconds between checks for changes of the imageset
+    """
+    serve(imageset_filename, imageset_dir, opt, host, port, cache_bytes, interval)
@@ -1,3 +1,5 @@
+import contextlib
+import html
 import re
 import sys
 import os
@@ -7,40 +9,71 @@ import mistletoe
 from mistletoe.markdown_renderer import MarkdownRenderer
 
 from constants import HTML_BREAK_PATTERN, HTML_BREAK
+from atlas import Atlas
 from button_sequence import ButtonSequence
+from markdown_source import MarkdownSource
+from stats import STATS
 from util import ImageOpt
 
 # For debugging parsing
 DEBUG_LOG_MODIFY = False
 
 
-def format_markdown(markdown_filename):
+def format_markdown(markdown_filename, source: MarkdownSource = None):
+    """
+    :param source: Optional contents of markdown_filename already read, and perhaps parsed, e.g. by extraction
+    """
+    if source:
+        return source.format()
     formatter = FormatMarkdown(markdown_filename)
     return formatter.formatted
 
 
-def write_markdown(md_out_file, image_out_path, md_in_file, button_sequences: [ButtonSequence], opt: ImageOpt):
-    if not button_sequences:
-        shutil.copyfile(md_in_file, md_out_file)
-        return
+def write_markdown(md_out_file, image_out_path, md_in_file, button_sequences: [ButtonSequence], opt: ImageOpt,
+                   srcset=False, source: MarkdownSource = None, atlas: Atlas = None):
+    """
+    :param srcset: Link images of all heights in opt, with an HTML img tag's srcset. Otherwise, a Markdown link.
+    :param source: Optional contents of md_in_file already read, e.g. by extraction, instead of reading md_in_file
+    :param atlas: Link images packed in the atlas in image_out_path, with an HTML img tag of their sprite sheet,
+    styled to show only the image. Ignores srcset.
+    """
+    with STATS.stage("write_markdown", md_in_file):
+        if not button_sequences and not source:
+            shutil.copyfile(md_in_file, md_out_file)
+        else:
+            write_linked_markdown(md_out_file, image_out_path, md_in_file, button_sequences, opt, srcset, source,
+                                  atlas)
 
+    STATS.count("bytes_written.md", os.path.getsize(md_out_file))
+
+
+def write_linked_markdown(md_out_file, image_out_path, md_in_file, button_sequences: [ButtonSequence],
+                          opt: ImageOpt, srcset, source: MarkdownSource = None, atlas: Atlas = None):
     seqs = iter(button_sequences)
-    seq = next(seqs)
+    seq = next(seqs, None)
 
     if os.path.normpath(md_in_file) == os.path.normpath(md_out_file):
         raise FileExistsError(f"Cannot write to same file that is being read from: \"{md_in_file}\"")
 
     line_count = 0
-    with open(md_in_file, "r") as fin:
+    with (contextlib.nullcontext(source.lines) if source else open(md_in_file, "r")) as fin:
         with open(md_out_file, "w") as fout:
             for in_line in fin:
                 line_count += 1
 
                 out_line = in_line
-                if seq.line_number == line_count:
+                if seq and seq.line_number == line_count:
                     # alter the line
-                    out_line = update_or_replace_image_in_markdown(
-                        in_line, f"{image_out_path}/{seq.basename}.{opt.extension()}")
+                    if atlas:
+                        atlas_image = atlas.images.get(seq.basename)
+                        if not atlas_image:
+                            raise KeyError(f"Image {seq.basename} is not in the atlas, generate images with --atlas")
+                        out_line = update_or_replace_image_in_markdown(
+                            in_line, f"{image_out_path}/{atlas_image.sheet}", style=atlas_image.style())
+                    else:
+                        out_line = update_or_replace_image_in_markdown(
+                            in_line, f"{image_out_path}/{seq.basename}.{opt.extension()}",
+                            format_srcset(image_out_path, seq.basename, opt) if srcset else None)
 
                     # Prepare for the next opportunity to mutate a button sequence
                     try:
@@ -53,13 +86,38 @@ def write_markdown(md_out_file, image_out_path, md_in_file, button_sequences: [B
                     print("OUT: " + out_line.strip('\n'), file=sys.stderr)
 
 
-def update_or_replace_image_in_markdown(line, new_image_path):
+def format_srcset(image_out_path, basename, opt: ImageOpt) -> str:
+    """ Lists the image of each height, with its pixel density relative to the primary height.
+
+    Example: 'out/s_1.png 1x, out/s_1@96.png 2x'
+    """
+    return ", ".join(f"{image_out_path}/{opt.variant_basename(basename, height)}.{opt.extension()} "
+                     f"{height / opt.height:g}x"
+                     for height in opt.heights)
+
+
+def format_image_link(label, image_path, srcset=None, style=None) -> str:
+    if srcset:
+        return f'<img alt="{html.escape(label)}" src="{image_path}" srcset="{srcset}">'
+    if style:
+        return f'<img alt="{html.escape(label)}" src="{image_path}" style="{style}">'
+    return f"![{label}]({image_path})"
+
+
+def update_or_replace_image_in_markdown(line, new_image_path, srcset=None, style=None):
+    """
+    :param srcset: Optional srcset attribute value, linking with an HTML img tag instead of a Markdown link
+    :param style: Optional style attribute value, likewise, e.g. showing one image of an atlas sprite sheet
+    """
     # RegEx explanation:
     # Replace the entire image link, and capture (as '\1', etc.):
     # 1. the image label, if any, and not any extra ']' later in the line
     # 2. the image path, and not any extra ')' later in the line
     # 3. the rest of the line, after the image link
     replacement_pattern = r"!\[(.*?)\]\((.+?)\)(.+)"
+    # Or, for an img tag, previously written with srcset: the whole tag, then its label from the alt attribute
+    img_tag_pattern = r"<img\b[^>]*>"
+    img_alt_pattern = r'\balt="([^"]*)"'
 
     # IN: B1 <br> ![](img) | desc
     # OUT: 'B1 ', ' ![](img) | desc'
@@ -84,12 +142,24 @@ def update_or_replace_image_in_markdown(line, new_image_path):
             # IN: ' ![](img) | desc'
             # OUT: ' ![](new_img)'
             if re.search(r"^( )?!\[.*?]\(.+?\)[ |]?", segment, re.IGNORECASE):
-                modified_line = re.sub(replacement_pattern, fr"![\1]({new_image_path})\3", segment, re.IGNORECASE)
+                modified_line = re.sub(replacement_pattern,
+                                       lambda m: (format_image_link(m.group(1), new_image_path, srcset, style) +
+                                                  m.group(3)),
+                                       segment, re.IGNORECASE)
+            elif re.search(r"^( )?" + img_tag_pattern, segment, re.IGNORECASE):
+                # IN: ' <img alt="" src="img" srcset="img 1x, ..."> | desc'
+                # OUT: ' <img alt="" src="new_img" srcset="new_img 1x, ..."> | desc'
+                def replace_img_tag(m):
+                    alt = re.search(img_alt_pattern, m.group(0), re.IGNORECASE)
+                    label = html.unescape(alt.group(1)) if alt else ""
+                    return format_image_link(label, new_image_path, srcset, style)
+
+                modified_line = re.sub(img_tag_pattern, replace_img_tag, segment, count=1, flags=re.IGNORECASE)
             else:
                 # ... or
                 # IN: ' | desc'
                 # OUT: ' ![](new_img)'
-                modified_line = f" ![]({new_image_path}) {segment}"
+                modified_line = f" {format_image_link('', new_image_path, srcset, style)} {segment}"
 
             column_one = False
 
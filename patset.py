@@ -1,50 +1,170 @@
 import csv
 import io
 import re
-from pathlib import Path
+import sys
 
 from constants import PATTERN_FILE_DELIMITER, SEPARATOR_VALUE_WRAPPER, COMMENT_KEY, SEPARATOR_KEY, TABLE_HEADER_KEY
+from util import digest_bytes, strip_whitespace
 
+DEBUG_LOG_PATSET = False
 
-def load_values_from_csv(button_pattern_file, find_key, delimiter=PATTERN_FILE_DELIMITER):
-    result = [
-        row[1].strip().strip(SEPARATOR_VALUE_WRAPPER)
-        for row in csv.reader(io.StringIO(button_pattern_file), delimiter=delimiter)
-        if row and row[0].startswith(find_key)
-    ]
+# Pattern sets remembered by PatternSet.load, e.g. each version of a pattern file edited while watching
+PATTERN_SET_CACHE_SIZE = 8
 
-    return result
 
-
-def load_constants_from_csv(button_pattern_file: str, delimiter=PATTERN_FILE_DELIMITER) -> \
-        {re.Pattern, str}:
+class PatternSet:
     """
-    Return a dict of regular expressions and their equivalent string identifiers.
+    The rules of a pattern file, parsed once: the header of button tables, the separators of a sequence's buttons, and
+    the button patterns, with their short names. See qunmk2.patset for the format.
 
-    To be used to match button names to short-form, well-known button identifiers.
+    Loaded pattern sets are remembered by the content digest of their file, so batch, watch and server modes parse
+    and compile a pattern file once while it's unchanged. Serializable as its rules, see to_dict, e.g. pickled for
+    worker processes. Not cached on disk across runs: compiled patterns can't be stored, and compiling them again
+    from the serialized rules costs as much as parsing the file.
     """
-    constants = {}
-    for row in csv.reader(io.StringIO(button_pattern_file), delimiter=delimiter):
-        if not row or row[0].startswith((COMMENT_KEY, SEPARATOR_KEY, TABLE_HEADER_KEY)):
-            continue
+    header: str = None
+    separators: [str] = []
+    button_patterns: {re.Pattern: str} = {}
+    """ Case-insensitive pattern of each button, as written in Markdown, and its short name """
+    digest: str = None
+    """ Content digest of the pattern file, as util.digest_file """
+    split_pattern: re.Pattern = None
+    """ Any separator, the earlier listed first """
+    overlap_pattern: re.Pattern = None
+    """ A separator overlapping an earlier listed separator which it starts before, see split """
+
+    def __init__(self, header, separators: [str], button_patterns: [(str, str)], digest=None):
+        """
+        :param button_patterns: Each button's regular expression, and its short name
+        :raises ValueError: Unless patterns are unique, and separators aren't empty
+        """
+        patterns = [pattern for pattern, _ in button_patterns]
+        duplicates = sorted({pattern for pattern in patterns if patterns.count(pattern) > 1})
+        if duplicates:
+            raise ValueError(f"Duplicate button patterns: {duplicates}")
+        if not all(separators):
+            raise ValueError("Empty separator")
+
+        self.header = header
+        self.separators = list(separators)
+        self.button_patterns = {re.compile(pattern, re.IGNORECASE): short_name
+                                for pattern, short_name in button_patterns}
+        self.digest = digest
+
+        self.split_pattern = re.compile("|".join(map(re.escape, self.separators))) if self.separators else None
+        overlaps = PatternSet.overlapping_separators(self.separators)
+        self.overlap_pattern = re.compile("|".join(map(re.escape, overlaps))) if overlaps else None
+        if DEBUG_LOG_PATSET:
+            print(f"pattern set of {len(self.button_patterns)} patterns, {len(self.separators)} separators, "
+                  f"overlapping as {overlaps}", file=sys.stderr)
+
+    @staticmethod
+    def load(button_pattern_file) -> "PatternSet":
+        """
+        Reads a pattern file, parsing it only when its contents are new, see PATTERN_SET_CACHE_SIZE.
+        """
+        with open(button_pattern_file, "rb") as fin:
+            data = fin.read()
+        digest = digest_bytes(data)
+
+        pattern_set = PATTERN_SETS.pop(digest, None) or PatternSet.parse(data.decode(), digest)
+        # Most recently loaded last
+        PATTERN_SETS[digest] = pattern_set
+        while len(PATTERN_SETS) > PATTERN_SET_CACHE_SIZE:
+            del PATTERN_SETS[next(iter(PATTERN_SETS))]
+        return pattern_set
+
+    @staticmethod
+    def of(button_pattern_file) -> "PatternSet":
+        """
+        :param button_pattern_file: Pattern file to load, or a PatternSet already loaded
+        """
+        if isinstance(button_pattern_file, PatternSet):
+            return button_pattern_file
+        return PatternSet.load(button_pattern_file)
+
+    @staticmethod
+    def parse(text, digest=None, delimiter=PATTERN_FILE_DELIMITER) -> "PatternSet":
+        """
+        :raises ValueError: Unless there's exactly one header, and each other rule is a pattern and its short name
+        """
+        headers, separators, button_patterns = [], [], []
+        for row in csv.reader(io.StringIO(text), delimiter=delimiter):
+            if not row or row[0].startswith(COMMENT_KEY):
+                continue
+
+            if row[0].startswith((TABLE_HEADER_KEY, SEPARATOR_KEY)):
+                value = row[1].strip().strip(SEPARATOR_VALUE_WRAPPER)
+                (headers if row[0].startswith(TABLE_HEADER_KEY) else separators).append(value)
+            elif len(row) == 2:
+                button_patterns.append((row[0].strip(), row[1].strip()))
+            else:
+                raise ValueError(f"Expected a pattern {delimiter} short name, not: {delimiter.join(row)}")
+
+        if len(headers) != 1:
+            raise ValueError(f"Expected exactly one {TABLE_HEADER_KEY} rule, not {len(headers)}")
+        return PatternSet(headers[0].strip(), separators, button_patterns, digest)
 
-        key, value = row
-        ks = key.strip()
-        kre = re.compile(ks, re.IGNORECASE)
-        constants[kre] = value.strip()
-    return constants
+    def split(self, text) -> [str]:
+        """
+        Splits text to a sequence at every separator, stripping padding. As splitting at each separator in turn, in
+        the order listed, which a single split matches unless separators overlap, e.g. " or " and " / " in
+        "a / or b".
+        """
+        if not self.split_pattern:
+            sequence = [text]
+        elif self.overlap_pattern and self.overlap_pattern.search(text):
+            sequence = [text]
+            for separator in self.separators:
+                sequence = [part for element in sequence for part in element.split(separator)]
+        else:
+            sequence = self.split_pattern.split(text)
+
+        return strip_whitespace(sequence)
+
+    @staticmethod
+    def overlapping_separators(separators: [str]) -> [str]:
+        """
+        A single split splits at the leftmost separator, where splitting in turn splits at the earlier listed. They
+        differ only where a separator overlaps an earlier listed one, starting before it.
+
+        :return: Text of each such overlap
+        """
+        overlaps = []
+        for index, earlier in enumerate(separators):
+            for later in separators[index + 1:]:
+                # The later contains the earlier, or ends with its start
+                overlaps.extend(later for start in range(1, len(later)) if later.startswith(earlier, start))
+                overlaps.extend(later + earlier[length:] for length in range(1, min(len(later), len(earlier)))
+                                if later.endswith(earlier[:length]))
+        return list(dict.fromkeys(overlaps))
+
+    def to_dict(self) -> {}:
+        return {
+            "header": self.header,
+            "separators": self.separators,
+            "button_patterns": [[pattern.pattern, short_name] for pattern, short_name in self.button_patterns.items()],
+            "digest": self.digest,
+        }
+
+    @staticmethod
+    def from_dict(values: {}) -> "PatternSet":
+        return PatternSet(values["header"], values["separators"], values["button_patterns"], values["digest"])
+
+    def __reduce__(self):
+        return PatternSet.from_dict, (self.to_dict(),)
+
+
+PATTERN_SETS: {str: PatternSet} = {}
+""" Pattern sets loaded, by content digest """
 
 
 def patterns_to_header(button_pattern_file):
-    button_pattern_data = Path(button_pattern_file).read_text()
-    values = load_values_from_csv(button_pattern_data, TABLE_HEADER_KEY)
-    result = values[0].strip()
-    return result
+    return PatternSet.load(button_pattern_file).header
 
 
 def patterns_to_separators(button_pattern_file) -> [str]:
-    button_pattern_data = Path(button_pattern_file).read_text()
-    return load_values_from_csv(button_pattern_data, SEPARATOR_KEY)
+    return PatternSet.load(button_pattern_file).separators
 
 
 def patterns_map_to_button_name(button_pattern_file) -> {str, str}:
@@ -55,6 +175,4 @@ def patterns_map_to_button_name(button_pattern_file) -> {str, str}:
     Case-insensitive, specially handled elsewhere by code.
     Equals (=) separates the word and its value. See BUTTON_PATTERN_DELIMITER.
     """
-    pattern_to_canonical_button_name = Path(button_pattern_file).read_text()
-
-    return load_constants_from_csv(pattern_to_canonical_button_name)
+    return PatternSet.load(button_pattern_file).button_patterns
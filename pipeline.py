@@ -0,0 +1,97 @@
+import concurrent.futures
+import io
+import os
+import queue
+import sys
+import threading
+import time
+
+from stats import STATS
+
+DEBUG_LOG_PIPELINE = False
+ENABLE_WRITE_PIPELINE = True
+ENCODE_THREADS_PER_CPU = 1  # Encoders release the GIL while compressing, see WritePipeline
+QUEUED_IMAGES_PER_THREAD = 2
+
+
+class WritePipeline:
+    """
+    Encodes images in a pool of threads, and writes them from a dedicated thread, while the caller composites the
+    next images. Encoding stalls neither compositing, nor writing: a slow disk, e.g. a network mount, only delays
+    the writer.
+
+    Bounded, for backpressure and to cap memory: submitting blocks while queue_size images wait to be encoded or
+    written. Images are written in the order submitted.
+
+    Errors encoding or writing are raised by close, the first one, after the remaining images are written. Use as a
+    context manager, closing on exit.
+    """
+    encoder: concurrent.futures.ThreadPoolExecutor = None
+    images: queue.Queue = None
+    """ Images encoding, or encoded, waiting to be written: the future of their bytes, filename and callback """
+    writer: threading.Thread = None
+    error: Exception = None
+
+    def __init__(self, encode_threads=None, queue_size=None):
+        encode_threads = encode_threads or max(1, int(os.cpu_count() * ENCODE_THREADS_PER_CPU))
+        self.encoder = concurrent.futures.ThreadPoolExecutor(max_workers=encode_threads)
+        self.images = queue.Queue(maxsize=queue_size or encode_threads * QUEUED_IMAGES_PER_THREAD)
+        self.error = None
+        self.writer = threading.Thread(target=self.write_images, name="write_images", daemon=True)
+        self.writer.start()
+
+    def submit(self, encode, filename, on_written=None):
+        """
+        :param encode: Encodes the image into a file object, e.g. lambda fout: save_png(image, fout, png). Called
+        by an encoding thread, so mustn't modify anything shared.
+        :param on_written: Optional callback, once the file is written, e.g. recording it in an ImageCache. Called
+        by the writer thread, one at a time.
+        """
+        if self.images.full():
+            STATS.count("pipeline_full")
+        start_time = time.perf_counter()
+        self.images.put((self.encoder.submit(encode_bytes, encode), filename, on_written))
+        STATS.record_latency("pipeline_submit", time.perf_counter() - start_time)
+
+    def write_images(self):
+        while True:
+            image = self.images.get()
+            if image is None:
+                return
+
+            future, filename, on_written = image
+            try:
+                data = future.result()
+                with open(filename, "wb") as fout:
+                    fout.write(data)
+                if on_written:
+                    on_written()
+                if DEBUG_LOG_PIPELINE:
+                    print(f"wrote {filename}, {len(data)} bytes", file=sys.stderr)
+            except Exception as e:
+                self.error = self.error or e
+
+    def close(self):
+        """ Waits for every image submitted to be written, then raises the first error, if any """
+        self.images.put(None)
+        self.writer.join()
+        self.encoder.shutdown()
+        if self.error:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except Exception:
+            # Raise the caller's error, rather than the pipeline's
+            if exc_type is None:
+                raise
+
+
+def encode_bytes(encode) -> bytes:
+    output = io.BytesIO()
+    encode(output)
+    return output.getvalue()
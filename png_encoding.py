@@ -0,0 +1,33 @@
+import io
+import os
+
+from PIL import Image
+
+from stats import STATS
+from util import PngOpt
+
+
+def save_png(image: Image, filename, png: PngOpt):
+    """
+    Writes the image as PNG, encoded as png sets. With png.measure_saved, counts bytes saved, compared to Pillow's
+    defaults, as "bytes_saved.png". Negative when larger.
+
+    :param filename: Or a file object
+    """
+    encoded = image
+    if png.colors:
+        # Palette with alpha, written with a tRNS chunk
+        encoded = image.convert("RGBA").quantize(png.colors, method=Image.Quantize.FASTOCTREE,
+                                                 dither=Image.Dither.NONE)
+    if png.strip:
+        # Metadata, e.g. the ICC profile, is copied from the first layer by compositing
+        encoded = encoded.copy() if encoded is image else encoded
+        encoded.info = {}
+
+    encoded.save(filename, format="PNG", compress_level=png.compress_level, optimize=png.optimize)
+
+    if png.measure_saved and not png.is_default():
+        default_encoded = io.BytesIO()
+        image.save(default_encoded, format="PNG")
+        encoded_size = filename.tell() if hasattr(filename, "tell") else os.path.getsize(filename)
+        STATS.count("bytes_saved.png", default_encoded.tell() - encoded_size)
@@ -1,11 +1,22 @@
 import concurrent.futures
+import contextlib
+import csv
+import functools
 import os
+import re
 import sys
+import time
 
+from PIL import Image
 from psd_tools import PSDImage
 
-from constants import BG_LAYER_NAME, SHORT_NAME_INFIX_SEPARATOR, THREADS_PER_CPU
-from util import make_out_dir, size_from_height
+from constants import BG_LAYER_NAME, SHORT_NAME_INFIX_SEPARATOR, THREADS_PER_CPU, PSD_EXPORT_VERSION, \
+    PSD_EXPORT_CSV_HEADERS
+from image_cache import ImageCache
+from pipeline import WritePipeline, ENABLE_WRITE_PIPELINE
+from png_encoding import save_png
+from stats import STATS
+from util import make_out_dir, size_from_height, digest_file, digest_values, ImageOpt
 
 # For debugging generating
 DEBUG_LOG_PSD = True
@@ -14,6 +25,8 @@ DEBUG_LOG_PSD = True
 class PSDInMd:
     bbox = None
     psd = None
+    layer_index: {str: set} = {}
+    """ Component to the layers it makes visible, see index_layers """
 
     def can_find_layer_for_any_shortname(self, layer, match_components) -> bool:
         """
@@ -52,6 +65,51 @@ class PSDInMd:
 
         return False
 
+    def index_layers(self):
+        """
+        Walks the PSD once, mapping each component to the set of layers which it makes visible, exactly as
+        can_find_layer_for_any_shortname decides. Then the layers of any components are a union of sets.
+        """
+        self.layer_index = {}
+        components_by_layer = {}
+        for layer in self.psd.descendants():
+            for component in PSDInMd.layer_components(layer, components_by_layer):
+                self.layer_index.setdefault(component, set()).add(layer)
+
+        if DEBUG_LOG_PSD:
+            print(f"indexed {len(components_by_layer)} layers by {len(self.layer_index)} components", file=sys.stderr)
+
+    @staticmethod
+    def layer_components(layer, components_by_layer) -> {str}:
+        """
+        :return: Components any of which make the layer visible. A named layer's own component, and its group's.
+        An unnamed layer's group's component, and, recursively, the components of the group itself.
+        :param components_by_layer: Memo of earlier results, as groups precede their layers
+        """
+        if layer in components_by_layer:
+            return components_by_layer[layer]
+
+        parent = layer.parent
+        parent_components = set()
+        if parent and parent.kind == 'group' and parent.name:
+            parent_components.add(parent.name.split('-')[-1].strip())
+
+        if layer.name:
+            result = {layer.name.split('-')[-1].strip()} | parent_components
+        elif parent:
+            result = parent_components | PSDInMd.layer_components(parent, components_by_layer)
+        else:
+            result = set()
+
+        components_by_layer[layer] = result
+        return result
+
+    def find_layers(self, components) -> set:
+        """
+        :return: Layers to composite for the components
+        """
+        return set().union(*(self.layer_index.get(component, ()) for component in components))
+
     def find_bbox(self):
         for layer in self.psd.descendants():
             if DEBUG_LOG_PSD:
@@ -63,21 +121,63 @@ class PSDInMd:
             print(f"Warning: Bounding box layer {BG_LAYER_NAME} not found. Output images will be full size.")
             self.bbox = self.psd.bbox
 
-    def process_psd(self, out_dirname, psd_filename, basenames, height):
+    def process_psd(self, out_dirname, psd_filename, basenames, opt: ImageOpt, force=False, jobs=None):
         """
-        Writes image files named using the basenames and placed in the out_dirname.
+        Writes PNG image files named using the basenames and placed in the out_dirname, for each height in opt.
         Images are composited from the PSD file according to substrings of the basenames, called "components".
         PSD has named layers, and the basenames are formatted to reference the layer names.
         Break the basenames apart (into "components") then search for matching layers, then composite that all into an
         image.
+
+        :param jobs: Number of worker processes compositing images, each opening the PSD once. When not given,
+        threads of this process, THREADS_PER_CPU per CPU.
         """
         make_out_dir(out_dirname)
+        cache = ImageCache(out_dirname, force)
 
+        # Avoid redundant image generation. Uniquify the list of basenames.
+        unique_basenames = list(set(basenames))
+
+        # Avoid regenerating images from an unchanged PSD, across runs
+        psd_digest = digest_file(psd_filename)
+        keys = {}
+        for basename in unique_basenames:
+            for height in opt.heights:
+                key = digest_values(basename, psd_digest, height, *opt.png.key())
+                if not cache.is_fresh(PSDInMd.image_filename(out_dirname, basename, opt, height), key):
+                    keys.setdefault(basename, {})[height] = key
+
+        if not keys:
+            STATS.count("images_skipped", cache.hits)
+            print(f"composited 0 images, skipped {cache.hits} unchanged")
+            return
+
+        try:
+            if jobs:
+                self.process_images_in_pool(out_dirname, psd_filename, keys, opt, cache, jobs)
+            else:
+                self.process_images_in_threads(out_dirname, psd_filename, keys, opt, cache)
+        finally:
+            cache.save()
+
+        STATS.count("images_composited", cache.misses)
+        STATS.count("images_skipped", cache.hits)
+        print(f"composited {cache.misses} images, skipped {cache.hits} unchanged")
+
+    def load_psd(self, psd_filename):
         self.psd = PSDImage.open(psd_filename)
         self.find_bbox()
+        self.index_layers()
 
-        # Avoid redundant image generation. Uniquify the list of basenames.
-        unique_basenames = list(set(basenames))
+    def process_images_in_threads(self, out_dirname, psd_filename, keys: {str: {int: str}}, opt: ImageOpt,
+                                  cache: ImageCache):
+        """
+        Composites in threads sharing the PSD. Scaling is limited by the GIL, see process_images_in_pool.
+        Images are encoded and written by a pipeline, while the threads composite the next.
+        Records each image written, and raises the first error after the remaining images finish.
+        """
+        with STATS.stage("load_psd"):
+            self.load_psd(psd_filename)
 
         # Performance metrics for posterity: 10-core, MacBook Pro, 16-inch, 2021, Apple M1 Pro, 16GB, Sonoma 14.4.1
         #  Threads:  2, 189% cpu, 2:31.85 total
@@ -87,18 +187,155 @@ class PSDInMd:
         #  Threads: 10, 530% cpu, 1:19.63 total
         #  Threads: 12, 418% cpu, 1:47.42 total
         #  Threads: 20, 389% cpu, 2:36.09 total
-        decent_performance = int(os.cpu_count() * THREADS_PER_CPU)
+        decent_performance = max(1, int(os.cpu_count() * THREADS_PER_CPU))
         if DEBUG_LOG_PSD:
             print(f"thread count: {decent_performance}", file=sys.stderr)
 
-        pool = concurrent.futures.ThreadPoolExecutor(max_workers=decent_performance)
+        keys_by_filename = PSDInMd.keys_by_filename(out_dirname, keys, opt)
+        with WritePipeline() if ENABLE_WRITE_PIPELINE else contextlib.nullcontext() as pipeline:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=decent_performance) as pool:
+                futures = [pool.submit(self.composite_image, basename, opt, list(keys[basename]), out_dirname,
+                                       pipeline, lambda filename: cache.record(filename, keys_by_filename[filename]))
+                           for basename in keys]
 
-        for basename in unique_basenames:
-            pool.submit(self.composite_image, basename, height, out_dirname)
+            error = next((future.exception() for future in futures if future.exception()), None)
+            if error:
+                raise error
+
+    def process_images_in_pool(self, out_dirname, psd_filename, keys: {str: {int: str}}, opt: ImageOpt,
+                               cache: ImageCache, jobs):
+        """
+        Composites in worker processes, avoiding the GIL. Each worker opens and indexes the PSD once, then composites
+        a share of the basenames, handed out as workers become free. With one job, composites in this process.
+        Records each image written, and raises the first error after the remaining images finish.
+        """
+        if jobs == 1 or len(keys) == 1:
+            with STATS.stage("load_psd"):
+                self.load_psd(psd_filename)
 
-        pool.shutdown(wait=True)
+            keys_by_filename = PSDInMd.keys_by_filename(out_dirname, keys, opt)
+            error = None
+            with WritePipeline() if ENABLE_WRITE_PIPELINE else contextlib.nullcontext() as pipeline:
+                for basename, heights in keys.items():
+                    try:
+                        self.composite_image(basename, opt, list(heights), out_dirname, pipeline,
+                                             lambda filename: cache.record(filename, keys_by_filename[filename]))
+                    except Exception as e:
+                        error = error or e
+                if error:
+                    raise error
+            return
+
+        if DEBUG_LOG_PSD:
+            print(f"process count: {jobs}", file=sys.stderr)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                                    initargs=(psd_filename,)) as pool:
+            futures = [(pool.submit(composite_image_in_worker, basename, opt, list(heights), out_dirname), basename)
+                       for basename, heights in keys.items()]
+
+            error = None
+            for future, basename in futures:
+                try:
+                    STATS.merge(future.result())
+                    PSDInMd.record_heights(cache, out_dirname, basename, opt, keys[basename])
+                except Exception as e:
+                    error = error or e
+
+            if error:
+                raise error
+
+    @staticmethod
+    def record_heights(cache: ImageCache, out_dirname, basename, opt: ImageOpt, keys: {int: str}):
+        for height, key in keys.items():
+            cache.record(PSDInMd.image_filename(out_dirname, basename, opt, height), key)
+
+    @staticmethod
+    def keys_by_filename(out_dirname, keys: {str: {int: str}}, opt: ImageOpt) -> {str: str}:
+        """ Cache keys of the images to write, by basename then height, rekeyed by image filename """
+        return {PSDInMd.image_filename(out_dirname, basename, opt, height): key
+                for basename, heights in keys.items() for height, key in heights.items()}
+
+    def export_imageset(self, psd_filename, imageset_filename, imageset_dir, force=False) -> bool:
+        """
+        Exports the PSD as an imageset, for ImageSet.load_imageset: a PNG of each component's layers, cropped to
+        their pixels, and a CSV of their offsets within the BG bounding box. The BG image is not cropped.
+        Skipped while the PSD is unchanged since its last export.
+
+        Compositing an imageset stacks layers in sequence order, rather than PSD order, so overlapping components
+        may differ from the psd sub-command.
+
+        :return: Whether exported, rather than skipped
+        """
+        make_out_dir(imageset_dir)
+        cache = ImageCache(imageset_dir, force)
+        key = digest_values(digest_file(psd_filename), PSD_EXPORT_VERSION)
+        if cache.is_fresh(imageset_filename, key):
+            print(f"PSD unchanged since exported to {imageset_filename}, skipped")
+            return False
+
+        with STATS.stage("load_psd"):
+            self.load_psd(psd_filename)
+
+        size = (self.bbox[2] - self.bbox[0], self.bbox[3] - self.bbox[1])
+        rows = []
+        image_filenames = set()
+        # BG first, the imageset's canvas
+        for component in sorted(self.layer_index, key=lambda name: (name != BG_LAYER_NAME, name)):
+            layers = self.layer_index[component]
+            image = self.psd.composite(viewport=self.bbox,
+                                       layer_filter=lambda candidate_layer: candidate_layer in layers).convert("RGBA")
+
+            box = (0, 0) + size if component == BG_LAYER_NAME else image.getchannel("A").getbbox()
+            if not box:
+                # Nothing visible
+                continue
+
+            image_filename = PSDInMd.export_filename(component, image_filenames)
+            image.crop(box).save(os.path.join(imageset_dir, image_filename), format="PNG")
+            rows.append([image_filename, component, box[0], box[1], box[2] - box[0], box[3] - box[1]])
+
+        if BG_LAYER_NAME not in self.layer_index:
+            image_filename = PSDInMd.export_filename(BG_LAYER_NAME, image_filenames)
+            Image.new("RGBA", size).save(os.path.join(imageset_dir, image_filename), format="PNG")
+            rows.insert(0, [image_filename, BG_LAYER_NAME, 0, 0, *size])
+
+        with open(imageset_filename, "w", newline="") as fout:
+            writer = csv.writer(fout)
+            writer.writerow(PSD_EXPORT_CSV_HEADERS)
+            writer.writerows(rows)
+
+        cache.record(imageset_filename, key)
+        cache.save()
+
+        print(f"exported {len(rows)} layers to {imageset_filename}")
+        return True
+
+    @staticmethod
+    def export_filename(component, image_filenames: {str}) -> str:
+        """ A PNG filename for the component, safe for any file system, and unique among image_filenames. """
+        name = re.sub(r"[^\w.-]", "_", component) or "layer"
+        image_filename = f"{name}.png"
+        suffix = 1
+        while image_filename.lower() in image_filenames:
+            suffix += 1
+            image_filename = f"{name}-{suffix}.png"
+        image_filenames.add(image_filename.lower())
+        return image_filename
+
+    @staticmethod
+    def image_filename(out_dirname, basename, opt: ImageOpt, height) -> str:
+        return f'{out_dirname}/{opt.variant_basename(basename, height)}.png'
+
+    def composite_image(self, basename, opt: ImageOpt, heights, out_dirname, pipeline: WritePipeline = None,
+                        on_written=None):
+        """ Composites once, then writes a resized image for each height.
+
+        :param pipeline: Optional pipeline encoding and writing the images, returning once they're submitted
+        :param on_written: Optional callback, with the filename of each image once written
+        """
+        start_time = time.perf_counter()
 
-    def composite_image(self, basename, height, out_dirname):
         # Prepare the component names to be matched with layers.
         #  - Remove separators, and separate digits.
         # E.g. 'lplay_12345' -> ['lplay', '1', '2', '3', '4', '5']
@@ -114,11 +351,47 @@ class PSDInMd:
 
         # Always render the background layer.
         components = components + [BG_LAYER_NAME]
-        image = self.psd.composite(
-            viewport=self.bbox,
-            layer_filter=lambda candidate_layer: self.can_find_layer_for_any_shortname(candidate_layer, components))
+        layers = self.find_layers(components)
+        image = self.psd.composite(viewport=self.bbox, layer_filter=lambda candidate_layer: candidate_layer in layers)
+
+        for height in heights:
+            new_size = size_from_height(height, image.size)
+            resized_image = image.resize(new_size)
+
+            image_filename = PSDInMd.image_filename(out_dirname, basename, opt, height)
+            encode = functools.partial(save_png, resized_image, png=opt.png)
+            written = functools.partial(PSDInMd.record_written, image_filename, on_written)
+            if pipeline:
+                pipeline.submit(encode, image_filename, written)
+            else:
+                encode(image_filename)
+                written()
+
+        STATS.record_latency("render_image", time.perf_counter() - start_time)
+
+    @staticmethod
+    def record_written(image_filename, on_written=None):
+        STATS.record_written("png", image_filename)
+        if on_written:
+            on_written(image_filename)
+
+
+# Worker process state, for PSDInMd.process_images_in_pool. Opened once per worker by its initializer.
+worker_psd_in_md: PSDInMd = None
+
+
+def init_worker(psd_filename):
+    global worker_psd_in_md
+    worker_psd_in_md = PSDInMd()
+    worker_psd_in_md.load_psd(psd_filename)
 
-        new_size = size_from_height(height, image.size)
-        resized_image = image.resize(new_size)
 
-        resized_image.save(f'{out_dirname}/{basename}.png', format="PNG")
+def composite_image_in_worker(basename, opt: ImageOpt, heights, out_dirname) -> {}:
+    """
+    :return: Stats of this image, to merge into the caller's
+    """
+    STATS.reset()
+    # Workers encode in parallel already, one encoding thread overlaps compositing and writing
+    with WritePipeline(encode_threads=1) if ENABLE_WRITE_PIPELINE else contextlib.nullcontext() as pipeline:
+        worker_psd_in_md.composite_image(basename, opt, heights, out_dirname, pipeline)
+    return STATS.snapshot()
@@ -0,0 +1,289 @@
+import collections
+import concurrent.futures
+import http.server
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+from button_sequence import ButtonSequence
+from constants import PNG_IMAGE_EXTENSION, GIF_IMAGE_EXTENSION, APNG_IMAGE_EXTENSION, WEBP_IMAGE_EXTENSION, \
+    ANIMATION_FORMATS
+from imageset_gen import ImageSet
+from pipeline import encode_bytes
+from stats import STATS
+from util import ImageOpt
+from watch import WatchSession, watch, watched_paths
+
+DEBUG_LOG_SERVER = False
+
+CONTENT_TYPES = {
+    PNG_IMAGE_EXTENSION: "image/png",
+    GIF_IMAGE_EXTENSION: "image/gif",
+    APNG_IMAGE_EXTENSION: "image/apng",
+    WEBP_IMAGE_EXTENSION: "image/webp",
+}
+# E.g. '/s_1.png'
+IMAGE_PATH_PATTERN = re.compile(r"^/([^/.]+)\.([a-z]+)$")
+HEIGHT_PARAMETER = "h"
+
+
+class ByteCache:
+    """
+    Encoded images, evicting the least recently used beyond max_bytes in total. Safe to use from several threads.
+    """
+    max_bytes: int = 0
+    entries: collections.OrderedDict = None
+    """ Bytes of each image, by key, least recently used first """
+    size: int = 0
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def get(self, key) -> bytes:
+        """
+        :return: The image's bytes, or None if not cached
+        """
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            STATS.count("server_cache_hits" if data is not None else "server_cache_misses")
+            return data
+
+    def put(self, key, data: bytes):
+        """ Caches an image, unless larger than the whole cache """
+        if len(data) > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                STATS.count("server_cache_evictions")
+
+
+class ImageServer:
+    """
+    Renders images of an imageset on request, for previewing documents without generating every image first.
+
+    Renders only the images requested, as ImageSet.process_image would write them. Concurrent requests for the same
+    image wait for a single render. Encoded images are kept in a ByteCache, and served with their image key as ETag:
+    the digest of all their inputs, see ImageSet.image_key, so a client's copy is revalidated without rendering.
+    """
+    imageset: ImageSet = None
+    """ Imageset served, replaced as a whole when reloaded: each request renders from the one it started with """
+    opt: ImageOpt = None
+    cache: ByteCache = None
+    rendering: {str: concurrent.futures.Future} = {}
+    """ Renders in progress, by image key """
+
+    def __init__(self, imageset: ImageSet, opt: ImageOpt, cache_bytes):
+        """
+        :param imageset: Imageset with its layers loaded
+        :param opt: Rendering options, and the heights served, the first by default
+        """
+        self.opt = opt
+        self.cache = ByteCache(cache_bytes)
+        self.rendering = {}
+        self.lock = threading.Lock()
+        self.replace_imageset(imageset)
+
+    def load(self, imageset_filename, imageset_dir):
+        """ Loads the imageset again, e.g. once its files changed, see replace_imageset. """
+        imageset = ImageSet()
+        imageset.all_layers = imageset.load_imageset(imageset_filename, imageset_dir)
+        self.replace_imageset(imageset)
+
+    def replace_imageset(self, imageset: ImageSet):
+        """ Serves from an imageset, once its caches are filled for every height served. ImageSet fills them lazily,
+        which requests' threads would otherwise do at once, duplicating the work.
+        """
+        for height in self.opt.heights:
+            variant = self.variant(PNG_IMAGE_EXTENSION, height)
+            imageset.scaled_background(variant)
+            imageset.compositor_for(variant).prepare(imageset.layers_for(variant).values())
+        imageset.gif_palette()
+
+        self.imageset = imageset
+        self.cache.clear()
+
+    def variant(self, extension, height) -> ImageOpt:
+        animated = extension in ANIMATION_FORMATS
+        return ImageOpt(height, animated, self.opt.prescale, self.opt.resample,
+                        animation_format=extension if animated else self.opt.animation_format, png=self.opt.png,
+                        compositor=self.opt.compositor)
+
+    @staticmethod
+    def image_key(imageset: ImageSet, basename, variant: ImageOpt) -> str:
+        """
+        :return: The image's key, or None if the imageset has no layer of one of its names
+        """
+        try:
+            return imageset.image_key(basename, variant)
+        except KeyError:
+            return None
+
+    def image(self, imageset: ImageSet, basename, variant: ImageOpt, key) -> bytes:
+        """
+        :param imageset: The imageset the key is of
+        :param key: The image's key, see image_key
+        :return: The encoded image, cached, or rendered once for all concurrent requests
+        """
+        with self.lock:
+            data = self.cache.get(key)
+            if data is not None:
+                return data
+
+            future = self.rendering.get(key)
+            renders = future is None
+            if renders:
+                future = self.rendering[key] = concurrent.futures.Future()
+            else:
+                STATS.count("server_renders_coalesced")
+
+        if not renders:
+            return future.result()
+
+        try:
+            data = self.render(imageset, basename, variant)
+            self.cache.put(key, data)
+            future.set_result(data)
+            return data
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.rendering[key]
+
+    @staticmethod
+    def render(imageset: ImageSet, basename, variant: ImageOpt) -> bytes:
+        start_time = time.perf_counter()
+        # Rendering reads only the sequence's basename
+        sequence = ButtonSequence([{basename: basename}], 0)
+        [(_, images, durations)] = imageset.render_variants(sequence, variant, [variant])
+        data = encode_bytes(imageset.encoder(variant, images, durations))
+
+        STATS.count("images_composited")
+        STATS.record_latency("render_image", time.perf_counter() - start_time)
+        if DEBUG_LOG_SERVER:
+            print(f"rendered {basename}.{variant.extension()}, {variant.height} high, {len(data)} bytes",
+                  file=sys.stderr)
+        return data
+
+
+class ImageRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves GET and HEAD requests for '/<basename>.<png|gif|apng|webp>', and optionally '?h=<height>', one of the
+    served heights.
+    """
+    server_version = "mdpicgen"
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def respond(self, send_body):
+        image_server: ImageServer = self.server.image_server
+        url = urllib.parse.urlsplit(self.path)
+        path_match = IMAGE_PATH_PATTERN.match(urllib.parse.unquote(url.path))
+        if not path_match or path_match[2] not in CONTENT_TYPES:
+            self.send_error(404, "Expected /<basename>.<png|gif|apng|webp>")
+            return
+        basename, extension = path_match.groups()
+
+        heights = urllib.parse.parse_qs(url.query).get(HEIGHT_PARAMETER, [str(image_server.opt.height)])
+        if heights[-1] not in [str(height) for height in image_server.opt.heights]:
+            self.send_error(400, f"Height must be one of {image_server.opt.heights}")
+            return
+
+        variant = image_server.variant(extension, int(heights[-1]))
+        imageset = image_server.imageset
+        key = ImageServer.image_key(imageset, basename, variant)
+        if not key:
+            self.send_error(404, f"No layers for image {basename}")
+            return
+
+        etag = f'"{key}"'
+        if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            STATS.count("server_not_modified")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        try:
+            data = image_server.image(imageset, basename, variant, key)
+        except Exception as e:
+            print(f"Error rendering {self.path}: {e}", file=sys.stderr)
+            self.send_error(500, "Error rendering image")
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPES[extension])
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        # Revalidate each time, as the imageset is reloaded when changed
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if DEBUG_LOG_SERVER:
+            super().log_message(format, *args)
+
+
+def serve(imageset_filename, imageset_dir, opt: ImageOpt, host, port, cache_bytes, interval):
+    """
+    Serves images rendered on request, see ImageServer, from a thread per request, until interrupted. Reloads the
+    imageset whenever its CSV, or any file in its directory, changes, see watch.
+
+    :param interval: Seconds between checks for changes of the imageset
+    """
+    imageset = ImageSet()
+    imageset.all_layers = imageset.load_imageset(imageset_filename, imageset_dir)
+    image_server = ImageServer(imageset, opt, cache_bytes)
+
+    session = WatchSession()
+
+    def reload(changed_paths):
+        # The first run, of every path, finds the imageset just loaded
+        if session.run_count and session.is_imageset_changed(changed_paths, imageset_filename, imageset_dir):
+            try:
+                image_server.load(imageset_filename, imageset_dir)
+                print(f"reloaded {imageset_filename}")
+            except Exception as e:
+                # Keep serving the previous imageset, the next edit may fix it
+                print(f"Error reloading imageset: {e}", file=sys.stderr)
+        session.run_count += 1
+
+    threading.Thread(target=watch, args=(lambda: watched_paths([imageset_filename], [imageset_dir]), reload,
+                                         interval), daemon=True).start()
+
+    httpd = http.server.ThreadingHTTPServer((host, port), ImageRequestHandler)
+    httpd.image_server = image_server
+    print(f"serving images of {imageset_filename} at http://{host}:{httpd.server_port}/<basename>.<format>"
+          f"?{HEIGHT_PARAMETER}={opt.height}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
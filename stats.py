@@ -0,0 +1,149 @@
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+
+# Percentiles of latencies, in the report
+LATENCY_PERCENTILES = [50, 90, 99]
+
+
+class Stats:
+    """
+    Timings and counters of a run, reported with --stats.
+
+    Stages record wall and CPU time, in total and per document. Counters accumulate, e.g. bytes written per format.
+    Latencies keep every sample, for percentiles, e.g. of each image rendered.
+
+    Worker processes record into their own Stats, which their caller merges from a snapshot, so CPU time of a stage
+    in this process excludes its workers. Worker threads share this process's Stats.
+    """
+    stages: {str: {str: float}} = {}
+    documents: {str: {str: float}} = {}
+    counters: {str: int} = {}
+    latencies: {str: [float]} = {}
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.documents = {}
+        self.counters = {}
+        self.latencies = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, document=None):
+        """ Times the body as a stage, and also for the document when given. """
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - wall_start, time.process_time() - cpu_start, document)
+
+    def add_stage(self, name, wall_seconds, cpu_seconds, document=None, calls=1):
+        with self.lock:
+            stage = self.stages.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "calls": 0})
+            stage["wall_seconds"] += wall_seconds
+            stage["cpu_seconds"] += cpu_seconds
+            stage["calls"] += calls
+
+        if document:
+            self.add_stage_document(document, name, wall_seconds)
+
+    def add_stage_document(self, document, name, wall_seconds):
+        with self.lock:
+            document_stages = self.documents.setdefault(document, {})
+            document_stages[name] = document_stages.get(name, 0.0) + wall_seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_latency(self, name, seconds):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+
+    def record_written(self, image_format, filename):
+        """ Counts a file, and its bytes, written in the format. """
+        self.count(f"files_written.{image_format}")
+        self.count(f"bytes_written.{image_format}", os.path.getsize(filename))
+
+    def snapshot(self) -> {}:
+        """
+        :return: Raw contents, to merge into another Stats, e.g. from a worker process
+        """
+        return {"stages": self.stages, "documents": self.documents, "counters": self.counters,
+                "latencies": self.latencies}
+
+    def merge(self, snapshot: {}):
+        for name, stage in snapshot["stages"].items():
+            self.add_stage(name, stage["wall_seconds"], stage["cpu_seconds"], calls=stage["calls"])
+        for document, document_stages in snapshot["documents"].items():
+            for name, wall_seconds in document_stages.items():
+                self.add_stage_document(document, name, wall_seconds)
+        for name, value in snapshot["counters"].items():
+            self.count(name, value)
+        for name, samples in snapshot["latencies"].items():
+            for seconds in samples:
+                self.record_latency(name, seconds)
+
+    @staticmethod
+    def percentiles(samples: [float]) -> {str: float}:
+        """ Nearest-rank percentiles, and the count and maximum. """
+        ordered = sorted(samples)
+        result = {"count": len(ordered)}
+        for percentile in LATENCY_PERCENTILES:
+            result[f"p{percentile}"] = ordered[max(0, math.ceil(percentile / 100 * len(ordered)) - 1)]
+        result["max"] = ordered[-1]
+        return result
+
+    def to_dict(self) -> {}:
+        """
+        :return: JSON-serializable report, documents ordered by their total time, slowest first
+        """
+        documents = sorted(self.documents.items(), key=lambda item: sum(item[1].values()), reverse=True)
+        return {
+            "stages": self.stages,
+            "documents": {document: stages for document, stages in documents},
+            "counters": dict(sorted(self.counters.items())),
+            "latencies": {name: Stats.percentiles(samples) for name, samples in self.latencies.items() if samples},
+        }
+
+    def report(self) -> str:
+        """
+        :return: Human-readable summary
+        """
+        report = self.to_dict()
+        lines = ["stats:", f"  {'stage':<20} {'wall s':>9} {'cpu s':>9} {'calls':>7}"]
+        for name, stage in report["stages"].items():
+            lines.append(f"  {name:<20} {stage['wall_seconds']:>9.3f} {stage['cpu_seconds']:>9.3f} "
+                         f"{stage['calls']:>7}")
+
+        if report["counters"]:
+            lines.append("  counters:")
+            lines.extend(f"    {name}: {value}" for name, value in report["counters"].items())
+
+        for name, latency in report["latencies"].items():
+            percentiles = ", ".join(f"p{percentile} {latency[f'p{percentile}'] * 1000:.1f}ms"
+                                    for percentile in LATENCY_PERCENTILES)
+            lines.append(f"  {name} latency: {percentiles}, max {latency['max'] * 1000:.1f}ms "
+                         f"({latency['count']} samples)")
+
+        if len(report["documents"]) > 1:
+            lines.append("  slowest documents:")
+            lines.extend(f"    {sum(stages.values()):.3f}s {document}"
+                         for document, stages in list(report["documents"].items())[:10])
+
+        return "\n".join(lines)
+
+    def write_json(self, filename):
+        with open(filename, "w") as fout:
+            json.dump(self.to_dict(), fout, indent=2)
+
+
+# Statistics of this process
+STATS = Stats()
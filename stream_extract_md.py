@@ -0,0 +1,266 @@
+import re
+import sys
+
+from mistletoe.block_token import Document, Table
+from mistletoe.markdown_renderer import MarkdownRenderer
+
+from button_sequence import ButtonSequence
+from extract_md import ExtractButtonsFromMarkdown
+
+# For debugging parsing
+DEBUG_LOG_STREAM = False
+
+# As mistletoe.block_token.TableRow: cells split on unescaped pipes
+CELL_SPLIT_PATTERN = re.compile(r"(?<!\\)\|")
+# Text which mistletoe might parse as anything other than plain text: escapes, entities, emphasis, code, HTML,
+# strikethrough, images, links. Bracketed text alone, e.g. "[1-8]", is plain text.
+AMBIGUOUS_TEXT_PATTERN = re.compile(r"[\\`*_&<>]|~~|!\[|\]\(|\]\[|\]:")
+BR_TAG_PATTERN = re.compile(r"<br/?>", re.IGNORECASE)
+# Lines starting any block other than a paragraph, or a table: headings, quotes, HTML, link reference definitions,
+# fenced and indented code, lists, thematic breaks and setext underlines.
+NON_PARAGRAPH_LINE_PATTERN = re.compile(r"^(?: {0,3}(?:[#>\[<]|```|~~~|[-+*](?:\s|$)|\d{1,9}[.)](?:\s|$)|"
+                                        r"(?:[-*_=]\s*){3,}$|=+\s*$)| {4}|\t)")
+LIST_ITEM_PATTERN = re.compile(r"^ {0,3}(?:[-+*]|\d{1,9}[.)])(?:\s|$)")
+FENCE_PATTERN = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+# HTML blocks which, unlike others, continue past blank lines: their start, and end, patterns
+HTML_BLOCK_PATTERNS = [
+    (re.compile(r"^ {0,3}<(?:script|pre|style|textarea)(?:\s|>|$)", re.IGNORECASE),
+     re.compile(r"</(?:script|pre|style|textarea)>", re.IGNORECASE)),
+    (re.compile(r"^ {0,3}<!--"), re.compile(r"-->")),
+    (re.compile(r"^ {0,3}<\?"), re.compile(r"\?>")),
+    (re.compile(r"^ {0,3}<![A-Za-z]"), re.compile(r">")),
+    (re.compile(r"^ {0,3}<!\[CDATA\["), re.compile(r"]]>")),
+]
+
+
+def stream_button_sequences(md_file, but_pat_file):
+    """
+    Extract button command sequences from Markdown following a set of patterns, as extract_button_sequences does,
+    reading the Markdown line by line.
+
+    :return: Generator of ButtonSequence, in document order
+    """
+    extractor = StreamButtonsFromMarkdown(but_pat_file)
+    yield from extractor.stream(md_file)
+
+    if DEBUG_LOG_STREAM:
+        print(f"rejected: {len(extractor.could_not_find)}, "
+              f"blocks parsed by mistletoe: {extractor.fallback_count}", file=sys.stderr)
+
+
+class StreamButtonsFromMarkdown(ExtractButtonsFromMarkdown):
+    """
+    Extracts button command sequences from tables in Markdown, without parsing the whole document.
+
+    Reads a block of lines at a time, up to a blank line, and recognizes GFM tables and the structure of their first
+    cells directly. Memory is bounded by the largest block, rather than the document.
+
+    Blocks which aren't plain paragraphs and tables, e.g. lists, quotes or HTML, and cells with text which might not
+    be plain, are parsed by mistletoe instead, so results match ExtractButtonsFromMarkdown. Except: link reference
+    definitions apply only within their own block, because later definitions are not yet read.
+    """
+    fallback_count: int = 0
+    """ Blocks and tables parsed by mistletoe """
+
+    def __init__(self, button_pattern_file):
+        self.load_patterns(button_pattern_file)
+        self.header_lower = self.header.lower()
+        self.fallback_count = 0
+
+    def stream(self, markdown_filename):
+        with open(markdown_filename, "r") as fin:
+            yield from self.extract_lines(fin)
+
+    def extract_lines(self, lines):
+        """
+        :param lines: Iterable of Markdown lines
+        :return: Generator of ButtonSequence
+        """
+        block = []
+        block_start = 1
+        fence = None
+        html_end = None
+        # Lines since the start of the last list, as tables indented after a blank line may belong to the list
+        list_context = []
+        list_start = None
+
+        for line_number, line in enumerate(lines, start=1):
+            if not block:
+                block_start = line_number
+
+            if fence or html_end:
+                # Inside a multi-line construct, which continues past blank lines
+                block.append(line)
+                if fence and re.match(rf"^ {{0,3}}{fence[0]}{{{len(fence)},}}\s*$", line):
+                    fence = None
+                elif html_end and html_end.search(line):
+                    html_end = None
+                continue
+
+            if line.strip():
+                block.append(line)
+                fence, html_end = StreamButtonsFromMarkdown.opened_construct(line)
+                continue
+
+            # A blank line ends the block
+            if block:
+                list_start, list_context = self.update_list_context(block, block_start, list_start, list_context)
+                yield from self.extract_block(block, block_start, list_start, list_context)
+                block = []
+            if list_start is not None:
+                list_context.append(line)
+
+        if block:
+            list_start, list_context = self.update_list_context(block, block_start, list_start, list_context)
+            yield from self.extract_block(block, block_start, list_start, list_context)
+
+    @staticmethod
+    def opened_construct(line) -> (str, re.Pattern):
+        """
+        :return: Opened code fence, or end pattern of an opened HTML block, either continuing past blank lines
+        """
+        fence_match = FENCE_PATTERN.match(line)
+        if fence_match:
+            fence = fence_match.group(1)
+            # Backtick fences can't contain backticks in their info string
+            if fence[0] == "~" or "`" not in line[fence_match.end():]:
+                return fence, None
+
+        for start_pattern, end_pattern in HTML_BLOCK_PATTERNS:
+            if start_pattern.match(line):
+                return None, (None if end_pattern.search(line, start_pattern.match(line).end()) else end_pattern)
+
+        return None, None
+
+    @staticmethod
+    def update_list_context(block, block_start, list_start, list_context) -> (int, [str]):
+        """ Starts the list context at each list block, extends it with indented blocks, and ends it otherwise.
+        """
+        first_line = block[0]
+        if LIST_ITEM_PATTERN.match(first_line):
+            return block_start, list(block)
+        if list_start is not None and first_line[:1] in (" ", "\t"):
+            return list_start, list_context + block
+        return None, []
+
+    def extract_block(self, block, block_start, list_start, list_context):
+        if not StreamButtonsFromMarkdown.has_table(block):
+            return
+
+        if list_start is not None:
+            # Parse the list, then keep only top-level tables in this block
+            yield from self.extract_parsed(list_context, list_start, block_start)
+        elif StreamButtonsFromMarkdown.is_simple_block(block):
+            yield from self.extract_simple_block(block, block_start)
+        else:
+            yield from self.extract_parsed(block, block_start, block_start)
+
+    @staticmethod
+    def has_table(block) -> bool:
+        return any("|" in line and Table.delimiter_row_pattern.fullmatch(next_line)
+                   for line, next_line in zip(block, block[1:]))
+
+    @staticmethod
+    def table_spans(block) -> [(int, int)]:
+        """
+        :return: Start and end offsets of each table in the block. As mistletoe, a table continues while lines have
+        a pipe.
+        """
+        spans = []
+        offset = 0
+        while offset < len(block) - 1:
+            if "|" in block[offset] and Table.delimiter_row_pattern.fullmatch(block[offset + 1]):
+                end = offset + 2
+                while end < len(block) and "|" in block[end]:
+                    end += 1
+                spans.append((offset, end))
+                offset = end
+            else:
+                offset += 1
+        return spans
+
+    @staticmethod
+    def is_simple_block(block) -> bool:
+        """ Whether the block is only paragraph lines, and tables.
+        """
+        spans = StreamButtonsFromMarkdown.table_spans(block)
+        table_lines = {offset for start, end in spans for offset in range(start + 1, end)}
+
+        return not any(NON_PARAGRAPH_LINE_PATTERN.match(line)
+                       for offset, line in enumerate(block) if offset not in table_lines)
+
+    def extract_simple_block(self, block, block_start):
+        for start, end in StreamButtonsFromMarkdown.table_spans(block):
+            table_lines = block[start:end]
+            table_start = block_start + start
+
+            sequences = self.extract_table_lines(table_lines, table_start)
+            if sequences is None:
+                # Not plain text, let mistletoe decide
+                sequences = self.extract_parsed(table_lines, table_start, table_start)
+
+            yield from sequences
+
+    def extract_table_lines(self, table_lines, table_start) -> [ButtonSequence]:
+        """ Extracts a table's sequences directly, as extract_table would.
+
+        :return: Sequences, or None when any needed cell text might not be plain
+        """
+        header_cell = StreamButtonsFromMarkdown.first_cell(table_lines[0])
+        if not header_cell:
+            return []
+        if AMBIGUOUS_TEXT_PATTERN.search(header_cell):
+            return None
+        if not header_cell.lower().startswith(self.header_lower):
+            return []
+
+        rows = []
+        for offset, line in enumerate(table_lines[2:], start=2):
+            cell = StreamButtonsFromMarkdown.first_cell(line)
+
+            # As validate_cell_structure: raw text, then a br-tag
+            tag_start = cell.find("<")
+            if tag_start < 0:
+                continue
+            text = cell[:tag_start]
+            if AMBIGUOUS_TEXT_PATTERN.search(text):
+                return None
+            if not BR_TAG_PATTERN.match(cell, tag_start):
+                if re.match(r"<[/!?a-zA-Z]", cell[tag_start:]):
+                    # Perhaps another HTML span, or perhaps text
+                    return None
+                continue
+            if text:
+                rows.append((text, table_start + offset))
+
+        result = []
+        for text, line_number in rows:
+            sequence_map = self.extract_valid_sequence_map(text)
+            if sequence_map:
+                result.append(ButtonSequence(sequence_map, line_number))
+        return result
+
+    @staticmethod
+    def first_cell(line) -> str:
+        """ As mistletoe.block_token.TableRow, skipping empty cells. """
+        cells = [cell for cell in CELL_SPLIT_PATTERN.split(line.strip()) if cell]
+        return cells[0].strip() if cells else ""
+
+    def extract_parsed(self, lines, lines_start, min_line_number) -> [ButtonSequence]:
+        """ Parses lines with mistletoe, extracting top-level tables starting at or after min_line_number.
+        """
+        self.fallback_count += 1
+        if DEBUG_LOG_STREAM:
+            print(f"parsing lines {lines_start}-{lines_start + len(lines) - 1} with mistletoe", file=sys.stderr)
+
+        with MarkdownRenderer(normalize_whitespace=True) as _:
+            document = Document(lines)
+
+        line_offset = lines_start - 1
+        result = []
+        for token in document.children:
+            if type(token) is Table and token.line_number + line_offset >= min_line_number:
+                for sequence in self.extract_table(token):
+                    sequence.line_number += line_offset
+                    result.append(sequence)
+        return result
@@ -0,0 +1,104 @@
+import io
+from unittest import TestCase
+
+from PIL import Image, ImageChops, ImageSequence
+
+from animation import AnimationFrames, build_palette, merge_duplicate_frames, quantize_frames, \
+    save_animation
+from constants import GIF_IMAGE_EXTENSION, APNG_IMAGE_EXTENSION, WEBP_IMAGE_EXTENSION
+from stats import STATS
+from util import ImageOpt
+
+
+def frame_with_buttons(*positions, transparent_corner=True) -> Image:
+    """ A gray background, a red button at each x position, and a transparent corner """
+    frame = Image.new("RGBA", (40, 20), (128, 128, 128, 255))
+    for x in positions:
+        frame.paste((200, 0, 0, 255), (x, 5, x + 8, 15))
+    if transparent_corner:
+        frame.paste((0, 0, 0, 0), (0, 0, 2, 2))
+    return frame
+
+
+class TestAnimation(TestCase):
+    def setUp(self):
+        self.frames = [frame_with_buttons(2, 12, 22), frame_with_buttons(), frame_with_buttons(2),
+                       frame_with_buttons(2), frame_with_buttons(2, 12), frame_with_buttons(2, 12, 22)]
+        self.durations = [1000, 400, 400, 400, 400, 2000]
+        self.palette = build_palette([frame_with_buttons(2)])
+
+    def test_merge_duplicate_frames__extends_duration(self):
+        frames, durations = merge_duplicate_frames(self.frames, self.durations)
+
+        self.assertEqual(5, len(frames))
+        self.assertEqual([1000, 400, 800, 400, 2000], durations)
+
+    def test_save_animation__gif_shared_palette_changed_rectangles(self):
+        output = io.BytesIO()
+        save_animation(output, self.frames, self.durations, GIF_IMAGE_EXTENSION, self.palette)
+
+        gif = Image.open(output)
+        self.assertEqual(5, gif.n_frames)
+        self.assertEqual([1000, 400, 800, 400, 2000], [frame.info["duration"] for frame in ImageSequence.Iterator(gif)])
+
+        # Only the third button is drawn by the last frame
+        gif.seek(4)
+        self.assertEqual((22, 5, 30, 15), gif.tile[0][1])
+        for expected, frame in zip([self.frames[0], *self.frames[1:3], *self.frames[4:]],
+                                   ImageSequence.Iterator(gif)):
+            self.assertIsNone(ImageChops.difference(expected, frame.convert("RGBA")).getbbox())
+
+    def test_quantize_frames__colors_used_then_transparency(self):
+        frames, colors, transparent_index = quantize_frames(self.frames, self.palette)
+
+        self.assertEqual(2, transparent_index)
+        self.assertEqual({(128, 128, 128), (200, 0, 0)}, {tuple(colors[i:i + 3]) for i in range(0, 6, 3)})
+        self.assertEqual(transparent_index, frames[0].getpixel((0, 0)))
+
+    def test_quantize_frames__none_when_transparency_changes(self):
+        frames = [frame_with_buttons(2), frame_with_buttons(2, transparent_corner=False)]
+
+        self.assertIsNone(quantize_frames(frames, self.palette))
+
+    def test_save_animation__gif_iterates_again_when_transparency_changes(self):
+        frames = [frame_with_buttons(2), frame_with_buttons(2, 12, transparent_corner=False)]
+        generated = []
+
+        def generate():
+            generated.append(len(generated))
+            return iter(frames)
+
+        output = io.BytesIO()
+        STATS.reset()
+        save_animation(output, AnimationFrames(generate, 2, frames[-1]), [400, 2000], GIF_IMAGE_EXTENSION,
+                       self.palette)
+
+        self.assertEqual([0, 1], generated)
+        self.assertEqual(2, Image.open(output).n_frames)
+        self.assertEqual(1, STATS.counters["gif_frame_palettes"])
+
+    def test_quantize_frames__repeated_frame_once(self):
+        frames = [self.frames[5], *self.frames[1:5], self.frames[5]]
+
+        quantized, _, _ = quantize_frames(frames, self.palette)
+        self.assertIs(quantized[0], quantized[-1])
+        self.assertIsNot(quantized[2], quantized[3])
+
+    def test_save_animation__apng_and_webp_lossless(self):
+        frames, _ = merge_duplicate_frames(self.frames, self.durations)
+        for image_format in [APNG_IMAGE_EXTENSION, WEBP_IMAGE_EXTENSION]:
+            output = io.BytesIO()
+            STATS.reset()
+            save_animation(output, self.frames, self.durations, image_format)
+
+            animation = Image.open(output)
+            self.assertEqual(5, animation.n_frames, image_format)
+            animation.seek(4)
+            self.assertIsNone(ImageChops.difference(frames[4], animation.convert("RGBA")).getbbox(), image_format)
+            self.assertEqual(1, STATS.counters["frames_merged"])
+
+    def test_image_opt__animation_format_variants(self):
+        opt = ImageOpt(48, gif=True, formats=["png", "gif"], animation_format=WEBP_IMAGE_EXTENSION)
+
+        self.assertEqual(["webp", "png", "gif"], [variant.extension() for variant in opt.variants()])
+        self.assertEqual([True, False, True], [variant.gif for variant in opt.variants()])
@@ -0,0 +1,74 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from PIL import Image
+
+from atlas import Atlas
+from util import PngOpt
+
+
+class TestAtlas(TestCase):
+    def test_pack__no_overlap_within_sheets(self):
+        sizes = {f"image{index}": (72, 48) for index in range(30)}
+        sizes.update({f"large{index}": (144, 96) for index in range(5)})
+
+        atlas = Atlas.pack(sizes, max_size=400)
+
+        self.assertEqual(set(sizes), set(atlas.images))
+        self.assertGreater(len(atlas.sheets), 1)
+        rects = list(atlas.images.values())
+        for index, rect in enumerate(rects):
+            self.assertEqual(sizes[list(atlas.images)[index]], (rect.width, rect.height))
+            self.assertLessEqual(rect.x + rect.width, 400)
+            self.assertLessEqual(rect.y + rect.height, 400)
+            for other in rects[index + 1:]:
+                overlap = (rect.sheet == other.sheet and rect.x < other.x + other.width and
+                           other.x < rect.x + rect.width and rect.y < other.y + other.height and
+                           other.y < rect.y + rect.height)
+                self.assertFalse(overlap, (vars(rect), vars(other)))
+
+    def test_pack__too_large(self):
+        with self.assertRaises(ValueError):
+            Atlas.pack({"image": (500, 10)}, max_size=400)
+
+    def test_write__sheets_and_index_round_trip(self):
+        images = {"s_1": Image.new("RGBA", (72, 48), (255, 0, 0, 255)),
+                  "s_1@96": Image.new("RGBA", (144, 96), (0, 0, 255, 128))}
+        atlas = Atlas.pack({name: image.size for name, image in images.items()})
+
+        with tempfile.TemporaryDirectory() as out_dirname:
+            # A previous atlas, of two sheets
+            previous_images = {"a": Image.new("RGBA", (10, 10)), "b": Image.new("RGBA", (10, 10))}
+            Atlas.pack({"a": (10, 10), "b": (10, 10)}, max_size=10).write(out_dirname, previous_images, PngOpt())
+            self.assertTrue(os.path.exists(os.path.join(out_dirname, "atlas-1.png")))
+
+            atlas.write(out_dirname, images, PngOpt())
+            loaded = Atlas.load(out_dirname)
+            self.assertTrue(Atlas.is_complete(out_dirname))
+
+            self.assertFalse(os.path.exists(os.path.join(out_dirname, "atlas-1.png")))
+            self.assertEqual({name: vars(rect) for name, rect in atlas.images.items()},
+                             {name: vars(rect) for name, rect in loaded.images.items()})
+
+            sheet = Image.open(os.path.join(out_dirname, "atlas-0.png"))
+            for name, image in images.items():
+                rect = loaded.images[name]
+                self.assertEqual(image.tobytes(),
+                                 sheet.crop((rect.x, rect.y, rect.x + rect.width, rect.y + rect.height)).tobytes())
+
+            with open(os.path.join(out_dirname, "atlas.css")) as fin:
+                css = fin.read()
+            self.assertIn(".mdpicgen-atlas-s_1-96 { background-image: url(atlas-0.png); background-position: "
+                          "0px 0px; width: 144px; height: 96px; }", css)
+
+    def test_is_complete__every_sheet_exists(self):
+        images = {"a": Image.new("RGBA", (10, 10)), "b": Image.new("RGBA", (10, 10))}
+
+        with tempfile.TemporaryDirectory() as out_dirname:
+            self.assertFalse(Atlas.is_complete(out_dirname))
+            Atlas.pack({"a": (10, 10), "b": (10, 10)}, max_size=10).write(out_dirname, images, PngOpt())
+            self.assertTrue(Atlas.is_complete(out_dirname))
+
+            os.remove(os.path.join(out_dirname, "atlas-1.png"))
+            self.assertFalse(Atlas.is_complete(out_dirname))
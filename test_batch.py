@@ -0,0 +1,60 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from batch import expand_markdown_filenames, output_filenames, unique_sequences, write_documents
+from button_sequence import ButtonSequence
+from util import ImageOpt
+
+
+class TestBatch(TestCase):
+    def test_expand_markdown_filenames__directories_and_patterns(self):
+        with tempfile.TemporaryDirectory() as temp_dirname:
+            for filename in ["a.md", "b.md", "notes.txt", os.path.join("sub", "c.md")]:
+                os.makedirs(os.path.dirname(os.path.join(temp_dirname, filename)), exist_ok=True)
+                open(os.path.join(temp_dirname, filename), "w").close()
+
+            actual_output = expand_markdown_filenames([os.path.join(temp_dirname, "b.md"), temp_dirname,
+                                                       os.path.join(temp_dirname, "*.md")])
+
+            self.assertEqual([os.path.join(temp_dirname, filename) for filename in ["b.md", "a.md", "sub/c.md"]],
+                             actual_output)
+
+    def test_expand_markdown_filenames__skips_output_directory(self):
+        with tempfile.TemporaryDirectory() as temp_dirname:
+            for filename in ["a.md", os.path.join("out", "a.md")]:
+                os.makedirs(os.path.dirname(os.path.join(temp_dirname, filename)), exist_ok=True)
+                open(os.path.join(temp_dirname, filename), "w").close()
+
+            out_dirname = os.path.join(temp_dirname, "out")
+            for paths in [[temp_dirname], [os.path.join(temp_dirname, "**", "*.md")]]:
+                actual_output = expand_markdown_filenames(paths, [out_dirname])
+
+                self.assertEqual([os.path.join(temp_dirname, "a.md")], actual_output, paths)
+
+    def test_unique_sequences__first_of_each_basename(self):
+        first = ButtonSequence([{"SHIFT": "s"}], 3)
+        sequences_by_document = {"a.md": [first, ButtonSequence([{"B1": "1"}], 4)],
+                                 "b.md": [ButtonSequence([{"Shift": "s"}], 7)]}
+
+        actual_output = unique_sequences(sequences_by_document)
+
+        self.assertEqual(["s", "1"], [sequence.basename for sequence in actual_output])
+        self.assertIs(first, actual_output[0])
+
+    def test_write_documents__links_relative_to_output(self):
+        with tempfile.TemporaryDirectory() as temp_dirname:
+            md_filename = os.path.join(temp_dirname, "docs", "sub", "a.md")
+            os.makedirs(os.path.dirname(md_filename))
+            with open(md_filename, "w") as fout:
+                fout.write("| Button | Image |\n|---|---|\n| B1 <br> | desc |\n")
+            md_out_dir = os.path.join(temp_dirname, "md_out")
+
+            self.assertEqual({md_filename: os.path.join(md_out_dir, "a.md")},
+                             output_filenames([md_filename], md_out_dir))
+
+            write_documents(md_out_dir, os.path.join(temp_dirname, "images"),
+                            {md_filename: [ButtonSequence([{"B1": "1"}], 3)]}, ImageOpt(48, gif=False))
+
+            with open(os.path.join(md_out_dir, "a.md")) as fin:
+                self.assertEqual("| B1 <br> ![](../images/1.png)  | desc |\n", fin.readlines()[2])
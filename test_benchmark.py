@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+from benchmark import BenchmarkConfig, run_benchmark, compare
+
+
+class TestBenchmark(TestCase):
+    def test_run_benchmark__tiny_corpus(self):
+        config = BenchmarkConfig(tables=1, rows=2, buttons=2, patterns=4, canvas_width=64, canvas_height=40,
+                                 image_height=16, repeat=1)
+
+        results = run_benchmark(config)
+
+        self.assertEqual(["extract", "imageset_png", "imageset_gif", "write_markdown", "format_markdown"],
+                         list(results["stages"]))
+        self.assertEqual(2, results["stages"]["extract"]["items"])
+        self.assertEqual([], compare(results, results, 0.0, 0.0))
+
+    def test_compare__regressions_beyond_limits(self):
+        baseline = {"stages": {"extract": {"seconds": 1.0, "peak_bytes": 1000},
+                               "format_markdown": {"seconds": 1.0, "peak_bytes": 1000}}}
+        results = {"stages": {"extract": {"seconds": 1.2, "peak_bytes": 1000},
+                              "format_markdown": {"seconds": 1.3, "peak_bytes": 2000},
+                              "imageset_png": {"seconds": 9.0, "peak_bytes": 9000}}}
+
+        regressions = compare(results, baseline, 0.25, 0.5)
+
+        self.assertEqual(2, len(regressions))
+        self.assertTrue(all(regression.startswith("format_markdown") for regression in regressions))
+
+    def test_compare__skips_times_of_short_stages(self):
+        baseline = {"stages": {"extract": {"seconds": 0.01, "peak_bytes": 1000}}}
+        results = {"stages": {"extract": {"seconds": 0.02, "peak_bytes": 1000}}}
+
+        self.assertEqual([], compare(results, baseline, 0.25, 0.5))
+        self.assertEqual(1, len(compare(results, baseline, 0.25, 0.5, min_seconds=0)))
@@ -0,0 +1,62 @@
+import random
+from unittest import TestCase, mock
+
+from PIL import Image, ImageChops
+
+import compositor
+from compositor import Compositor, NumpyCompositor
+from imageset_gen import ImageLayer
+from constants import BG_LAYER_NAME
+
+
+def max_difference(expected: Image, actual: Image) -> int:
+    return max(high for _, high in ImageChops.difference(expected, actual).getextrema())
+
+
+class TestCompositor(TestCase):
+    def setUp(self):
+        background = Image.new("RGBA", (60, 40), (128, 128, 128, 255))
+        background.paste((0, 0, 0, 0), (0, 0, 4, 4))
+        self.background = ImageLayer(background, BG_LAYER_NAME, 0, 0)
+
+        # Overlapping, half transparent, and partly outside the canvas
+        rng = random.Random(0)
+        self.layers = []
+        for index in range(6):
+            image = Image.new("RGBA", (12, 8), (rng.randrange(256), rng.randrange(256), rng.randrange(256),
+                                                rng.choice([255, 128, 30])))
+            image.paste((0, 0, 0, 0), (0, 0, 3, 3))
+            self.layers.append(ImageLayer(image, str(index), rng.randrange(-4, 56), rng.randrange(-4, 36)))
+
+        self.layer_lists = [[self.background, *rng.sample(self.layers, rng.randint(0, 6))] for _ in range(20)]
+
+    def test_composite_batch__frames_continue_from_previous(self):
+        frames = [[self.background, *self.layers[:count]] for count in range(len(self.layers) + 1)]
+
+        for expected, actual in zip([Compositor().composite(layers) for layers in frames],
+                                    Compositor().composite_batch(frames)):
+            self.assertEqual(expected.tobytes(), actual.tobytes())
+
+    def test_composite__box_matches_crop_of_canvas(self):
+        box = (10, 5, 50, 30)
+        for layers in self.layer_lists:
+            self.assertEqual(Compositor().composite(layers).crop(box).tobytes(),
+                             Compositor().composite(layers, box).tobytes())
+
+    def test_numpy_composite_batch__within_1_level_of_pillow(self):
+        for box in [None, (10, 5, 50, 30)]:
+            expected = [Compositor().composite(layers, box) for layers in self.layer_lists]
+            actual = NumpyCompositor().composite_batch(self.layer_lists, box)
+
+            for expected_image, actual_image in zip(expected, actual):
+                # Fully transparent pixels lose their color
+                mask = expected_image.getchannel("A").point(lambda alpha: 255 if alpha else 0)
+                expected_image = Image.composite(expected_image, Image.new("RGBA", expected_image.size), mask)
+                self.assertLessEqual(max_difference(expected_image, actual_image), 1, box)
+
+    def test_numpy_composite_batch__split_by_pixels(self):
+        expected = NumpyCompositor().composite_batch(self.layer_lists)
+        with mock.patch.object(compositor, "NUMPY_BATCH_PIXELS", 60 * 40 * 3):
+            actual = NumpyCompositor().composite_batch(self.layer_lists)
+
+        self.assertEqual([image.tobytes() for image in expected], [image.tobytes() for image in actual])
@@ -0,0 +1,38 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from button_sequence import ButtonSequence
+from extract_index import ExtractionIndex
+
+
+class TestExtractionIndex(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.index_filename = os.path.join(self.temp_dir.name, "index.json")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_lookup_table__rebases_line_numbers(self):
+        index = ExtractionIndex(self.index_filename)
+        self.assertIsNone(index.lookup_table("table", 10))
+        index.record_table("table", 10, [ButtonSequence([{'SHIFT': 's'}], 12)], ["ZORK"])
+        index.record_document("doc", "pat", [], [])
+        index.save()
+
+        index = ExtractionIndex(self.index_filename)
+        sequences, rejects = index.lookup_table("table", 20)
+        self.assertEqual([("s", 22)], [(seq.basename, seq.line_number) for seq in sequences])
+        self.assertEqual(["ZORK"], rejects)
+
+    def test_lookup_document__changed_inputs(self):
+        index = ExtractionIndex(self.index_filename)
+        index.record_document("doc", "pat", [ButtonSequence([{'SHIFT': 's'}], 3)], [])
+        index.save()
+
+        index = ExtractionIndex(self.index_filename)
+        sequences, _ = index.lookup_document("doc", "pat")
+        self.assertEqual([("s", 3)], [(seq.basename, seq.line_number) for seq in sequences])
+        self.assertIsNone(index.lookup_document("doc", "changed"))
+        self.assertIsNone(ExtractionIndex(self.index_filename, force=True).lookup_document("doc", "pat"))
@@ -1,7 +1,13 @@
+import os
+import re
 from unittest import TestCase
 
+from extract_md import ButtonMatcher, ExtractButtonsFromMarkdown
+from patset import patterns_map_to_button_name
 from util import extract_digit_ranges
 
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
 
 class TestExtractButtonsFromMarkdown(TestCase):
     
@@ -24,3 +30,29 @@ class TestExtractButtonsFromMarkdown(TestCase):
     def assert_extract_digit_ranges(self, text, expected_output):
         actual_output = extract_digit_ranges(text)
         self.assertEqual(expected_output, actual_output)
+
+
+class TestButtonMatcher(TestCase):
+    ELEMENTS = ["SHIFT", "shift", "B1", "Button 2 (Long press)", "[1-3, 7,8]", "B[1-8] (2nd pattern) in any sub-mode",
+                "turn dial", "Turn dial clockwise", "OK (>)", "ZORK", "10", "", "SEQ PLAY", "LOOPER REC"]
+
+    def test_match__same_as_searching_each_pattern(self):
+        button_patterns = patterns_map_to_button_name(f"{SCRIPT_DIR}/qunmk2.patset")
+        matcher = ButtonMatcher(button_patterns)
+        self.assertIsNotNone(matcher.combined)
+
+        for element in self.ELEMENTS:
+            expected = ExtractButtonsFromMarkdown.search_element(element, list(button_patterns.values()),
+                                                                 button_patterns.keys())
+            self.assertEqual(expected, matcher.lookup(element), element)
+
+    def test_match__ambiguous(self):
+        matcher = ButtonMatcher({re.compile("^B", re.IGNORECASE): "b", re.compile(r"\d$", re.IGNORECASE): "%digits%"})
+        self.assertEqual((2, None), matcher.lookup("B1"))
+        self.assertEqual({}, matcher.match("B1"))
+        self.assertEqual({"7": "7"}, matcher.match("7"))
+
+    def test_match__backreference_falls_back(self):
+        matcher = ButtonMatcher({re.compile(r"^(\d)\1$", re.IGNORECASE): "%digits%"})
+        self.assertIsNone(matcher.combined)
+        self.assertEqual({"33": "3"}, matcher.match("33"))
@@ -0,0 +1,42 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from image_cache import ImageCache
+
+
+class TestImageCache(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.out_dirname = self.temp_dir.name
+        self.image_filename = os.path.join(self.out_dirname, "s_1.png")
+        with open(self.image_filename, "wb") as fout:
+            fout.write(b"png")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_is_fresh__recorded_key_persists(self):
+        cache = ImageCache(self.out_dirname)
+        self.assertFalse(cache.is_fresh(self.image_filename, "key"))
+        cache.record(self.image_filename, "key")
+        cache.save()
+
+        cache = ImageCache(self.out_dirname)
+        self.assertTrue(cache.is_fresh(self.image_filename, "key"))
+        self.assertFalse(cache.is_fresh(self.image_filename, "changed"))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_is_fresh__missing_image(self):
+        cache = ImageCache(self.out_dirname)
+        cache.record(self.image_filename, "key")
+        os.remove(self.image_filename)
+        self.assertFalse(cache.is_fresh(self.image_filename, "key"))
+
+    def test_is_fresh__force(self):
+        cache = ImageCache(self.out_dirname)
+        cache.record(self.image_filename, "key")
+        cache.save()
+
+        cache = ImageCache(self.out_dirname, force=True)
+        self.assertFalse(cache.is_fresh(self.image_filename, "key"))
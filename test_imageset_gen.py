@@ -1,6 +1,14 @@
+import os
 from unittest import TestCase
 
-from imageset_gen import ImageSet, BG_LAYER_NAME
+from PIL import Image, ImageChops
+
+from button_sequence import ButtonSequence
+from compositor import COMPOSITORS
+from imageset_gen import ImageSet, ImageLayer, BG_LAYER_NAME
+from util import ImageOpt
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 
 class TestImageSet(TestCase):
@@ -18,3 +26,99 @@ class TestImageSet(TestCase):
         actual_output = (
             ImageSet.layer_names_from_basename(basename="big_barf_123_wilt_234_5", add_bg=True, unpack_digits=False))
         self.assertEqual([BG_LAYER_NAME, "big", "barf", "123", "wilt", "234", "5"], actual_output)
+
+    def test_compare_prescaled__within_tolerance(self):
+        imageset = ImageSet()
+        imageset.all_layers = imageset.load_imageset(f"{SCRIPT_DIR}/qunmk2_imageset.csv", f"{SCRIPT_DIR}/imageset")
+
+        mean, _ = imageset.compare_prescaled(ButtonSequence([{'SHIFT': 's'}, {'B[1-8]': '12345678'}], 1),
+                                             ImageOpt(height=48, gif=False, prescale=True))
+        self.assertLess(mean, 2.0)
+
+    def test_trim_transparent__offset_of_crop(self):
+        image = Image.new("RGBA", (40, 20))
+        image.paste((200, 0, 0, 128), (2, 5, 10, 15))
+
+        trimmed, x, y = ImageSet.trim_transparent(image)
+        self.assertEqual((8, 10), trimmed.size)
+        self.assertEqual((2, 5), (x, y))
+        self.assertIs(trimmed, ImageSet.trim_transparent(trimmed)[0])
+
+    def test_composite_dirty_rects__matches_full_size_composite(self):
+        imageset = ImageSet()
+        imageset.all_layers = imageset.load_imageset(f"{SCRIPT_DIR}/qunmk2_imageset.csv", f"{SCRIPT_DIR}/imageset")
+        sequence = ButtonSequence([{'SHIFT': 's'}, {'B[1-8]': '1_23'}], 1)
+
+        for resample in ["bilinear", "bicubic", "lanczos"]:
+            opt = ImageOpt(height=48, gif=True, resample=resample)
+            expected, _, _ = ImageSet.gen_animated_images(sequence, opt, imageset.all_layers)
+            actual, _, _ = ImageSet.gen_animated_images(sequence, opt, imageset.all_layers,
+                                                        imageset.scaled_background(opt))
+
+            self.assertEqual(len(expected), len(actual))
+            for expected_frame, actual_frame in zip(expected, actual):
+                difference = ImageChops.difference(expected_frame, actual_frame)
+                self.assertLessEqual(max(high for _, high in difference.getextrema()), 1, resample)
+
+    def test_gen_animated_images__repeats_are_references(self):
+        imageset = ImageSet()
+        imageset.all_layers = imageset.load_imageset(f"{SCRIPT_DIR}/qunmk2_imageset.csv", f"{SCRIPT_DIR}/imageset")
+        sequence = ButtonSequence([{'B[1-8]': '1_2_2'}], 1)
+
+        frames, _, _ = ImageSet.gen_animated_images(sequence, ImageOpt(height=48, gif=True), imageset.all_layers)
+        frames = list(frames)
+        # Poster, background, 1, 2, flash of 1, then 2 again
+        self.assertEqual(6, len(frames))
+        self.assertIs(frames[0], frames[-1])
+        self.assertIs(frames[2], frames[4])
+
+    def test_composite_dirty_rects__only_changed_rectangles(self):
+        background = Image.new("RGBA", (100, 50), (128, 128, 128, 255))
+        layers = [ImageLayer(background, BG_LAYER_NAME, 0, 0),
+                  ImageLayer(Image.new("RGBA", (10, 10), (200, 0, 0, 255)), "a", 60, 20)]
+        base = Image.new("RGBA", (50, 25), (0, 0, 255, 255))
+
+        result = ImageSet.composite_dirty_rects(ImageOpt(height=25, gif=False), base, layers, layers[1:])
+        # Resampled around the layer, from the background and the layer, and the base elsewhere
+        self.assertEqual((200, 0, 0, 255), result.getpixel((32, 12)))
+        self.assertEqual((128, 128, 128, 255), result.getpixel((25, 12)))
+        self.assertEqual((0, 0, 255, 255), result.getpixel((5, 5)))
+
+    def test_render_variants__composites_once_without_dirty_rects(self):
+        imageset = ImageSet()
+        imageset.all_layers = imageset.load_imageset(f"{SCRIPT_DIR}/qunmk2_imageset.csv", f"{SCRIPT_DIR}/imageset")
+        sequence = ButtonSequence([{'SHIFT': 's'}], 1)
+
+        rendered_heights = []
+        render_frames_batch = imageset.render_frames_batch
+
+        def record_height(sequences, opt, layers, variants):
+            rendered_heights.append(opt.height)
+            return render_frames_batch(sequences, opt, layers, variants)
+
+        imageset.render_frames_batch = record_height
+        for resample, expected_heights in [("nearest", [None]), ("bicubic", [48, 24])]:
+            rendered_heights.clear()
+            opt = ImageOpt(height=48, gif=False, resample=resample, heights=[48, 24])
+            results = imageset.render_variants(sequence, opt, opt.variants())
+
+            self.assertEqual(expected_heights, rendered_heights, resample)
+            self.assertEqual([48, 24], [images[0].height for _, images, _ in results])
+
+    def test_gen_composite_images__matches_each_composited_alone(self):
+        imageset = ImageSet()
+        imageset.all_layers = imageset.load_imageset(f"{SCRIPT_DIR}/qunmk2_imageset.csv", f"{SCRIPT_DIR}/imageset")
+        layer_name_lists = [ImageSet.layer_names_from_basename(basename=basename)
+                            for basename in ["s_1", "s_2", "s_1_2", "1"]]
+
+        for compositor_name, compositor in COMPOSITORS.items():
+            for resample in ["bicubic", "nearest"]:
+                opt = ImageOpt(height=48, gif=False, resample=resample)
+                background = imageset.scaled_background(opt)
+                actual = ImageSet.gen_composite_images(opt, layer_name_lists, imageset.all_layers, background,
+                                                       compositor())
+
+                for layer_names, image in zip(layer_name_lists, actual):
+                    expected = ImageSet.gen_composite_image(opt, layer_names, imageset.all_layers, background,
+                                                            compositor())
+                    self.assertEqual(expected.tobytes(), image.tobytes(), (compositor_name, resample, layer_names))
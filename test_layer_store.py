@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from PIL import Image
+
+from layer_store import LayerStore
+
+
+class TestLayerStore(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.rgb_filename = os.path.join(self.temp_dir.name, "rgb.png")
+        Image.new("RGB", (4, 2), (255, 0, 0)).save(self.rgb_filename)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_load__normalizes_to_rgba(self):
+        image, _ = LayerStore().load(self.rgb_filename)
+        self.assertEqual("RGBA", image.mode)
+        self.assertEqual((255, 0, 0, 255), image.getpixel((0, 0)))
+
+    def test_load__decodes_once_per_path_and_content(self):
+        copy_filename = os.path.join(self.temp_dir.name, "copy.png")
+        shutil.copyfile(self.rgb_filename, copy_filename)
+
+        store = LayerStore()
+        image, digest = store.load(self.rgb_filename)
+        same_path_image, _ = store.load(f"{self.temp_dir.name}/./rgb.png")
+        same_content_image, same_content_digest = store.load(copy_filename)
+
+        self.assertIs(image, same_path_image)
+        self.assertIs(image, same_content_image)
+        self.assertEqual(digest, same_content_digest)
+        self.assertEqual((2, 1), (store.files_read, store.images_decoded))
@@ -0,0 +1,61 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from atlas import AtlasImage
+from extract_md import ExtractButtonsFromMarkdown
+from markdown_source import MarkdownSource
+from modify_md import update_or_replace_image_in_markdown, format_srcset, format_markdown, write_markdown
+from util import ImageOpt
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+class TestModifyMarkdown(TestCase):
+    def test_update_or_replace_image_in_markdown__replace_link(self):
+        actual_output = update_or_replace_image_in_markdown("| B1 <br> ![a](old.png) | desc |\n", "out/1.png")
+        self.assertEqual("| B1 <br> ![a](out/1.png) | desc |\n", actual_output)
+
+    def test_update_or_replace_image_in_markdown__add_link(self):
+        actual_output = update_or_replace_image_in_markdown("| B1 <br> | desc |\n", "out/1.png")
+        self.assertEqual("| B1 <br> ![](out/1.png)  | desc |\n", actual_output)
+
+    def test_update_or_replace_image_in_markdown__srcset_round_trip(self):
+        srcset = format_srcset("out", "1", ImageOpt(48, gif=False, heights=[48, 96]))
+        self.assertEqual("out/1.png 1x, out/1@96.png 2x", srcset)
+
+        with_srcset = update_or_replace_image_in_markdown("| B1 <br> ![a](old.png) | desc |\n", "out/1.png", srcset)
+        self.assertEqual(f'| B1 <br> <img alt="a" src="out/1.png" srcset="{srcset}"> | desc |\n', with_srcset)
+
+        without_srcset = update_or_replace_image_in_markdown(with_srcset, "out/1.png")
+        self.assertEqual("| B1 <br> ![a](out/1.png) | desc |\n", without_srcset)
+
+    def test_update_or_replace_image_in_markdown__atlas_round_trip(self):
+        style = AtlasImage("atlas-0.png", 72, 0, 72, 48).style()
+
+        with_atlas = update_or_replace_image_in_markdown("| B1 <br> ![a](old.png) | desc |\n", "out/atlas-0.png",
+                                                         style=style)
+        self.assertEqual('| B1 <br> <img alt="a" src="out/atlas-0.png" style="width:72px;height:48px;'
+                         'object-fit:none;object-position:-72px 0px"> | desc |\n', with_atlas)
+
+        without_atlas = update_or_replace_image_in_markdown(with_atlas, "out/1.png")
+        self.assertEqual("| B1 <br> ![a](out/1.png) | desc |\n", without_atlas)
+
+    def test_markdown_source__same_as_reading_file(self):
+        markdown_filename = f"{SCRIPT_DIR}/test.md"
+        source = MarkdownSource(markdown_filename)
+        sequences = ExtractButtonsFromMarkdown(markdown_filename, f"{SCRIPT_DIR}/qunmk2.patset",
+                                               source=source).button_sequences
+
+        self.assertEqual(format_markdown(markdown_filename), format_markdown(markdown_filename, source))
+
+        with tempfile.TemporaryDirectory() as temp_dirname:
+            outputs = []
+            for shared_source in [None, source]:
+                md_out_filename = os.path.join(temp_dirname, "out.md")
+                write_markdown(md_out_filename, "out", markdown_filename, sequences, ImageOpt(48, gif=False),
+                               source=shared_source)
+                with open(md_out_filename) as fin:
+                    outputs.append(fin.read())
+
+        self.assertEqual(outputs[0], outputs[1])
@@ -0,0 +1,51 @@
+import os
+import pickle
+import tempfile
+from unittest import TestCase
+
+from patset import PatternSet
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+class TestPatternSet(TestCase):
+    def test_parse__rules(self):
+        patterns = PatternSet.parse('# comment\n__header__ = Button\n__separator__ = "+"\n^SHIFT$ = s\n')
+
+        self.assertEqual("Button", patterns.header)
+        self.assertEqual(["+"], patterns.separators)
+        self.assertEqual(["s"], list(patterns.button_patterns.values()))
+        self.assertTrue(next(iter(patterns.button_patterns)).search("shift"))
+
+    def test_parse__exactly_one_header_and_unique_patterns(self):
+        for text in ["^SHIFT$ = s\n", "__header__ = Button\n__header__ = Key\n",
+                     "__header__ = Button\n^SHIFT$ = s\n^SHIFT$ = t\n"]:
+            with self.assertRaises(ValueError, msg=text):
+                PatternSet.parse(text)
+
+    def test_split__as_each_separator_in_turn(self):
+        patterns = PatternSet("Button", ["+", " or ", " / "], [])
+
+        self.assertEqual(["SHIFT", "1", "2"], patterns.split(" SHIFT + 1 or 2 "))
+        # " / " starts before the " or " it overlaps, yet " or " splits first
+        self.assertEqual(["a /", "b"], patterns.split("a / or b"))
+
+    def test_load__parses_each_content_once(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, "test.patset")
+            with open(f"{SCRIPT_DIR}/qunmk2.patset") as fin, open(filename, "w") as fout:
+                fout.write(fin.read())
+
+            patterns = PatternSet.load(filename)
+            self.assertIs(patterns, PatternSet.load(filename))
+
+            with open(filename, "a") as fout:
+                fout.write("^EXTRA$ = x\n")
+            self.assertIsNot(patterns, PatternSet.load(filename))
+
+    def test_pickle__rules(self):
+        patterns = PatternSet.load(f"{SCRIPT_DIR}/qunmk2.patset")
+
+        unpickled = pickle.loads(pickle.dumps(patterns))
+        self.assertEqual(patterns.to_dict(), unpickled.to_dict())
+        self.assertEqual(patterns.split("SHIFT + 1"), unpickled.split("SHIFT + 1"))
@@ -0,0 +1,64 @@
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from pipeline import WritePipeline
+
+
+def encode_text(text):
+    return lambda fout: fout.write(text.encode())
+
+
+class TestWritePipeline(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def filename(self, name):
+        return os.path.join(self.temp_dir.name, name)
+
+    def test_submit__writes_in_order_then_calls_back(self):
+        written = []
+        with WritePipeline(encode_threads=3, queue_size=2) as pipeline:
+            for index in range(10):
+                pipeline.submit(encode_text(str(index)), self.filename(f"{index}.txt"),
+                                lambda index=index: written.append(index))
+
+        self.assertEqual(list(range(10)), written)
+        with open(self.filename("9.txt")) as fin:
+            self.assertEqual("9", fin.read())
+
+    def test_close__raises_first_error_after_writing_the_rest(self):
+        def fail(fout):
+            raise ValueError("encode")
+
+        written = []
+        with self.assertRaisesRegex(ValueError, "encode"):
+            with WritePipeline() as pipeline:
+                pipeline.submit(fail, self.filename("a.txt"), lambda: written.append("a"))
+                pipeline.submit(encode_text("b"), self.filename("b.txt"), lambda: written.append("b"))
+
+        self.assertEqual(["b"], written)
+        self.assertFalse(os.path.exists(self.filename("a.txt")))
+
+    def test_submit__blocks_while_queue_is_full(self):
+        release = threading.Event()
+
+        def wait(fout):
+            release.wait(5)
+
+        with WritePipeline(encode_threads=1, queue_size=1) as pipeline:
+            # The writer waits for the first image, the second fills the queue
+            pipeline.submit(wait, self.filename("a.txt"))
+            pipeline.submit(wait, self.filename("b.txt"))
+            submitter = threading.Thread(target=pipeline.submit, args=(wait, self.filename("c.txt")))
+            submitter.start()
+
+            submitter.join(0.2)
+            self.assertTrue(submitter.is_alive())
+            release.set()
+            submitter.join(5)
+            self.assertFalse(submitter.is_alive())
@@ -0,0 +1,67 @@
+import os
+import random
+import tempfile
+from unittest import TestCase
+
+from PIL import Image
+
+from png_encoding import save_png
+from stats import STATS
+from util import PngOpt, ImageOpt
+
+
+class TestSavePng(TestCase):
+    def setUp(self):
+        self.image = Image.new("RGBA", (40, 20), (128, 128, 128, 255))
+        self.image.paste((200, 0, 0, 128), (2, 5, 10, 15))
+        self.image.info["icc_profile"] = b"\0" * 100
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.temp_dir.name, "image.png")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_save_png__default_keeps_metadata(self):
+        save_png(self.image, self.filename, PngOpt())
+
+        saved = Image.open(self.filename)
+        self.assertEqual("RGBA", saved.mode)
+        self.assertIn("icc_profile", saved.info)
+
+    def test_save_png__palette_with_alpha(self):
+        save_png(self.image, self.filename, PngOpt(colors=16))
+
+        saved = Image.open(self.filename)
+        self.assertEqual("P", saved.mode)
+        self.assertEqual(self.image.tobytes(), saved.convert("RGBA").tobytes())
+
+    def test_save_png__strip_is_reproducible(self):
+        png = PngOpt(strip=True)
+        save_png(self.image, self.filename, png)
+        other_image = self.image.copy()
+        other_image.info["icc_profile"] = b"\1" * 100
+        other_filename = os.path.join(self.temp_dir.name, "other.png")
+        save_png(other_image, other_filename, png)
+
+        self.assertNotIn("icc_profile", Image.open(self.filename).info)
+        with open(self.filename, "rb") as fin, open(other_filename, "rb") as other_fin:
+            self.assertEqual(fin.read(), other_fin.read())
+        # The caller's image keeps its metadata
+        self.assertIn("icc_profile", self.image.info)
+
+    def test_save_png__measures_bytes_saved(self):
+        # Noise of 16 colors, which RGBA encodes larger than a palette
+        colors = random.Random(0)
+        image = Image.new("RGBA", (160, 80))
+        image.putdata([(colors.randrange(16) * 16, 0, 0, 255) for _ in range(160 * 80)])
+        STATS.reset()
+        save_png(image, self.filename, PngOpt(colors=16, measure_saved=True))
+
+        self.assertGreater(STATS.counters["bytes_saved.png"], 1000)
+
+    def test_png_opt__default_key_is_empty_and_shared_by_variants(self):
+        png = PngOpt(compress_level=9)
+        opt = ImageOpt(48, gif=False, heights=[48, 96], png=png)
+
+        self.assertEqual([], PngOpt().key())
+        self.assertEqual([png, png], [variant.png for variant in opt.variants()])
@@ -0,0 +1,110 @@
+import os
+import tempfile
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import TestCase
+from unittest.mock import patch
+
+from PIL import Image
+from psd_tools import PSDImage
+from psd_tools.api.layers import PixelLayer, Group
+
+import psd_gen
+from imageset_gen import ImageSet
+from psd_gen import PSDInMd
+from util import ImageOpt
+
+
+class TestPSDInMd(TestCase):
+    def setUp(self):
+        psd_gen.DEBUG_LOG_PSD = False
+        psd = PSDImage.new("RGBA", (40, 30))
+        image = Image.new("RGBA", (10, 10), (255, 0, 0, 255))
+
+        PixelLayer.frompil(Image.new("RGBA", (40, 30), (0, 0, 255, 255)), psd, "BG")
+        PixelLayer.frompil(image, psd, "SHIFT - s", top=5, left=20)
+        dial = Group.new(psd, "Dial - d")
+        PixelLayer.frompil(image, dial, "Knob - k")
+        PixelLayer.frompil(image, dial, "")
+        nested = Group.new(dial, "")
+        PixelLayer.frompil(image, nested, "")
+
+        self.psd_in_md = PSDInMd()
+        self.psd_in_md.psd = psd
+        self.psd_in_md.index_layers()
+
+    def tearDown(self):
+        psd_gen.DEBUG_LOG_PSD = True
+
+    def test_find_layers__same_as_searching_each_layer(self):
+        layers = list(self.psd_in_md.psd.descendants())
+        for components in [["BG"], ["s", "BG"], ["d"], ["k"], ["1", "2"], ["Root"], []]:
+            expected = {layer for layer in layers
+                        if self.psd_in_md.can_find_layer_for_any_shortname(layer, components)}
+
+            self.assertEqual(expected, self.psd_in_md.find_layers(components), components)
+
+    def test_export_imageset__cropped_layers_once_per_psd(self):
+        with tempfile.TemporaryDirectory() as temp_dirname:
+            psd_filename = os.path.join(temp_dirname, "test.psd")
+            self.psd_in_md.psd.save(psd_filename)
+            imageset_filename = os.path.join(temp_dirname, "imageset.csv")
+            imageset_dir = os.path.join(temp_dirname, "imageset")
+
+            with redirect_stdout(StringIO()):
+                exported = PSDInMd().export_imageset(psd_filename, imageset_filename, imageset_dir)
+                exported_again = PSDInMd().export_imageset(psd_filename, imageset_filename, imageset_dir)
+
+            self.assertTrue(exported)
+            self.assertFalse(exported_again)
+
+            layers = ImageSet().load_imageset(imageset_filename, imageset_dir)
+            # As compositing the PSD directly: the knob's group is hidden without its own component
+            self.assertEqual(["BG", "d", "s"], list(layers))
+            self.assertEqual((40, 30), layers["BG"].image.size)
+            self.assertEqual((10, 10), layers["s"].image.size)
+            self.assertEqual((20, 5), (layers["s"].x, layers["s"].y))
+
+    def test_process_psd__jobs_same_as_threads(self):
+        with tempfile.TemporaryDirectory() as temp_dirname:
+            psd_filename = os.path.join(temp_dirname, "test.psd")
+            self.psd_in_md.psd.save(psd_filename)
+            opt = ImageOpt(height=12, gif=False, heights=[12, 24])
+            basenames = ["s", "d", "s_d", "s"]
+
+            with redirect_stdout(StringIO()):
+                for jobs in [None, 1, 2]:
+                    PSDInMd().process_psd(os.path.join(temp_dirname, str(jobs)), psd_filename, basenames, opt,
+                                          jobs=jobs)
+
+            for basename in set(basenames):
+                for height in opt.heights:
+                    expected = Image.open(PSDInMd.image_filename(os.path.join(temp_dirname, "None"), basename, opt,
+                                                                 height))
+                    for jobs in [1, 2]:
+                        image = Image.open(PSDInMd.image_filename(os.path.join(temp_dirname, str(jobs)), basename,
+                                                                  opt, height))
+                        self.assertEqual(expected.tobytes(), image.tobytes(), (basename, height, jobs))
+
+    def test_process_psd__raises_error_after_recording_other_images(self):
+        with tempfile.TemporaryDirectory() as temp_dirname:
+            psd_filename = os.path.join(temp_dirname, "test.psd")
+            self.psd_in_md.psd.save(psd_filename)
+            opt = ImageOpt(height=12, gif=False)
+            composite_image = PSDInMd.composite_image
+
+            def fail_on_d(psd_in_md, basename, *args):
+                if basename == "d":
+                    raise ValueError(basename)
+                composite_image(psd_in_md, basename, *args)
+
+            for jobs in [None, 1]:
+                out_dirname = os.path.join(temp_dirname, str(jobs))
+                with redirect_stdout(StringIO()), patch.object(PSDInMd, "composite_image", fail_on_d):
+                    with self.assertRaises(ValueError):
+                        PSDInMd().process_psd(out_dirname, psd_filename, ["s", "d"], opt, jobs=jobs)
+
+                # Only the failed image is composited again
+                with redirect_stdout(StringIO()) as output:
+                    PSDInMd().process_psd(out_dirname, psd_filename, ["s", "d"], opt, jobs=jobs)
+                self.assertIn("composited 1 images, skipped 1 unchanged", output.getvalue())
@@ -0,0 +1,124 @@
+import http.client
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from PIL import Image
+
+from constants import IMAGE_FILE_CSV_HEADER
+from imageset_gen import ImageSet
+from server import ByteCache, ImageServer, ImageRequestHandler
+from util import ImageOpt
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+class TestByteCache(TestCase):
+    def test_put__evicts_least_recently_used(self):
+        cache = ByteCache(max_bytes=5)
+        cache.put("a", b"aa")
+        cache.put("b", b"bb")
+        cache.get("a")
+        cache.put("c", b"cc")
+
+        self.assertEqual(b"aa", cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(4, cache.size)
+
+        cache.put("d", b"larger than the cache")
+        self.assertIsNone(cache.get("d"))
+
+
+class TestImageServer(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        imageset = ImageSet()
+        imageset.all_layers = imageset.load_imageset(f"{SCRIPT_DIR}/qunmk2_imageset.csv", f"{SCRIPT_DIR}/imageset")
+        opt = ImageOpt(height=48, gif=False, heights=[48, 24])
+
+        cls.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ImageRequestHandler)
+        cls.httpd.image_server = ImageServer(imageset, opt, cache_bytes=1 << 20)
+        cls.thread = threading.Thread(target=cls.httpd.serve_forever)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+        cls.thread.join()
+
+    def get(self, path, headers=None) -> http.client.HTTPResponse:
+        connection = http.client.HTTPConnection("127.0.0.1", self.httpd.server_port, timeout=30)
+        self.addCleanup(connection.close)
+        connection.request("GET", path, headers=headers or {})
+        response = connection.getresponse()
+        response.body = response.read()
+        return response
+
+    def test_get__renders_then_revalidates(self):
+        for path, content_type, signature in [("/s_1.png", "image/png", b"\x89PNG"),
+                                              ("/s_1.gif?h=24", "image/gif", b"GIF8")]:
+            response = self.get(path)
+            self.assertEqual(200, response.status, path)
+            self.assertEqual(content_type, response.getheader("Content-Type"))
+            self.assertTrue(response.body.startswith(signature))
+
+            etag = response.getheader("ETag")
+            not_modified = self.get(path, {"If-None-Match": etag})
+            self.assertEqual(304, not_modified.status)
+            self.assertEqual(etag, not_modified.getheader("ETag"))
+
+    def test_get__rejects_unknown_images_and_heights(self):
+        self.assertEqual(404, self.get("/no_such_layer.png").status)
+        self.assertEqual(404, self.get("/s_1.jpg").status)
+        self.assertEqual(400, self.get("/s_1.png?h=100").status)
+
+    def test_image__renders_once_for_concurrent_requests(self):
+        imageset = self.httpd.image_server.imageset
+        image_server = ImageServer(imageset, self.httpd.image_server.opt, 1 << 20)
+        variant = image_server.variant("png", 48)
+        key = ImageServer.image_key(imageset, "s_2", variant)
+
+        renders = []
+        release = threading.Event()
+        render = image_server.render
+
+        def wait_then_render(imageset, basename, variant):
+            renders.append(basename)
+            release.wait(5)
+            return render(imageset, basename, variant)
+
+        image_server.render = wait_then_render
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(image_server.image(imageset, "s_2", variant, key)))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while not image_server.rendering:
+            release.wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(["s_2"], renders)
+        self.assertEqual(3, len(results))
+        self.assertEqual(1, len(set(results)))
+
+    def test_load__serves_the_changed_imageset(self):
+        with tempfile.TemporaryDirectory() as temp_dirname:
+            imageset_dir = os.path.join(temp_dirname, "imageset")
+            shutil.copytree(f"{SCRIPT_DIR}/imageset", imageset_dir)
+            image_server = ImageServer(self.httpd.image_server.imageset, self.httpd.image_server.opt, 1 << 20)
+            variant = image_server.variant("png", 48)
+            key = ImageServer.image_key(image_server.imageset, "s_1", variant)
+            image_server.image(image_server.imageset, "s_1", variant, key)
+
+            layer_filename = dict(image_server.imageset.all_layers["s"].source)[IMAGE_FILE_CSV_HEADER]
+            Image.new("RGBA", (8, 8), (255, 0, 0, 255)).save(os.path.join(imageset_dir, layer_filename))
+            image_server.load(f"{SCRIPT_DIR}/qunmk2_imageset.csv", imageset_dir)
+
+            self.assertNotEqual(key, ImageServer.image_key(image_server.imageset, "s_1", variant))
+            self.assertEqual(0, image_server.cache.size)
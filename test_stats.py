@@ -0,0 +1,26 @@
+from unittest import TestCase
+
+from stats import Stats
+
+
+class TestStats(TestCase):
+    def test_percentiles__nearest_rank(self):
+        actual_output = Stats.percentiles([0.01 * value for value in range(100, 0, -1)])
+        self.assertEqual({"count": 100, "p50": 0.5, "p90": 0.9, "p99": 0.99, "max": 1.0}, actual_output)
+
+    def test_merge__worker_snapshot(self):
+        stats = Stats()
+        stats.add_stage("extract", 1.0, 0.5, "a.md")
+        stats.count("images_composited", 2)
+
+        worker_stats = Stats()
+        worker_stats.add_stage("extract", 2.0, 1.5, "b.md")
+        worker_stats.count("images_composited")
+        worker_stats.record_latency("render_image", 0.25)
+        stats.merge(worker_stats.snapshot())
+
+        report = stats.to_dict()
+        self.assertEqual({"wall_seconds": 3.0, "cpu_seconds": 2.0, "calls": 2}, report["stages"]["extract"])
+        self.assertEqual(["b.md", "a.md"], list(report["documents"]))
+        self.assertEqual({"images_composited": 3}, report["counters"])
+        self.assertEqual(1, report["latencies"]["render_image"]["count"])
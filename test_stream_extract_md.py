@@ -0,0 +1,45 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from extract_md import ExtractButtonsFromMarkdown
+from stream_extract_md import StreamButtonsFromMarkdown
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+PATTERN_FILENAME = f"{SCRIPT_DIR}/qunmk2.patset"
+
+TABLE = "| Button | Image |\n|---|---|\n| SHIFT + {}<br> | |\n"
+
+
+class TestStreamButtonsFromMarkdown(TestCase):
+
+    def test_stream__same_as_parsing_document(self):
+        for markdown_filename in [f"{SCRIPT_DIR}/test.md", f"{SCRIPT_DIR}/README.md"]:
+            self.assert_same_as_parsing_document(markdown_filename)
+
+    def test_stream__block_constructs(self):
+        """Tables inside code fences and HTML comments spanning blank lines, lists, and quotes, are not top-level."""
+        markdown = ("# Title\n\n" + TABLE.format(1) +
+                    "\n```\n\n" + TABLE.format(2) + "```\n" +
+                    "\n<!--\n\n" + TABLE.format(3) + "-->\n" +
+                    "\n- item\n\n" + "".join(f"  {line}\n" for line in TABLE.format(4).splitlines()) +
+                    "\n" + "".join(f"> {line}\n" for line in TABLE.format(5).splitlines()) +
+                    "\ntext\n" + TABLE.format(6) +
+                    "\n| Button | Image |\n|---|---|\n| SHIFT &amp; 7<br> | |\n| *SHIFT* + 8<br> | |\n")
+
+        with tempfile.TemporaryDirectory() as temp_dirname:
+            markdown_filename = os.path.join(temp_dirname, "edge.md")
+            with open(markdown_filename, "w") as fout:
+                fout.write(markdown)
+
+            sequences = self.assert_same_as_parsing_document(markdown_filename)
+
+        self.assertEqual([5, 34], [sequence.line_number for sequence in sequences])
+
+    def assert_same_as_parsing_document(self, markdown_filename):
+        expected = ExtractButtonsFromMarkdown(markdown_filename, PATTERN_FILENAME).button_sequences
+        actual = list(StreamButtonsFromMarkdown(PATTERN_FILENAME).stream(markdown_filename))
+
+        self.assertEqual([(sequence.basename, sequence.line_number) for sequence in expected],
+                         [(sequence.basename, sequence.line_number) for sequence in actual])
+        return actual
@@ -0,0 +1,40 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from watch import WatchSession, snapshot, watched_paths
+
+
+class TestWatch(TestCase):
+    def test_snapshot__detects_changes(self):
+        with tempfile.TemporaryDirectory() as temp_dirname:
+            filename = os.path.join(temp_dirname, "a.md")
+            with open(filename, "w") as fout:
+                fout.write("a")
+            missing_filename = os.path.join(temp_dirname, "missing.md")
+
+            before = snapshot([filename, missing_filename])
+            with open(filename, "a") as fout:
+                fout.write("b")
+            after = snapshot([filename, missing_filename])
+
+            self.assertIsNone(after[missing_filename])
+            self.assertNotEqual(before[filename], after[filename])
+
+    def test_is_imageset_changed__csv_or_directory_files(self):
+        with tempfile.TemporaryDirectory() as temp_dirname:
+            imageset_dir = os.path.join(temp_dirname, "imageset")
+            os.makedirs(imageset_dir)
+            layer_filename = os.path.join(imageset_dir, "bg.png")
+            open(layer_filename, "w").close()
+            csv_filename = os.path.join(temp_dirname, "imageset.csv")
+
+            session = WatchSession()
+            self.assertTrue(session.is_imageset_changed(set(), csv_filename, imageset_dir))
+
+            session.run_count = 1
+            self.assertEqual([layer_filename], watched_paths([], [imageset_dir]))
+            self.assertTrue(session.is_imageset_changed({layer_filename}, csv_filename, imageset_dir))
+            self.assertTrue(session.is_imageset_changed({csv_filename}, csv_filename, imageset_dir))
+            self.assertFalse(session.is_imageset_changed({os.path.join(temp_dirname, "a.md")}, csv_filename,
+                                                         imageset_dir))
@@ -1,6 +1,9 @@
+import hashlib
+import json
 from pathlib import Path
 
-from constants import GIF_IMAGE_EXTENSION, PNG_IMAGE_EXTENSION, SHORT_NAME_INFIX_SEPARATOR
+from constants import GIF_IMAGE_EXTENSION, PNG_IMAGE_EXTENSION, SHORT_NAME_INFIX_SEPARATOR, DIGEST_CHUNK_SIZE, \
+    DEFAULT_RESAMPLE_FILTER, VARIANT_HEIGHT_SEPARATOR, ANIMATION_FORMATS, DEFAULT_PNG_COMPRESS_LEVEL, DEFAULT_COMPOSITOR
 
 
 def make_out_dir(out_dirname):
@@ -8,6 +11,24 @@ def make_out_dir(out_dirname):
     Path(out_dirname).mkdir(parents=True, exist_ok=True)
 
 
+def digest_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def digest_file(filename) -> str:
+    """ Content hash of a file, read in chunks to bound memory for large inputs, e.g. PSD. """
+    hasher = hashlib.sha256()
+    with open(filename, "rb") as fin:
+        for chunk in iter(lambda: fin.read(DIGEST_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def digest_values(*values) -> str:
+    """ Content hash of JSON-serializable values, stable across runs. """
+    return digest_bytes(json.dumps(values, sort_keys=True, separators=(",", ":")).encode())
+
+
 def size_from_height(new_height, old_size) -> (int, int):
     old_width, old_height = tuple(old_size)
 
@@ -18,20 +39,88 @@ def size_from_height(new_height, old_size) -> (int, int):
     return new_size
 
 
+class PngOpt:
+    compress_level: int
+    """ zlib level, 0 (fastest) to 9 (smallest) """
+    optimize: bool
+    """ Search for the smallest encoding, slower, as with compress_level 9 """
+    colors: int
+    """ Quantize to a palette of at most this many colors, with alpha, or None for full RGBA """
+    strip: bool
+    """ Drop metadata copied from layer images, e.g. their ICC profile and resolution """
+    measure_saved: bool
+    """ Also encode each image with Pillow's defaults, in memory, to count the bytes saved """
+
+    def __init__(self, compress_level=DEFAULT_PNG_COMPRESS_LEVEL, optimize=False, colors=None, strip=False,
+                 measure_saved=False):
+        self.compress_level = compress_level
+        self.optimize = optimize
+        self.colors = colors
+        self.strip = strip
+        self.measure_saved = measure_saved
+
+    def is_default(self) -> bool:
+        return not self.key()
+
+    def key(self) -> []:
+        """
+        :return: Settings changing the written bytes, for caching. Empty by default, keeping earlier images fresh.
+        """
+        if (self.compress_level, self.optimize, self.colors, self.strip) == (DEFAULT_PNG_COMPRESS_LEVEL, False, None,
+                                                                             False):
+            return []
+        return [self.compress_level, self.optimize, self.colors, self.strip]
+
+
 class ImageOpt:
     height: int
+    """ Primary height, of the images linked from Markdown """
     gif: bool
-
-    def __init__(self, height, gif):
+    """ Primary format, of the images linked from Markdown, is animated: GIF, or animation_format """
+    prescale: bool
+    """ Composite at output size, from layers scaled once per height, instead of resizing full size composites """
+    resample: str
+    """ Name of the resampling filter for resizing, see RESAMPLE_FILTER_NAMES """
+    heights: [int]
+    """ Every height to generate, primary first """
+    formats: [str]
+    """ Every format to generate, as filename extensions, primary first """
+    animation_format: str
+    """ Format of animated images, as a filename extension, see ANIMATION_FORMATS """
+    png: PngOpt
+    """ Encoding of PNG images """
+    compositor: str
+    """ Name of the compositing backend, see COMPOSITOR_NAMES """
+
+    def __init__(self, height, gif, prescale=False, resample=DEFAULT_RESAMPLE_FILTER, heights=None, formats=None,
+                 animation_format=GIF_IMAGE_EXTENSION, png: PngOpt = None, compositor=DEFAULT_COMPOSITOR):
         self.height = height
         self.gif = gif
+        self.animation_format = animation_format
+        self.png = png or PngOpt()
+        self.compositor = compositor
+        self.prescale = prescale
+        self.resample = resample
+        self.heights = list(dict.fromkeys([height, *(heights or [])]))
+        self.formats = list(dict.fromkeys([self.extension(), *(formats or [])]))
 
     def extension(self):
         if self.gif:
-            return GIF_IMAGE_EXTENSION
+            return self.animation_format
         else:
             return PNG_IMAGE_EXTENSION
 
+    def variants(self) -> ["ImageOpt"]:
+        """ Options for generating each single height and format, primary first. """
+        return [ImageOpt(height, extension in ANIMATION_FORMATS, self.prescale, self.resample,
+                         animation_format=extension if extension in ANIMATION_FORMATS else self.animation_format,
+                         png=self.png, compositor=self.compositor)
+                for height in self.heights for extension in self.formats]
+
+    def variant_basename(self, basename, height) -> str:
+        """ Images of the primary height keep the plain basename, e.g. 's_1'. Others are suffixed, e.g. 's_1@96'. """
+        return basename if height == self.height else f"{basename}{VARIANT_HEIGHT_SEPARATOR}{height}"
+
 
 def format_image_basename(button_sequence) -> str:
     """
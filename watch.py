@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+
+from extract_index import ExtractionIndex
+from imageset_gen import ImageSet
+
+DEBUG_LOG_WATCH = False
+
+
+class WatchSession:
+    """
+    State kept warm between runs while watching: an in-memory extraction index per Markdown file, so that only
+    edited tables are extracted again, and the loaded imageset layers, reloaded only when the imageset changes.
+
+    Images are regenerated only when their inputs change, by the image cache in the output directory, so a changed
+    layer file regenerates exactly the images using it.
+    """
+    indexes: {str: ExtractionIndex} = {}
+    imageset: ImageSet = None
+    run_count: int = 0
+
+    def __init__(self):
+        self.indexes = {}
+        self.imageset = ImageSet()
+        self.run_count = 0
+
+    def extraction_index(self, md_filename, index_filename=None, force=False) -> ExtractionIndex:
+        """
+        :param index_filename: Optional index file, read on first use and written after each extraction
+        """
+        if md_filename not in self.indexes:
+            self.indexes[md_filename] = ExtractionIndex(index_filename, force)
+        return self.indexes[md_filename]
+
+    def is_imageset_changed(self, changed_paths: {str}, imageset_filename, imageset_dir) -> bool:
+        """ Whether the imageset CSV, or any file in the imageset directory, changed since the last run.
+        """
+        if self.run_count == 0:
+            return True
+
+        csv_path = os.path.abspath(imageset_filename)
+        dir_path = os.path.join(os.path.abspath(imageset_dir), "")
+        return any(path == csv_path or path.startswith(dir_path) for path in changed_paths)
+
+
+def watched_paths(filenames: [str], dirnames: [str]) -> [str]:
+    """
+    :return: Absolute paths of the files, and of all files within the directories
+    """
+    result = [os.path.abspath(filename) for filename in filenames]
+    for dirname in dirnames:
+        for root, _, files in os.walk(dirname):
+            result.extend(os.path.abspath(os.path.join(root, filename)) for filename in files)
+    return result
+
+
+def snapshot(paths: [str]) -> {str: (int, int)}:
+    """
+    :return: Modification time and size of each path, or None for missing files
+    """
+    result = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            result[path] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            result[path] = None
+    return result
+
+
+def watch(list_paths, run, interval):
+    """
+    Runs once, then polls the paths and runs again after each change, until interrupted.
+
+    :param list_paths: Function listing the paths to watch, called on every poll so that new files are noticed
+    :param run: Function of the set of changed paths
+    :param interval: Seconds between polls
+    """
+    previous = snapshot(list_paths())
+    run(set(previous))
+    print(f"watching {len(previous)} files, press Ctrl-C to stop")
+
+    try:
+        while True:
+            time.sleep(interval)
+
+            current = snapshot(list_paths())
+            changed = {path for path in previous.keys() | current.keys() if previous.get(path) != current.get(path)}
+            if not changed:
+                continue
+
+            # Snapshot before running, so that edits made during the run cause another run
+            previous = current
+            print(f"changed: {', '.join(sorted(os.path.relpath(path) for path in changed))}")
+
+            start_time = time.perf_counter()
+            run(changed)
+            if DEBUG_LOG_WATCH:
+                print(f"watch: ran in {time.perf_counter() - start_time:.3f}s", file=sys.stderr)
+    except KeyboardInterrupt:
+        pass